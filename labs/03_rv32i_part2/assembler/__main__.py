@@ -1,3 +1,16 @@
+import sys
+
+import server
+
+if sys.argv[1:2] == ["--server"]:
+    server.main(sys.argv[2:])
+    sys.exit(0)
+
+# Hand off to a running assembler server if there is one, otherwise assemble here
+exit_code = server.request(sys.argv[1:])
+if exit_code is not None:
+    sys.exit(exit_code)
+
 from main import main
 
 main()
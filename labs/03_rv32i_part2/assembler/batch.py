@@ -0,0 +1,340 @@
+"""
+Vectorized (NumPy) versions of the encoder and decoder in rv32i.py, for assembling and
+disassembling whole programs at once.
+
+Operands are still pulled out of each ParsedLine in Python, but every field (registers,
+immediates, label offsets) is packed into the instruction words with a handful of array
+operations instead of one encoder call per line. Decoding goes the other way: every field of every
+word is pulled out with array operations, and only the final text is made in Python.
+"""
+
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from helpers import LineException, UndefinedSymbolException
+from constants import *
+import rv32i
+
+
+def require_numpy():
+    if np is None:
+        raise Exception("Missing a library, try `sudo apt install python3-numpy`")
+
+
+FORMAT_CODES = {"halt": 0, "R": 1, "I": 2, "L": 3, "S": 4, "B": 5, "J": 6, "U": 7}
+
+# Width of the (signed) immediate that check_imm would be called with, by format code. B and J are
+# checked after dropping the always-zero low bit, just like rv32i.encode_btype/encode_jtype.
+IMMEDIATE_BITS = [0, 0, 12, 12, 12, 12, 20, 20]
+
+
+def extract_operands(parsed, label_ids, labels, address):
+    """
+    Returns (format, instruction, rd, rs1, rs2, imm, label_id) for one ParsedLine, with any unused
+    operands set to 0 (and label_id to -1). Branch and jump targets that are already offsets come
+    out as imm instead of a label_id.
+    """
+    instruction = parsed.instruction
+    args = parsed.args
+    if instruction == "halt":
+        return "halt", instruction, 0, 0, 0, 0, -1
+    fmt = INSTRUCTION_FORMATS.get(instruction)
+    if fmt == "R":
+        if len(args) != 3:
+            raise LineException("R-type instructions require 3 arguments.")
+        if all(rv32i.is_register(a) for a in args):
+            rd, rs1, rs2 = [rv32i.register_number(a) for a in args]
+            return fmt, instruction, rd, rs1, rs2, 0, -1
+        # Same as encode_rtype: GCC sometimes forgets the I in immediate instructions
+        instruction += "i"
+        fmt = INSTRUCTION_FORMATS.get(instruction)
+    if fmt == "I":
+        if len(args) != 3:
+            raise LineException("I-type instructions require 3 arguments.")
+        rd, rs1, imm = args
+        imm = rv32i.immediate_value(imm, labels, address)
+        if rv32i.fits_imm(imm, 12):  # Otherwise the range check reports it, like encode_itype
+            rv32i.check_shift_amount(instruction, imm)
+        return fmt, instruction, rv32i.register_number(rd), rv32i.register_number(rs1), 0, imm, -1
+    if fmt == "L":
+        rd, offset_rs = args
+        imm, rs1 = rv32i.memory_operand(offset_rs, labels, address)
+        return fmt, instruction, rv32i.register_number(rd), rs1, 0, imm, -1
+    if fmt == "S":
+        rs2, offset_rs = args
+        imm, rs1 = rv32i.memory_operand(offset_rs, labels, address)
+        return fmt, instruction, 0, rs1, rv32i.register_number(rs2), imm, -1
+    if fmt == "B":
+        rs1, rs2, label = args
+        if isinstance(label, int):
+            imm, label_id = label, -1
+        elif label in label_ids:
+            imm, label_id = 0, label_ids[label]
+        else:
+            raise UndefinedSymbolException(label)
+        return (
+            fmt,
+            instruction,
+            0,
+            rv32i.register_number(rs1),
+            rv32i.register_number(rs2),
+            imm,
+            label_id,
+        )
+    if fmt == "J":
+        rd, label = args
+        if isinstance(label, int):
+            return fmt, instruction, rv32i.register_number(rd), 0, 0, label, -1
+        if label not in label_ids:
+            raise UndefinedSymbolException(label)
+        return fmt, instruction, rv32i.register_number(rd), 0, 0, 0, label_ids[label]
+    if fmt == "U":
+        rd, upimm = args
+        return (
+            fmt,
+            instruction,
+            rv32i.register_number(rd),
+            0,
+            0,
+            rv32i.immediate_value(upimm, labels, address),
+            -1,
+        )
+    raise LineException(f"Instruction {instruction} was not handled.")
+
+
+def assemble_words(parsed_lines, labels, start_address=0):
+    """
+    Encode a whole program, returning a uint32 array with one instruction word per ParsedLine.
+
+    Produces the same words as calling rv32i.line_to_word on each line. Any LineException raised
+    has the offending ParsedLine attached as `e.line`.
+    """
+    require_numpy()
+    label_ids = {label: i for i, label in enumerate(labels)}
+    label_addresses = np.array([int(a) for a in labels.values()] + [0], dtype=np.int64)
+
+    count = len(parsed_lines)
+    formats = np.empty(count, dtype=np.uint8)
+    bases = np.empty(count, dtype=np.int64)
+    rds = np.empty(count, dtype=np.int64)
+    rs1s = np.empty(count, dtype=np.int64)
+    rs2s = np.empty(count, dtype=np.int64)
+    imms = np.empty(count, dtype=np.int64)
+    label_indices = np.empty(count, dtype=np.int64)
+
+    columns = []
+    for i, parsed in enumerate(parsed_lines):
+        try:
+            columns.append(extract_operands(parsed, label_ids, labels, start_address + 4 * i))
+        except LineException as e:
+            e.line = parsed
+            raise e
+    if count:
+        fmts, instructions, rds[:], rs1s[:], rs2s[:], imms[:], label_indices[:] = zip(*columns)
+        formats[:] = [FORMAT_CODES[f] for f in fmts]
+        bases[:] = [BASE_WORDS.get(i, 0) for i in instructions]
+
+    is_b = formats == FORMAT_CODES["B"]
+    is_j = formats == FORMAT_CODES["J"]
+    is_i = (formats == FORMAT_CODES["I"]) | (formats == FORMAT_CODES["L"])
+    is_s = formats == FORMAT_CODES["S"]
+    is_u = formats == FORMAT_CODES["U"]
+
+    # Label-relative offsets for branches and jumps
+    addresses = start_address + 4 * np.arange(count, dtype=np.int64)
+    has_label = (is_b | is_j) & (label_indices >= 0)
+    imms = np.where(has_label, label_addresses[label_indices] - addresses, imms)
+
+    # Range checks, all at once
+    checked = np.where(is_b | is_j, imms >> 1, imms)
+    limits = np.array([1 << (b - 1) if b else 0 for b in IMMEDIATE_BITS], dtype=np.int64)
+    limit = limits[formats]
+    bad = np.nonzero((limit > 0) & ((checked >= limit) | (checked < -limit)))[0]
+    if len(bad):
+        i = bad[0]
+        e = LineException(
+            f"Immediate {checked[i]} does not fit into {IMMEDIATE_BITS[formats[i]]} bits."
+        )
+        e.line = parsed_lines[i]
+        raise e
+
+    imm12 = imms & 0xFFF
+    imm13 = imms & 0x1FFF
+    imm21 = imms & 0x1FFFFF
+    immediates = np.select(
+        [is_i, is_s, is_b, is_j, is_u],
+        [
+            imm12 << 20,
+            ((imm12 >> 5) << 25) | ((imm12 & 0x1F) << 7),
+            ((imm13 >> 12) << 31)
+            | (((imm13 >> 5) & 0x3F) << 25)
+            | (((imm13 >> 1) & 0xF) << 8)
+            | (((imm13 >> 11) & 0x1) << 7),
+            ((imm21 >> 20) << 31)
+            | (((imm21 >> 1) & 0x3FF) << 21)
+            | (((imm21 >> 11) & 0x1) << 20)
+            | (((imm21 >> 12) & 0xFF) << 12),
+            (imms & 0xFFFFF) << 12,
+        ],
+        0,
+    )
+
+    words = bases | (rds << 7) | (rs1s << 15) | (rs2s << 20) | immediates
+    return words.astype(np.uint32)
+
+
+# Shift amounts live where rs2 would be, instead of a sign-extended immediate
+SHIFT_OPS = ("slli", "srli", "srai")
+
+
+@lru_cache(maxsize=None)
+def decode_tables():
+    """
+    Lookup tables for decode_words, made by running rv32i.decode_word on every opcode/funct3 pair
+    (and every funct7, for the ones that depend on it). Returns (ops, formats, depends on funct7,
+    op for each opcode | funct3 << 7 | funct7 << 10), where ops and formats are indexed by the
+    numbers in the last table (-1 for invalid instructions).
+    """
+    require_numpy()
+    funct7_opcodes = {OP_CODE_VALUES["add"]: rv32i.RTYPE_FUNCT7_OPS, OP_CODE_VALUES["addi"]: rv32i.ITYPE_FUNCT7_OPS}
+    depends = np.zeros(1 << 10, dtype=bool)
+    for opcode, table in funct7_opcodes.items():
+        for funct3, _ in table:
+            depends[opcode | funct3 << 7] = True
+
+    ops = []
+    formats = []
+    op_ids = {}
+    table = np.full(1 << 17, -1, dtype=np.int16)
+    for key in range(1 << 10):
+        for funct7 in range(128) if depends[key] else [0]:
+            word = (key & 0x7F) | (key >> 7) << 12 | funct7 << 25
+            if word == 0:
+                continue  # halt is the whole word being 0, not just these fields
+            try:
+                decoded = rv32i.decode_word(word)
+            except ValueError:
+                continue
+            if (decoded.op, decoded.format) not in op_ids:
+                op_ids[decoded.op, decoded.format] = len(ops)
+                ops.append(decoded.op)
+                formats.append(decoded.format)
+            table[key | funct7 << 10] = op_ids[decoded.op, decoded.format]
+    return ops, formats, depends, table
+
+
+def decode_words(words):
+    """
+    Decode an array of instruction words all at once. Returns (op, rd, rs1, rs2, imm) arrays, with
+    op indexing decode_tables()[0] (-1 for words that aren't valid instructions, and for halt) and
+    immediates sign-extended like rv32i.decode_word.
+    """
+    ops, formats, depends, table = decode_tables()
+    words = np.asarray(words, dtype=np.uint32).astype(np.int64)
+    opcodes = words & 0x7F
+    funct3s = (words >> 12) & 0x7
+    rds = (words >> 7) & 0x1F
+    rs1s = (words >> 15) & 0x1F
+    rs2s = (words >> 20) & 0x1F
+    funct7s = words >> 25
+    key = opcodes | (funct3s << 7)
+    op = table[key | np.where(depends[key], funct7s << 10, 0)].astype(np.int64)
+
+    def sign_extend(value, bits):
+        return value - ((value >> (bits - 1)) << bits)
+
+    format_of = np.array([FORMAT_CODES[f] for f in formats] + [0], dtype=np.uint8)[op]
+    is_shift = np.isin(op, [i for i, name in enumerate(ops) if name in SHIFT_OPS])
+    imm = np.select(
+        [
+            is_shift,
+            (format_of == FORMAT_CODES["I"]) | (format_of == FORMAT_CODES["L"]),
+            format_of == FORMAT_CODES["S"],
+            format_of == FORMAT_CODES["B"],
+            format_of == FORMAT_CODES["J"],
+            format_of == FORMAT_CODES["U"],
+        ],
+        [
+            rs2s,
+            sign_extend(words >> 20, 12),
+            sign_extend((funct7s << 5) | rds, 12),
+            sign_extend(
+                ((words >> 31) << 12)
+                | (((words >> 25) & 0x3F) << 5)
+                | (((words >> 8) & 0xF) << 1)
+                | (((words >> 7) & 0x1) << 11),
+                13,
+            ),
+            sign_extend(
+                ((words >> 31) << 20)
+                | (((words >> 21) & 0x3FF) << 1)
+                | (((words >> 20) & 0x1) << 11)
+                | (((words >> 12) & 0xFF) << 12),
+                21,
+            ),
+            sign_extend(words >> 12, 20),
+        ],
+        0,
+    )
+    # decode_word refuses jumps that aren't to a whole instruction
+    op[(format_of == FORMAT_CODES["J"]) & (imm % 4 != 0)] = -1
+    return op, rds, rs1s, rs2s, imm
+
+
+def disassemble_words(words, labels=None, start_address=0):
+    """
+    Disassemble an array of instruction words, returning one line of text for each. The same text
+    as rv32i.bits_to_line(word, labels, address), and the same ValueError for the first invalid word
+    (with its index as `e.index`).
+    """
+    ops, formats, _, _ = decode_tables()
+    words = np.asarray(words, dtype=np.uint32)
+    op, rds, rs1s, rs2s, imms = decode_words(words)
+    invalid = np.nonzero((op < 0) & (words != 0))[0]
+    if len(invalid):
+        i = int(invalid[0])
+        try:
+            rv32i.decode_word(int(words[i]))
+        except ValueError as e:
+            e.index = i
+            raise e
+
+    names = [names[-1] for names in REGISTER_NAMES]
+    lines = []
+    address = start_address
+    for op_id, rd, rs1, rs2, imm in zip(op.tolist(), rds.tolist(), rs1s.tolist(), rs2s.tolist(), imms.tolist()):
+        if op_id < 0:
+            lines.append("halt")
+        else:
+            fmt = formats[op_id]
+            if fmt == "R":
+                lines.append(f"{ops[op_id]} {names[rd]}, {names[rs1]}, {names[rs2]}")
+            elif fmt == "I":
+                lines.append(f"{ops[op_id]} {names[rd]}, {names[rs1]}, {imm}")
+            elif fmt == "L":
+                lines.append(f"{ops[op_id]} {names[rd]}, {imm}({names[rs1]})")
+            elif fmt == "S":
+                lines.append(f"{ops[op_id]} {names[rs2]}, {imm}({names[rs1]})")
+            elif fmt == "U":
+                lines.append(f"{ops[op_id]} {names[rd]}, {imm}")
+            elif labels is None:
+                operands = f"{names[rs1]}, {names[rs2]}" if fmt == "B" else names[rd]
+                lines.append(f"{ops[op_id]} {operands}, {imm}")
+            else:
+                decoded = rv32i.DecodedInstruction(ops[op_id], fmt, rd, rs1, rs2, imm)
+                lines.append(decoded.format_line(labels, address))
+        address += 4
+    return lines
+
+
+def branch_targets(words, start_address=0):
+    """ The address every branch and jal in an array of instruction words goes to. """
+    ops, formats, _, _ = decode_tables()
+    op, _, _, _, imms = decode_words(words)
+    jumps = np.isin(op, [i for i, f in enumerate(formats) if f in ("B", "J")])
+    addresses = start_address + 4 * np.arange(len(op), dtype=np.int64)
+    return set((addresses + imms)[jumps].tolist())
@@ -0,0 +1,102 @@
+"""
+A local cache of assembler outputs, keyed by the content of everything that goes into them (input
+files, flags, and the assembler itself) rather than by timestamps. A fresh checkout that makes
+`make` think everything is out of date can then restore each .memh (and its sourcemap) instantly.
+
+Each entry is a directory named after its key. Entries are touched whenever they're used, and the
+least recently used ones are deleted once the cache grows past its size limit.
+"""
+
+from __future__ import annotations
+from typing import *
+
+import glob
+import hashlib
+import os
+import os.path as path
+import shutil
+
+# Overridden by $ASSEMBLER_CACHE_DIR and $ASSEMBLER_CACHE_MAX_BYTES. Those are read for each build
+# rather than at import, since the assembler server imports this once and builds for many clients.
+DEFAULT_CACHE_DIR = ".assembler_cache"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+ASSEMBLER_DIR = path.dirname(path.abspath(__file__))
+
+
+def assembler_version() -> str:
+    """ A hash of the assembler's own source, so changing the assembler invalidates the cache. """
+    h = hashlib.sha256()
+    for fn in sorted(glob.glob(path.join(ASSEMBLER_DIR, "*.py"))):
+        h.update(path.basename(fn).encode())
+        with open(fn, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def cache_key(files: Iterable[str], flags: Mapping[str, Any]) -> str:
+    h = hashlib.sha256()
+    h.update(assembler_version().encode())
+    h.update(repr(sorted(flags.items())).encode())
+    for fn in files:
+        with open(fn, "rb") as f:
+            contents = f.read()
+        h.update(f"{len(contents)}:".encode())
+        h.update(contents)
+    return h.hexdigest()
+
+
+class BuildCache:
+    # Names of the files in each entry
+    OUTPUT = "output"
+    SOURCEMAP = "sourcemap.txt"
+    DATA = "data"
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or os.environ.get("ASSEMBLER_CACHE_DIR", DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("ASSEMBLER_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self.max_bytes = max_bytes
+
+    def restore(self, key, output, sourcemap=None, data=None) -> bool:
+        """
+        Copy a cached build to output (and sourcemap and data memory image). Returns False on a
+        cache miss.
+        """
+        entry = path.join(self.cache_dir, key)
+        files = [(self.OUTPUT, output), (self.SOURCEMAP, sourcemap), (self.DATA, data)]
+        files = [(name, fn) for name, fn in files if fn]
+        if not all(path.exists(path.join(entry, name)) for name, _ in files):
+            return False
+        for name, fn in files:
+            shutil.copyfile(path.join(entry, name), fn)
+        os.utime(entry)  # Mark as recently used
+        return True
+
+    def store(self, key, output, sourcemap=None, data=None):
+        entry = path.join(self.cache_dir, key)
+        tmp = entry + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, fn in [(self.OUTPUT, output), (self.SOURCEMAP, sourcemap), (self.DATA, data)]:
+            if fn:
+                shutil.copyfile(fn, path.join(tmp, name))
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        """ Delete least recently used entries until the cache fits in max_bytes. """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or entry.name.endswith(".tmp"):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+            total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
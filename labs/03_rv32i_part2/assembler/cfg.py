@@ -0,0 +1,282 @@
+"""
+Control-flow graph: splitting a program into basic blocks (straight-line runs of instructions that
+are only ever entered at the top), and working out which blocks can jump or fall through to which.
+
+A new block starts at every label, and after every branch, jump and halt. Edges come from:
+
+    beq a0, a1, loop    ->  loop, and the next block (if the branch isn't taken)
+    jal zero, done      ->  done
+    jal ra, f           ->  f, and the next block (f returns there)
+    jalr zero, ra, 0    ->  nothing (returns go back to the block after the call)
+    halt                ->  nothing
+
+Anything that could be reached in a way we can't see (a label whose address is taken by `la`,
+`%hi`/`%lo`, or `.word label`, ex. a function pointer) counts as an entry point, so eliminate() only
+removes code that really can never run: code after a `ret`/`j`/`halt` that nothing jumps to, and
+functions that are never called.
+"""
+
+from __future__ import annotations
+from typing import *
+
+import json
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
+from constants import BTYPES
+from lexer import Memory, Relocation, register
+from relax import text_label_lines
+
+ZERO = register("zero")
+
+
+@dataclass
+class BasicBlock:
+    index: int
+    start: int  # first line
+    end: int  # one past the last line
+    labels: List[str] = field(default_factory=list)
+    successors: List[int] = field(default_factory=list)
+    call: Optional[int] = None  # the block this one calls (it returns to the next block)
+    reachable: bool = False
+
+    @property
+    def lines(self) -> range:
+        return range(self.start, self.end)
+
+
+def jump_target(parsed) -> Tuple[Optional[Any], bool, bool]:
+    """
+    Where a control-flow instruction can go: (target, falls through, ends the block). target is a
+    label, a byte offset, or None if there isn't one we know of (ex. `ret`).
+    """
+    instruction, args = parsed.instruction, parsed.args
+    if instruction == "halt":
+        return None, False, True
+    if instruction in BTYPES and len(args) == 3:
+        return args[2], True, True
+    if instruction == "jal" and len(args) == 2:
+        return args[1], args[0] != ZERO, True
+    if instruction == "jalr" and len(args) == 3:
+        # auipc/jalr pairs from relaxation name their target with %pcrel_lo
+        target = args[2].symbol if isinstance(args[2], Relocation) else None
+        return target, args[0] != ZERO, True
+    return None, True, False
+
+
+def referenced_labels(parsed) -> Iterator[str]:
+    """ Labels an instruction uses other than as a branch/jump target (ex. `la a0, table`). """
+    args = parsed.args
+    if parsed.instruction in BTYPES or parsed.instruction == "jal":
+        args = args[:-1]
+    for arg in args:
+        if isinstance(arg, Memory):
+            arg = arg.offset
+        if isinstance(arg, Relocation):
+            yield arg.symbol
+        elif isinstance(arg, str):
+            yield arg
+
+
+def offset_jumps(parsed_lines) -> List[Tuple[int, int]]:
+    """ (line, target line) for every branch and jump by a number of bytes instead of to a label. """
+    count = len(parsed_lines)
+    jumps = []
+    for i, parsed in enumerate(parsed_lines):
+        target, _, _ = jump_target(parsed)
+        if isinstance(target, int) and target % 4 == 0 and 0 <= i + target // 4 <= count:
+            jumps.append((i, i + target // 4))
+    return jumps
+
+
+def patch_offset_jumps(old_lines, new_lines, new_index, jumps) -> List[Tuple[int, int]]:
+    """
+    After removing lines (new_index is where each of old_lines ended up, and where the end did),
+    fix the offsets of the jumps from offset_jumps(old_lines) that are still in new_lines, in place.
+    Returns those jumps in terms of new_lines.
+    """
+    kept = []
+    for line, target in jumps:
+        i = new_index[line]
+        if i < len(new_lines) and new_lines[i] is old_lines[line]:
+            parsed = old_lines[line]
+            new_lines[i] = parsed.replace(args=parsed.args[:-1] + [4 * (new_index[target] - i)])
+            kept.append((i, new_index[target]))
+    return kept
+
+
+class ControlFlowGraph:
+    def __init__(self, parsed_lines, labels, start_address=0, roots=()):
+        """
+        Build the graph for parsed_lines (one instruction per line), where labels maps names to
+        addresses. Execution starts at the first line, and roots are extra labels that might be
+        jumped to from somewhere we can't see.
+        """
+        self.parsed_lines = parsed_lines
+        self.start_address = start_address
+        count = len(parsed_lines)
+        label_lines = text_label_lines(labels, count, start_address)
+
+        leaders = {0} | {line for line in label_lines.values() if line < count}
+        targets = []
+        self.offset_jumps = offset_jumps(parsed_lines)
+        offset_targets = dict(self.offset_jumps)
+        leaders.update(offset_targets.values())
+        for i, parsed in enumerate(parsed_lines):
+            target, falls_through, ends_block = jump_target(parsed)
+            if ends_block and i + 1 < count:
+                leaders.add(i + 1)
+            if isinstance(target, int):
+                target = offset_targets.get(i)
+            elif target is not None:
+                target = label_lines.get(target)
+            targets.append((target, falls_through))
+
+        starts = sorted(line for line in leaders if line < count)
+        self.blocks: List[BasicBlock] = [
+            BasicBlock(index, start, end)
+            for index, (start, end) in enumerate(zip(starts, starts[1:] + [count]))
+        ]
+        self.block_at = {block.start: block.index for block in self.blocks}
+        for label, line in sorted(label_lines.items(), key=lambda item: item[1]):
+            if line in self.block_at:
+                self.blocks[self.block_at[line]].labels.append(label)
+
+        for block in self.blocks:
+            target, falls_through = targets[block.end - 1]
+            if target in self.block_at:
+                block.successors.append(self.block_at[target])
+                if falls_through and parsed_lines[block.end - 1].instruction in ("jal", "jalr"):
+                    block.call = self.block_at[target]
+            if falls_through and block.end in self.block_at:
+                if self.block_at[block.end] not in block.successors:
+                    block.successors.append(self.block_at[block.end])
+
+        roots = set(roots)
+        for parsed in parsed_lines:
+            roots.update(referenced_labels(parsed))
+        self.entries = sorted({
+            self.block_at[label_lines[label]]
+            for label in roots
+            if label_lines.get(label) in self.block_at
+        } | ({0} if self.blocks else set()))
+        self.mark_reachable()
+
+    def block_of(self, line: int) -> int:
+        return bisect_right([block.start for block in self.blocks], line) - 1
+
+    def address(self, line: int) -> int:
+        return self.start_address + 4 * line
+
+    def mark_reachable(self):
+        stack = list(self.entries)
+        while stack:
+            block = self.blocks[stack.pop()]
+            if block.reachable:
+                continue
+            block.reachable = True
+            stack += [s for s in block.successors if not self.blocks[s].reachable]
+
+    @property
+    def dead_lines(self) -> int:
+        return sum(block.end - block.start for block in self.blocks if not block.reachable)
+
+    def back_edges(self) -> Set[Tuple[int, int]]:
+        """
+        Edges that jump back to a block that's still being explored in a depth-first search from the
+        entry points: the jumps back to the top of each loop.
+        """
+        back = set()
+        state = [0] * len(self.blocks)  # 0 = not visited, 1 = exploring, 2 = done
+        for entry in self.entries:
+            if state[entry]:
+                continue
+            stack = [(entry, iter(self.blocks[entry].successors))]
+            state[entry] = 1
+            while stack:
+                index, successors = stack[-1]
+                for successor in successors:
+                    if state[successor] == 1:
+                        back.add((index, successor))
+                    elif state[successor] == 0:
+                        state[successor] = 1
+                        stack.append((successor, iter(self.blocks[successor].successors)))
+                        break
+                else:
+                    state[index] = 2
+                    stack.pop()
+        return back
+
+    def eliminate(self, labels) -> Tuple[List[Any], Dict[str, int]]:
+        """
+        Remove every unreachable block. Returns the remaining lines, and labels with the ones in
+        code moved to their new addresses (labels on removed code move to whatever comes next).
+        """
+        count = len(self.parsed_lines)
+        new_lines = []
+        new_index = [0] * (count + 1)
+        for block in self.blocks:
+            for i in block.lines:
+                new_index[i] = len(new_lines) + (i - block.start if block.reachable else 0)
+            if block.reachable:
+                new_lines += self.parsed_lines[block.start:block.end]
+        new_index[count] = len(new_lines)
+
+        # Jumps by a number of bytes (instead of to a label) may have had code removed in between
+        patch_offset_jumps(self.parsed_lines, new_lines, new_index, self.offset_jumps)
+
+        label_lines = text_label_lines(labels, count, self.start_address)
+        new_labels = {
+            label: self.address(new_index[label_lines[label]]) if label in label_lines else address
+            for label, address in labels.items()
+        }
+        return new_lines, new_labels
+
+    def as_dict(self) -> Dict[str, Any]:
+        back = self.back_edges()
+        return {
+            "entries": self.entries,
+            "blocks": [
+                {
+                    "index": block.index,
+                    "address": self.address(block.start),
+                    "end_address": self.address(block.end),
+                    "labels": block.labels,
+                    "instructions": [
+                        self.parsed_lines[i].original for i in block.lines
+                    ],
+                    "successors": block.successors,
+                    "call": block.call,
+                    "reachable": block.reachable,
+                }
+                for block in self.blocks
+            ],
+            "loops": [{"from": source, "to": target} for source, target in sorted(back)],
+        }
+
+    def to_dot(self) -> str:
+        back = self.back_edges()
+        lines = ["digraph cfg {", '  node [shape=box, fontname="monospace"];']
+        for block in self.blocks:
+            name = ", ".join(block.labels) or f"block {block.index}"
+            body = [f"{name} ({hex(self.address(block.start))})"] + [
+                self.parsed_lines[i].original or self.parsed_lines[i].instruction
+                for i in block.lines
+            ]
+            text = "\\l".join(line.replace("\\", "\\\\").replace('"', '\\"') for line in body)
+            style = "" if block.reachable else ", style=dashed, color=gray"
+            lines.append(f'  b{block.index} [label="{text}\\l"{style}];')
+            for successor in block.successors:
+                color = " [color=red]" if (block.index, successor) in back else ""
+                lines.append(f"  b{block.index} -> b{successor}{color};")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, fn: str):
+        """ Write the graph as DOT (for Graphviz) if fn ends in .dot/.gv, otherwise as JSON. """
+        with open(fn, "w") as f:
+            if fn.endswith((".dot", ".gv")):
+                f.write(self.to_dot())
+            else:
+                json.dump(self.as_dict(), f, indent=2)
+                f.write("\n")
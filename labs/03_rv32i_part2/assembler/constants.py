@@ -76,43 +76,79 @@ BTYPES = ["beq", "bne", "blt", "bge", "bltu", "bgeu"]
 JTYPES = ["jal"]
 UTYPES = ["lui", "auipc"]
 
-OP_CODES = {}
+OP_CODE_VALUES = {}
 for i in RTYPES:
-    OP_CODES[i] = BitArray("0b0110011")
+    OP_CODE_VALUES[i] = 0b0110011
 for i in ITYPES:
-    OP_CODES[i] = BitArray("0b0010011")
+    OP_CODE_VALUES[i] = 0b0010011
 for i in LTYPES:
-    OP_CODES[i] = BitArray("0b0000011")
+    OP_CODE_VALUES[i] = 0b0000011
 for i in STYPES:
-    OP_CODES[i] = BitArray("0b0100011")
+    OP_CODE_VALUES[i] = 0b0100011
 for i in BTYPES:
-    OP_CODES[i] = BitArray("0b1100011")
-OP_CODES["jal"] = BitArray("0b1101111")
-OP_CODES["jalr"] = BitArray("0b1100111")
-OP_CODES["lui"] = BitArray("0b0110111")
-OP_CODES["auipc"] = BitArray("0b0010111")
-# op_codes["ecall"] = BitArray("0b1110011")
-# op_codes["ebreak"] = BitArray("0b1110011")
-
-BITS_TO_OP_CODE = {v.bin: k for k, v in OP_CODES.items()}
+    OP_CODE_VALUES[i] = 0b1100011
+OP_CODE_VALUES["jal"] = 0b1101111
+OP_CODE_VALUES["jalr"] = 0b1100111
+OP_CODE_VALUES["lui"] = 0b0110111
+OP_CODE_VALUES["auipc"] = 0b0010111
+# OP_CODE_VALUES["ecall"] = 0b1110011
+# OP_CODE_VALUES["ebreak"] = 0b1110011
 
-FUNCT3_CODES = {}
+FUNCT3_VALUES = {}
 for i in ["add", "sub", "addi", "lb", "sb", "beq", "jalr"]:
-    FUNCT3_CODES[i] = BitArray("0b000")
+    FUNCT3_VALUES[i] = 0b000
 for i in ["sll", "slli", "lh", "sh", "bne"]:
-    FUNCT3_CODES[i] = BitArray("0b001")
+    FUNCT3_VALUES[i] = 0b001
 for i in ["slt", "slti", "lw", "sw"]:
-    FUNCT3_CODES[i] = BitArray("0b010")
+    FUNCT3_VALUES[i] = 0b010
 for i in ["sltu", "sltiu"]:
-    FUNCT3_CODES[i] = BitArray("0b011")
+    FUNCT3_VALUES[i] = 0b011
 for i in ["xor", "xori", "lbu", "blt"]:
-    FUNCT3_CODES[i] = BitArray("0b100")
+    FUNCT3_VALUES[i] = 0b100
 for i in ["srl", "sra", "srli", "srai", "lhu", "bge"]:
-    FUNCT3_CODES[i] = BitArray("0b101")
+    FUNCT3_VALUES[i] = 0b101
 for i in ["or", "ori", "bltu"]:
-    FUNCT3_CODES[i] = BitArray("0b110")
+    FUNCT3_VALUES[i] = 0b110
 for i in ["and", "andi", "bgeu"]:
-    FUNCT3_CODES[i] = BitArray("0b111")
+    FUNCT3_VALUES[i] = 0b111
+
+FUNCT7_VALUES = {"sub": 0b0100000, "sra": 0b0100000, "srai": 0b0100000}
+
+# Which encoder handles each instruction. L isn't an official format (loads are I-types), but
+# they're parsed differently.
+INSTRUCTION_FORMATS = {}
+for i in RTYPES:
+    INSTRUCTION_FORMATS[i] = "R"
+for i in ITYPES:
+    INSTRUCTION_FORMATS[i] = "I"
+for i in LTYPES:
+    INSTRUCTION_FORMATS[i] = "L"
+for i in STYPES:
+    INSTRUCTION_FORMATS[i] = "S"
+for i in BTYPES:
+    INSTRUCTION_FORMATS[i] = "B"
+for i in JTYPES:
+    INSTRUCTION_FORMATS[i] = "J"
+for i in UTYPES:
+    INSTRUCTION_FORMATS[i] = "U"
+
+# Every bit of the instruction that doesn't depend on the operands (opcode, funct3, funct7), so
+# encoding only has to OR in the registers and immediates.
+BASE_WORDS = {
+    i: OP_CODE_VALUES[i]
+    | (FUNCT3_VALUES.get(i, 0) << 12)
+    | (FUNCT7_VALUES.get(i, 0) << 25)
+    for i in INSTRUCTION_FORMATS
+}
+
+# BitArray versions of the above, only available if bitstring is installed.
+OP_CODES = {}
+FUNCT3_CODES = {}
+if BitArray is not None:
+    OP_CODES = {k: BitArray(uint=v, length=7) for k, v in OP_CODE_VALUES.items()}
+    FUNCT3_CODES = {k: BitArray(uint=v, length=3) for k, v in FUNCT3_VALUES.items()}
+
+BITS_TO_OP_CODE = {v.bin: k for k, v in OP_CODES.items()}
 
 RTYPE_FUNCT3_MAPPING = {
     "001": "sll",
@@ -147,3 +183,8 @@ BTYPE_FUNCT3_MAPPING = {
     "110": "bltu",
     "111": "bgeu",
 }
+
+# Data memory, see hdl/memmap.sv: the bank is picked by the top 4 bits of the address
+# (MMU_BANK_DATA), and it's DATA_L_WORDS long.
+DATA_BASE_ADDRESS = 0x30000000
+DATA_WORDS = 1024
@@ -0,0 +1,323 @@
+"""
+Static cycle-count estimates for rv32i_multicycle_core, so you can pick MAX_CYCLES (and notice when
+a change makes a program slower) without running a simulation.
+
+Every instruction goes through S_FETCH, S_DECODE and S_EXECUTE, then some take one more state (see
+the state machine in hdl/rv32i_multicycle_core.sv):
+
+    add, addi, lui, jal, jalr, ...  3 cycles
+    lw, sw                          4 cycles (S_LOAD/S_STORE)
+    beq, bne, ...                   3 cycles, 4 if taken (S_BRANCH_JUMP)
+    halt                            4 cycles (S_HALT, where the simulation ends)
+
+Using the control-flow graph, every block of a function is counted once per call, times the
+iterations of each loop it's in, and calls add the whole cost of the function they call. Both sides
+of an `if` are counted, so this is an upper bound for code without loops. Loop iterations come from
+an annotation on any instruction in the loop's first or last block:
+
+    loop:
+        addi t0, t0, 1
+        bne t0, a0, loop  # iterations: 100
+
+or for simple counted loops (ex. `li t0, 0` / `li t1, 10` before the loop, `addi t0, t0, 1` and
+`blt t0, t1, loop` in it), from the instructions themselves. Otherwise DEFAULT_ITERATIONS is assumed.
+Recursive calls can't be bounded, so they're left out (and the function is marked recursive).
+"""
+
+from __future__ import annotations
+from typing import *
+
+import os
+import re
+
+from cfg import ControlFlowGraph
+from constants import BTYPES, INSTRUCTION_FORMATS
+from helpers import LineException
+from optimize import constant, destination
+import rv32i
+
+# Every instruction takes S_FETCH, S_DECODE and S_EXECUTE
+BASE_CYCLES = 3
+# States some instructions take after S_EXECUTE, by format
+EXTRA_CYCLES = {"L": 1, "S": 1, "halt": 1}  # S_LOAD, S_STORE, S_HALT
+# S_BRANCH_JUMP, only for branches that are taken
+TAKEN_BRANCH_CYCLES = 1
+
+DEFAULT_ITERATIONS = 10
+# Give up on working out a loop's iterations past this many
+MAX_INFERRED_ITERATIONS = 1_000_000
+
+ITERATIONS_REGEX = re.compile(r"#.*\biterations\s*[:=]\s*(\d+)")
+
+BRANCH_CONDITIONS = {
+    "beq": lambda a, b: a == b,
+    "bne": lambda a, b: a != b,
+    "blt": lambda a, b: rv32i.sign_extend(a, 32) < rv32i.sign_extend(b, 32),
+    "bge": lambda a, b: rv32i.sign_extend(a, 32) >= rv32i.sign_extend(b, 32),
+    "bltu": lambda a, b: a < b,
+    "bgeu": lambda a, b: a >= b,
+}
+
+
+def instruction_cycles(instruction: str) -> int:
+    """ Cycles an instruction takes (not counting a taken branch). """
+    fmt = "halt" if instruction == "halt" else INSTRUCTION_FORMATS.get(instruction)
+    return BASE_CYCLES + EXTRA_CYCLES.get(fmt, 0)
+
+
+class Loop(NamedTuple):
+    header: int  # block
+    back_edges: List[int]  # the blocks that jump back to the header
+    body: FrozenSet[int]
+
+
+class CycleEstimator:
+    def __init__(self, graph: ControlFlowGraph):
+        self.graph = graph
+        self.blocks = graph.blocks
+        self.lines = graph.parsed_lines
+        self.block_cycles = [
+            sum(instruction_cycles(self.lines[i].instruction) for i in block.lines)
+            for block in self.blocks
+        ]
+        self.functions: Dict[int, Dict[str, Any]] = {}
+        self.loops: List[Dict[str, Any]] = []
+        self.in_progress: Set[int] = set()
+
+    def name(self, index: int) -> str:
+        block = self.blocks[index]
+        return block.labels[0] if block.labels else hex(self.graph.address(block.start))
+
+    def successors(self, index: int) -> List[int]:
+        """ Successors within a function: calls continue with the next block. """
+        block = self.blocks[index]
+        if block.call is None:
+            return block.successors
+        return [block.index + 1] if block.index + 1 < len(self.blocks) else []
+
+    def function_blocks(self, entry: int) -> Tuple[List[int], List[Tuple[int, int]]]:
+        """ The blocks of the function starting at entry (in DFS order) and its loops' back edges. """
+        order = []
+        back_edges = []
+        state = {entry: 1}  # 1 = exploring, 2 = done
+        stack = [(entry, iter(self.successors(entry)))]
+        order.append(entry)
+        while stack:
+            index, successors = stack[-1]
+            for successor in successors:
+                if state.get(successor) == 1:
+                    back_edges.append((index, successor))
+                elif successor not in state:
+                    state[successor] = 1
+                    order.append(successor)
+                    stack.append((successor, iter(self.successors(successor))))
+                    break
+            else:
+                state[index] = 2
+                stack.pop()
+        return order, back_edges
+
+    def natural_loop(self, sources: List[int], header: int, blocks: List[int]) -> Loop:
+        """ The header, plus every block that can get to sources without going through header. """
+        predecessors: Dict[int, List[int]] = {}
+        for index in blocks:
+            for successor in self.successors(index):
+                predecessors.setdefault(successor, []).append(index)
+        body = {header, *sources}
+        stack = [source for source in sources if source != header]
+        while stack:
+            for predecessor in predecessors.get(stack.pop(), []):
+                if predecessor not in body:
+                    body.add(predecessor)
+                    stack.append(predecessor)
+        return Loop(header, sources, frozenset(body))
+
+    def annotated_iterations(self, loop: Loop) -> Optional[int]:
+        """ Iterations from a `# iterations: N` comment. Raises LineException if N is 0. """
+        for index in [loop.header] + loop.back_edges:
+            for i in self.blocks[index].lines:
+                match = ITERATIONS_REGEX.search(self.lines[i].original)
+                if match:
+                    iterations = int(match.group(1))
+                    if iterations < 1:
+                        e = LineException("Loops run at least once, iterations must be 1 or more.")
+                        e.line = self.lines[i]
+                        raise e
+                    return iterations
+        return None
+
+    def known_values(self, index: int) -> Dict[Any, int]:
+        """ Registers holding constants at the end of a block (ex. after `li t0, 10`). """
+        known = {rv32i.ZERO: 0}
+        lines = self.lines
+        i = self.blocks[index].start
+        while i < self.blocks[index].end:
+            loaded = constant(lines, i, {})
+            if loaded is not None and i + loaded[2] <= self.blocks[index].end:
+                rd, value, length = loaded
+                known[rd] = value
+                i += length
+                continue
+            rd = destination(lines[i])
+            if rd is not None and rd != rv32i.ZERO:
+                known.pop(rd, None)
+            i += 1
+        return known
+
+    def inferred_iterations(self, loop: Loop, blocks: List[int]) -> Optional[int]:
+        """
+        Iterations of a counted loop: entered at the top from a block that sets up the counter and
+        the limit, which ends in a branch back to the top comparing the counter (changed by one
+        addi in the loop) against the limit (not changed in the loop).
+        """
+        if len(loop.back_edges) != 1:
+            return None
+        last = self.lines[self.blocks[loop.back_edges[0]].end - 1]
+        if last.instruction not in BRANCH_CONDITIONS:
+            return None
+        if last.args[2] not in self.blocks[loop.header].labels:
+            return None  # branches out of the loop instead of back to the top
+        outside = [
+            index for index in blocks
+            if index not in loop.body and loop.header in self.successors(index)
+        ]
+        if len(outside) != 1:
+            return None
+        known = self.known_values(outside[0])
+
+        updates: Dict[Any, List[Any]] = {}
+        for index in loop.body:
+            if self.blocks[index].call is not None:
+                return None  # the function could change anything
+            for i in self.blocks[index].lines:
+                rd = destination(self.lines[i])
+                if rd is not None and rd != rv32i.ZERO:
+                    updates.setdefault(rd, []).append(self.lines[i])
+
+        rs1, rs2, _ = last.args
+        for counter, limit, swapped in ((rs1, rs2, False), (rs2, rs1, True)):
+            if counter not in known or limit not in known or limit in updates:
+                continue
+            changes = updates.get(counter, [])
+            if len(changes) != 1:
+                continue
+            (change,) = changes
+            if change.instruction != "addi" or change.args[1] != counter:
+                continue
+            step = change.args[2]
+            if not isinstance(step, int) or step == 0:
+                continue
+
+            condition = BRANCH_CONDITIONS[last.instruction]
+            value, bound = known[counter], known[limit]
+            for iterations in range(1, MAX_INFERRED_ITERATIONS + 1):
+                value = (value + step) & 0xFFFFFFFF
+                a, b = (bound, value) if swapped else (value, bound)
+                if not condition(a, b):
+                    return iterations
+            return None
+        return None
+
+    def function(self, entry: int) -> Dict[str, Any]:
+        """ Estimate for one call of the function starting at block entry (including its calls). """
+        if entry in self.functions:
+            return self.functions[entry]
+        self.in_progress.add(entry)
+
+        blocks, back_edges = self.function_blocks(entry)
+        multiplier = {index: 1 for index in blocks}
+        loops = []
+        sources: Dict[int, List[int]] = {}
+        for source, header in back_edges:
+            sources.setdefault(header, []).append(source)
+        for header, loop_sources in sources.items():
+            loop = self.natural_loop(loop_sources, header, blocks)
+            iterations = self.annotated_iterations(loop)
+            source_kind = "annotation"
+            if iterations is None:
+                iterations = self.inferred_iterations(loop, blocks)
+                source_kind = "inferred"
+            if iterations is None:
+                iterations, source_kind = DEFAULT_ITERATIONS, "assumed"
+            loops.append((loop, iterations, source_kind))
+            for index in loop.body:
+                multiplier[index] *= iterations
+
+        cycles = sum(self.block_cycles[index] * multiplier[index] for index in blocks)
+        self_cycles = cycles
+        calls: Dict[str, int] = {}
+        recursive = False
+        for index in blocks:
+            callee = self.blocks[index].call
+            if callee is None:
+                continue
+            name = self.name(callee)
+            calls[name] = calls.get(name, 0) + multiplier[index]
+            if callee in self.in_progress:
+                recursive = True
+                continue
+            cycles += self.function(callee)["cycles"] * multiplier[index]
+
+        for loop, iterations, source_kind in loops:
+            # Branching back to the top is a taken branch, every time but the last
+            entries = max(multiplier[loop.header] // iterations, 1)
+            loop_cycles = sum(self.block_cycles[index] * multiplier[index] for index in loop.body)
+            if any(
+                self.lines[self.blocks[source].end - 1].instruction in BTYPES
+                for source in loop.back_edges
+            ):
+                extra = entries * (iterations - 1) * TAKEN_BRANCH_CYCLES
+                cycles += extra
+                self_cycles += extra
+                loop_cycles += extra
+            loop_cycles //= entries
+            self.loops.append({
+                "function": self.name(entry),
+                "header": self.name(loop.header),
+                "address": self.graph.address(self.blocks[loop.header].start),
+                "iterations": iterations,
+                "iterations_from": source_kind,
+                "cycles": loop_cycles,
+            })
+
+        self.in_progress.discard(entry)
+        result = {
+            "name": self.name(entry),
+            "address": self.graph.address(self.blocks[entry].start),
+            "cycles": cycles,
+            "self_cycles": self_cycles,
+            "calls": calls,
+            "recursive": recursive,
+        }
+        self.functions[entry] = result
+        return result
+
+    def estimate(self) -> Dict[str, Any]:
+        if not self.blocks:
+            return {"total": 0, "functions": [], "loops": []}
+        total = self.function(0)["cycles"]
+        for index in sorted({block.call for block in self.blocks if block.call is not None}):
+            self.function(index)
+        return {
+            "total": total,
+            # Leave some room, the estimate isn't exact
+            "suggested_max_cycles": max(100, 2 * total),
+            "cycle_costs": {
+                "base": BASE_CYCLES,
+                "extra": EXTRA_CYCLES,
+                "taken_branch": TAKEN_BRANCH_CYCLES,
+            },
+            "functions": sorted(self.functions.values(), key=lambda f: f["address"]),
+            "loops": sorted(self.loops, key=lambda loop: loop["address"]),
+        }
+
+
+def estimate_cycles(graph: ControlFlowGraph) -> Dict[str, Any]:
+    """ Raises LineException (with `e.line` set) on bad `# iterations:` annotations. """
+    return CycleEstimator(graph).estimate()
+
+
+def cycles_path(output: str) -> str:
+    """ Where the estimate for an output file goes: foo.memh -> foo.cycles.json """
+    root, _ = os.path.splitext(output)
+    return root + ".cycles.json"
@@ -0,0 +1,215 @@
+"""
+Initialized data: the .data/.rodata sections, and the directives that fill them in.
+
+    .section .rodata
+    .align 2
+    squares:
+        .word 0, 1, 4, 9, 16
+    greeting:
+        .asciz "Hello!"
+
+Everything in a data section is laid out in order in data memory, starting at DATA_BASE_ADDRESS
+(the data bank in hdl/memmap.sv), and labels there get data memory addresses. The result is written
+to a separate memh file for the data RAM. There's no separate ROM, so .rodata is just more data.
+"""
+
+from __future__ import annotations
+from typing import *
+
+import os
+
+from constants import DATA_BASE_ADDRESS, DATA_WORDS
+from helpers import LineException, UndefinedSymbolException
+
+
+def section_kind(name: str) -> Optional[str]:
+    """ "text" or "data" for a section name, or None for sections we don't load (ex. .comment). """
+    if name.startswith(".text"):
+        return "text"
+    for prefix in (".data", ".rodata", ".sdata", ".srodata", ".bss", ".sbss"):
+        if name.startswith(prefix):
+            return "data"
+    return None
+
+
+# Directives that switch sections, and the section they switch to
+SECTION_DIRECTIVES = {
+    ".text": ".text",
+    ".data": ".data",
+    ".rodata": ".rodata",
+    ".bss": ".bss",
+}
+
+
+def section_name(directive, args) -> Optional[str]:
+    """ The section a directive switches to, or None if it isn't a section directive. """
+    if directive in SECTION_DIRECTIVES:
+        return SECTION_DIRECTIVES[directive]
+    if directive == ".section":
+        if not args or not isinstance(args[0], str):
+            raise LineException(".section needs a section name.")
+        return args[0]
+    return None
+
+
+class DataSegment:
+    def __init__(self, base=DATA_BASE_ADDRESS, words=DATA_WORDS):
+        self.base = base
+        self.size = 4 * words
+        self.contents = bytearray()
+        self.fixups: List[Tuple[int, int, str, Any]] = []  # (offset, size, label, line)
+
+    @property
+    def address(self) -> int:
+        """ The address the next byte will go at. """
+        return self.base + len(self.contents)
+
+    def align(self, alignment: int):
+        if alignment <= 0 or alignment & (alignment - 1):
+            raise LineException(f"Alignment must be a power of two, not {alignment}.")
+        self.contents += bytes(-len(self.contents) % alignment)
+
+    def emit(self, value, size: int, line=None):
+        """ Append a size byte little-endian value. Labels are filled in by resolve(). """
+        if isinstance(value, str):
+            self.fixups.append((len(self.contents), size, value, line))
+            value = 0
+        elif not isinstance(value, int):
+            raise LineException(f"Expected a number or label, not '{value}'.")
+        if not -(1 << (8 * size - 1)) <= value < (1 << (8 * size)):
+            raise LineException(f"Value {value} does not fit into {size} bytes.")
+        self.contents += (value & ((1 << (8 * size)) - 1)).to_bytes(size, "little")
+
+    def resolve(self, labels):
+        """
+        Fill in references to labels (ex. `.word main`). Raises UndefinedSymbolException (with the
+        offending line as e.line) if a label doesn't exist.
+        """
+        for offset, size, label, line in self.fixups:
+            if label not in labels:
+                e = UndefinedSymbolException(label)
+                e.line = line
+                raise e
+            value = int(labels[label]) & ((1 << (8 * size)) - 1)
+            self.contents[offset:offset + size] = value.to_bytes(size, "little")
+        self.fixups = []
+
+    def words(self) -> List[int]:
+        padded = self.contents + bytes(-len(self.contents) % 4)
+        return [
+            int.from_bytes(padded[i:i + 4], "little") for i in range(0, len(padded), 4)
+        ]
+
+    def check_size(self):
+        if len(self.contents) > self.size:
+            raise LineException(
+                f"Data takes {len(self.contents)} bytes, but data memory is only {self.size} bytes."
+            )
+
+    def write_mem(self, fn, hex_notbin=True, disable_annotations=False, labels=None):
+        """
+        Write the data memory image, padded with zeros to the size of data memory. Labels are
+        annotated next to the words they point to.
+        """
+        self.check_size()
+        names: Dict[int, List[str]] = {}
+        if labels and not disable_annotations:
+            for label, address in labels.items():
+                if self.base <= address < self.base + self.size:
+                    names.setdefault((address - self.base) // 4, []).append(label)
+
+        words = self.words()
+        words += [0] * (self.size // 4 - len(words))
+        with open(fn + ".tmp", "w") as f:
+            for i, word in enumerate(words):
+                line = f"{word:08x}" if hex_notbin else f"{word:032b}"
+                if hex_notbin and i in names:
+                    line += f" // {hex(self.base + 4 * i)}: {', '.join(names[i])}"
+                f.write(line + "\n")
+        os.replace(fn + ".tmp", fn)
+
+
+def directive_values(size):
+    def directive(segment, args, line):
+        for value in args:
+            segment.emit(value, size, line)
+
+    return directive
+
+
+def directive_zero(segment, args, line):
+    if len(args) not in (1, 2) or not all(isinstance(a, int) for a in args):
+        raise LineException("Expected a size (and optionally a fill byte).")
+    count, fill = (args + [0])[:2]
+    segment.contents += bytes([fill & 0xFF]) * count
+
+
+def directive_string(null_terminated):
+    def directive(segment, args, line):
+        for value in args:
+            segment.contents += value + (b"\0" if null_terminated else b"")
+
+    return directive
+
+
+# In RISC-V, .align is a power of two (like .p2align), while .balign is in bytes
+ALIGN_DIRECTIVES = {".align", ".p2align", ".balign"}
+
+
+def alignment(directive, args) -> int:
+    """ How many bytes an alignment directive aligns to. """
+    if len(args) < 1 or not isinstance(args[0], int):
+        raise LineException("Expected an alignment.")
+    if directive == ".balign":
+        size = args[0]
+    else:
+        size = 1 << args[0] if args[0] >= 0 else 0
+    if size <= 0 or size & (size - 1):
+        raise LineException(f"Alignment must be a power of two, not {size}.")
+    return size
+
+
+def directive_align(segment, args, line):
+    segment.align(alignment(line.instruction, args))
+
+
+DATA_DIRECTIVES = {
+    ".byte": directive_values(1),
+    ".half": directive_values(2),
+    ".short": directive_values(2),
+    ".2byte": directive_values(2),
+    ".word": directive_values(4),
+    ".long": directive_values(4),
+    ".4byte": directive_values(4),
+    ".zero": directive_zero,
+    ".space": directive_zero,
+    ".ascii": directive_string(null_terminated=False),
+    ".asciz": directive_string(null_terminated=True),
+    ".string": directive_string(null_terminated=True),
+    ".align": directive_align,
+    ".p2align": directive_align,
+    ".balign": directive_align,
+}
+
+
+# Uninitialized globals that don't belong to any section (GCC emits these for `int counter;`)
+COMMON_DIRECTIVES = {".comm", ".lcomm"}
+
+
+def directive_common(segment, args) -> Tuple[str, int]:
+    """ `.comm symbol, size[, alignment]`: reserve zeroed space. Returns (symbol, address). """
+    if len(args) not in (2, 3) or not isinstance(args[0], str):
+        raise LineException("Expected a symbol, a size, and optionally an alignment.")
+    symbol, size, align = (args + [4])[:3]
+    if not isinstance(size, int) or not isinstance(align, int):
+        raise LineException("Expected a size and alignment in bytes.")
+    segment.align(align)
+    address = segment.address
+    segment.contents += bytes(size)
+    return symbol, address
+
+
+def data_path(output: str) -> str:
+    """ Where the data memory image for an output file goes: foo.memh -> foo.data.memh """
+    root, ext = os.path.splitext(output)
+    return root + ".data" + ext
@@ -1,10 +1,60 @@
+import logging
+import sys
+
 try:
     from bitstring import BitArray
-except:
-    raise Exception(
-        "Missing a library, try `sudo apt install python3-bitstring`"
-    )
+except ImportError:
+    # bitstring is only needed for the BitArray compatibility layer (line_to_bits and friends),
+    # the assembler itself works on plain integers.
+    BitArray = None
+
+
+def require_bitstring():
+    if BitArray is None:
+        raise Exception(
+            "Missing a library, try `sudo apt install python3-bitstring`"
+        )
 
 
 class LineException(Exception):
     pass
+
+
+class UndefinedSymbolException(LineException):
+    """ An instruction refers to a label (or other symbol) that isn't in the label table. """
+
+    def __init__(self, symbol):
+        super().__init__(f"label '{symbol}' was not in the stored table.")
+        self.symbol = symbol
+
+
+# Diagnostics go through this logger, so they cost (almost) nothing unless they're turned on with -v
+log = logging.getLogger("assembler")
+
+
+class StdoutHandler(logging.StreamHandler):
+    """
+    Writes to whatever sys.stdout currently is, so redirect_stdout (used by the server and for
+    parallel builds) captures log messages too.
+    """
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def configure_logging(verbose=False):
+    """ Show info messages (and debug messages too, if verbose) on stdout. """
+    if not log.handlers:
+        handler = StdoutHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(logging.DEBUG if verbose else logging.INFO)
@@ -0,0 +1,190 @@
+"""
+Splits lines of assembly into a label, a mnemonic, and operands, in a single pass per line.
+
+Operands come out already classified, so nothing downstream has to re-parse strings:
+    - registers are Register objects (`a0`, `x10`)
+    - `imm(reg)` memory operands are Memory tuples (`-4(sp)`)
+    - number literals are ints (`0xFF`, `0b1010`, `0100`, `-12`)
+    - anything else (labels, directive arguments) is left as a string
+"""
+
+from __future__ import annotations
+from typing import *
+
+import codecs
+import re
+import sys
+from functools import lru_cache
+
+from constants import REGISTER_NAMES, REGISTER_TO_INTEGER
+from helpers import LineException
+
+
+class Register:
+    """ A register operand. Compares equal to any other name for the same register. """
+
+    __slots__ = ("number", "name")
+
+    def __init__(self, number: int, name: str):
+        self.number = number
+        self.name = name
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Register) and other.number == self.number
+
+    def __hash__(self) -> int:
+        return hash(self.number)
+
+    def __str__(self) -> str:
+        return self.name
+
+    __repr__ = __str__
+
+
+# Every valid register name, looked up once
+REGISTERS: Dict[str, Register] = {
+    name: Register(number, name) for name, number in REGISTER_TO_INTEGER.items()
+}
+
+
+def register(name_or_number: Union[str, int]) -> Register:
+    """ Look up a register by name or number (numbers get their ABI name). """
+    if isinstance(name_or_number, int):
+        return REGISTERS[REGISTER_NAMES[name_or_number][-1]]
+    return REGISTERS[name_or_number]
+
+
+class Relocation(NamedTuple):
+    """
+    An immediate that depends on where a symbol ends up, ex. `%hi(table)`, or the two halves of a
+    PC-relative offset. For PC-relative kinds, pc_offset is where the offset is measured from,
+    relative to the instruction itself (the jalr in an auipc/jalr pair measures from the auipc just
+    before it, so it has -4).
+    """
+
+    kind: str
+    symbol: str
+    pc_offset: int = 0
+    addend: int = 0
+
+    def __str__(self) -> str:
+        if self.addend:
+            return f"%{self.kind}({self.symbol}{self.addend:+d})"
+        return f"%{self.kind}({self.symbol})"
+
+
+class Memory(NamedTuple):
+    """ An `offset(base)` memory operand, as used by loads and stores. """
+
+    offset: Union[int, Relocation]
+    base: Register
+
+    def __str__(self) -> str:
+        return f"{self.offset}({self.base})"
+
+
+# Strings (ex. for .ascii) come out as bytes
+Operand = Union[Register, Memory, Relocation, int, bytes, str]
+
+LINE_REGEX = re.compile(
+    r"""
+    ^\s*
+    (?:(?P<label>[\w().]+):)?   # label:
+    \s*
+    (?P<mnemonic>[\w.]+)?       # instruction or directive
+    \s*
+    (?P<operands>[^#]*?)        # operands, separated by commas
+    \s*(?:\#.*)?$               # comment
+    """,
+    re.VERBOSE,
+)
+
+NUMBER_PATTERN = r"[-+]?(?:0[xX][0-9a-fA-F]+|0[bB][01]+|\d+)"
+NUMBER_REGEX = re.compile(NUMBER_PATTERN)
+RELOCATION_PATTERN = r"%\w+\(\s*[\w.$]+\s*(?:[-+]\s*\d+\s*)?\)"
+RELOCATION_REGEX = re.compile(
+    r"%(?P<kind>\w+)\(\s*(?P<symbol>[\w.$]+)\s*(?:(?P<addend>[-+]\s*\d+)\s*)?\)"
+)
+MEMORY_REGEX = re.compile(
+    rf"(?P<offset>{NUMBER_PATTERN}|{RELOCATION_PATTERN})?\s*\(\s*(?P<base>\w+)\s*\)"
+)
+STRING_REGEX = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+# Directives whose operands are string literals, which can contain commas and #s
+STRING_DIRECTIVES = {".ascii", ".asciz", ".string"}
+
+
+def parse_number(text: str) -> int:
+    """
+    Parse a number literal: 0x for hex, 0b for binary, a leading 0 for octal, otherwise decimal.
+    """
+    sign = 1
+    if text[0] in "+-":
+        sign = -1 if text[0] == "-" else 1
+        text = text[1:]
+    lower = text.lower()
+    try:
+        if lower.startswith("0x"):
+            return sign * int(lower[2:], 16)
+        if lower.startswith("0b"):
+            return sign * int(lower[2:], 2)
+        if lower.startswith("0") and len(lower) > 1:
+            return sign * int(lower, 8)
+        return sign * int(lower)
+    except ValueError:
+        raise LineException(f"Invalid number literal '{text}'.")
+
+
+@lru_cache(maxsize=4096)
+def parse_operand(text: str) -> Operand:
+    """ Classify a single operand. Results are cached, since the same operands come up a lot. """
+    if text in REGISTERS:
+        return REGISTERS[text]
+    if NUMBER_REGEX.fullmatch(text):
+        return parse_number(text)
+    match = RELOCATION_REGEX.fullmatch(text)
+    if match:
+        addend = match.group("addend")
+        return Relocation(
+            match.group("kind"),
+            sys.intern(match.group("symbol")),
+            addend=int(addend.replace(" ", "")) if addend else 0,
+        )
+    match = MEMORY_REGEX.fullmatch(text)
+    if match and match.group("base") in REGISTERS:
+        offset = match.group("offset")
+        return Memory(parse_operand(offset) if offset else 0, REGISTERS[match.group("base")])
+    return sys.intern(text)  # A label, which probably comes up elsewhere too
+
+
+def parse_string(text: str) -> bytes:
+    """ Decode the inside of a string literal, handling C-style escapes (\\n, \\0, \\x41, ...). """
+    return codecs.escape_decode(text.encode())[0]
+
+
+def tokenize_line(line: str) -> Optional[Tuple[Optional[str], str, List[Operand]]]:
+    """
+    Returns (label, mnemonic, operands) for a line, or None for blank lines and comments. Lines with
+    only a label have an empty mnemonic.
+    """
+    match = LINE_REGEX.match(line)
+    if not match:
+        return None
+    label, mnemonic, operands = match.groups()
+    # Every line has its own copy of these otherwise
+    if label is not None:
+        label = sys.intern(label)
+    if mnemonic:
+        mnemonic = sys.intern(mnemonic)
+    if not mnemonic:
+        if label is None:
+            return None
+        return label, "", []
+    if mnemonic in STRING_DIRECTIVES:
+        rest = line[match.end("mnemonic"):]
+        return label, mnemonic, [parse_string(s) for s in STRING_REGEX.findall(rest)]
+    return (
+        label,
+        mnemonic,
+        [parse_operand(op.strip()) for op in operands.split(",") if op.strip()],
+    )
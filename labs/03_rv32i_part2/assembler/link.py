@@ -0,0 +1,210 @@
+"""
+Object files and linking, so shared code (like asm/_preamble.s) is only assembled once.
+
+Assembling to a `.rvo` file (`-o foo.rvo`) encodes everything that doesn't depend on where the code
+ends up, and writes it out as JSON along with:
+    - the symbol table: every label, as an offset into this file's code or data
+    - fixups: instructions that need to be encoded again once every symbol has its final address
+      (calls and branches to labels in other files, and `%hi`/`%lo`/`la`, which are absolute)
+    - the data segment, and the `.word label`s in it
+
+`--link a.rvo b.rvo -o prog.memh` lays out each file's code one after the other (so the first file
+is where execution starts) followed by a halt, does the same for their data, encodes the fixups, and
+writes the .memh, the data image and the sourcemap just like assembling would. Labels starting with
+`.L` (GCC's local labels) are private to their file, every other label is visible to all of them.
+"""
+
+from __future__ import annotations
+from typing import *
+
+import json
+import os
+
+from constants import BTYPES, DATA_BASE_ADDRESS, JTYPES
+from data import DataSegment
+from helpers import LineException
+from lexer import Memory, Relocation, register
+import rv32i
+
+OBJECT_VERSION = 1
+
+
+class SourceLine(NamedTuple):
+    """ Where an instruction came from, for annotations and the sourcemap. """
+
+    line_number: int
+    original: str
+
+    @property
+    def original_bytes(self) -> bytes:
+        return self.original.encode()
+
+
+class LinkedProgram(NamedTuple):
+    words: List[int]
+    lines: List[SourceLine]
+    labels: Dict[str, int]
+    data: DataSegment
+
+
+def is_object_file(fn: str) -> bool:
+    return fn.endswith(".rvo")
+
+
+def is_local(label: str) -> bool:
+    return label.startswith(".L")
+
+
+def encode_operand(operand) -> Any:
+    """ An operand as JSON. Strings (labels) and ints are left as is. """
+    if isinstance(operand, Memory):
+        return {"memory": [encode_operand(operand.offset), operand.base.name]}
+    if isinstance(operand, Relocation):
+        return {"relocation": list(operand)}
+    if isinstance(operand, (str, int)):
+        return operand
+    if rv32i.is_register(operand):
+        return {"register": str(operand)}
+    raise LineException(f"Can't put operand '{operand}' in an object file.")
+
+
+def decode_operand(value) -> Any:
+    if not isinstance(value, dict):
+        return value
+    if "register" in value:
+        return register(value["register"])
+    if "relocation" in value:
+        return Relocation(*value["relocation"])
+    offset, base = value["memory"]
+    return Memory(decode_operand(offset), register(base))
+
+
+def needs_fixup(parsed, local_labels: Container[str]) -> bool:
+    """
+    Does an instruction have to wait for the linker? Branches and jumps to labels in the same file
+    don't, since they're relative. Relocations (`%hi(x)`, etc.) always do.
+    """
+    for arg in parsed.args:
+        if isinstance(arg, Memory):
+            arg = arg.offset
+        if isinstance(arg, Relocation):
+            return True
+    if parsed.instruction in BTYPES or parsed.instruction in JTYPES:
+        target = parsed.args[-1] if parsed.args else None
+        return isinstance(target, str) and target not in local_labels
+    return False
+
+
+def make_object(source, words, parsed_lines, fixups, labels, data: DataSegment, start_address=0):
+    """
+    Build an object file (as a dict, ready for JSON). words is the encoded instruction for each of
+    parsed_lines (anything for the lines in fixups, which are indices into parsed_lines).
+    """
+    symbols = {}
+    for label, address in labels.items():
+        if data.base <= address < data.base + data.size:
+            symbols[label] = ["data", address - data.base]
+        else:
+            symbols[label] = ["text", address - start_address]
+    return {
+        "version": OBJECT_VERSION,
+        "source": source,
+        "words": [int(word) for word in words],
+        "lines": [[parsed.line_number, parsed.original] for parsed in parsed_lines],
+        "fixups": [
+            {
+                "index": i,
+                "instruction": parsed_lines[i].instruction,
+                "args": [encode_operand(arg) for arg in parsed_lines[i].args],
+            }
+            for i in fixups
+        ],
+        "symbols": symbols,
+        "data": data.contents.hex(),
+        "data_fixups": [[offset, size, label] for offset, size, label, _ in data.fixups],
+    }
+
+
+def write_object(obj: Dict[str, Any], fn: str):
+    with open(fn + ".tmp", "w") as f:
+        json.dump(obj, f)
+        f.write("\n")
+    os.replace(fn + ".tmp", fn)
+
+
+def read_object(fn: str) -> Dict[str, Any]:
+    with open(fn, "r") as f:
+        try:
+            obj = json.load(f)
+        except ValueError:
+            object_fn = os.path.splitext(fn)[0] + ".rvo"
+            raise LineException(f"{fn} is not an object file (assemble it with -o {object_fn}).")
+    if not isinstance(obj, dict) or obj.get("version") != OBJECT_VERSION:
+        raise LineException(f"{fn} is not an object file from this version of the assembler.")
+    obj.setdefault("source", fn)
+    return obj
+
+
+def link(objects: List[Dict[str, Any]], start_address=0) -> LinkedProgram:
+    """
+    Lay out objects one after another, resolve their symbols, and encode every fixup. Raises
+    LineException (with `e.source` and `e.line` set when it's about a particular line) on undefined
+    or duplicate symbols, and on fixups that can't be encoded.
+    """
+    data = DataSegment(DATA_BASE_ADDRESS)
+    global_labels: Dict[str, int] = {}
+    all_labels: Dict[str, int] = {}
+    placements = []  # (text address, data offset, local labels) for each object
+    address = start_address
+    for obj in objects:
+        data.align(4)
+        data_offset = len(data.contents)
+        local_labels = {}
+        for label, (section, offset) in obj["symbols"].items():
+            value = address + offset if section == "text" else data.base + data_offset + offset
+            if is_local(label):
+                local_labels[label] = value
+                continue
+            if label in global_labels:
+                raise LineException(f"'{label}' is defined in more than one file ({obj['source']}).")
+            global_labels[label] = value
+        placements.append((address, data_offset, local_labels))
+        data.contents += bytes.fromhex(obj["data"])
+        address += 4 * len(obj["words"])
+
+    words = []
+    lines = []
+    for obj, (base, data_offset, local_labels) in zip(objects, placements):
+        labels = {**global_labels, **local_labels}
+        object_words = list(obj["words"])
+        for fixup in obj["fixups"]:
+            i = fixup["index"]
+            try:
+                object_words[i] = rv32i.encode_instruction(
+                    fixup["instruction"],
+                    [decode_operand(arg) for arg in fixup["args"]],
+                    labels,
+                    base + 4 * i,
+                )
+            except LineException as e:
+                e.source = obj["source"]
+                e.line = SourceLine(*obj["lines"][i])
+                raise e
+        for offset, size, label in obj["data_fixups"]:
+            if label not in labels:
+                e = LineException(f"label '{label}' (in .data) was not in the stored table.")
+                e.source = obj["source"]
+                raise e
+            value = int(labels[label]) & ((1 << (8 * size)) - 1)
+            start = data_offset + offset
+            data.contents[start:start + size] = value.to_bytes(size, "little")
+        words += object_words
+        lines += [SourceLine(*line) for line in obj["lines"]]
+        for label, value in local_labels.items():
+            all_labels.setdefault(label, value)
+
+    # Halt at the end, like when assembling a single file
+    words.append(0)
+    lines.append(SourceLine(-1, ""))
+    all_labels.update(global_labels)
+    return LinkedProgram(words, lines, all_labels, data)
@@ -8,23 +8,129 @@ from __future__ import annotations
 from typing import *
 
 import argparse
+import glob
+import io
+import logging
+import mmap
 import os
 import os.path as path
-import re
 import sys
-from dataclasses import dataclass, replace, field
+import time
+import traceback
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, redirect_stdout
+from itertools import chain
 
+import batch
+import cfg
+import cycles
+import data
+import lexer
+import link
+import optimize
+import relax
+from cache import DEFAULT_CACHE_DIR, BuildCache, cache_key
 import rv32i
-from helpers import BitArray
+from helpers import configure_logging, log
+from lexer import Operand
+from stats import Stats, write_stats
+from symbols import SOURCEMAP_PATH, LabelIndex
+
+
+class SourceFile:
+    """
+    An input file, mapped into memory. ParsedLines read their line back out of here when they need
+    it, instead of each keeping a copy. All that's kept per line is its offset, in a compact array.
+    Close it (or use it in a with block) once nothing needs the lines anymore.
+    """
+
+    def __init__(self, fn: str):
+        self.name = fn
+        self.offsets = array("L")
+        with open(fn, "rb") as f:
+            try:
+                self.contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self.contents = b""  # Empty files can't be mapped
+
+    def lines(self) -> Iterator[str]:
+        contents = self.contents
+        offset = 0
+        while offset < len(contents):
+            end = contents.find(b"\n", offset)
+            if end < 0:
+                end = len(contents)
+            self.offsets.append(offset)
+            yield contents[offset:end].decode()
+            offset = end + 1
+
+    def line(self, line_number: int) -> str:
+        return self.line_bytes(line_number).decode()
+
+    def line_bytes(self, line_number: int) -> bytes:
+        """ A line as it is in the file, for writing it back out without decoding it. """
+        offset = self.offsets[line_number - 1]
+        end = self.contents.find(b"\n", offset)
+        if end < 0:
+            end = len(self.contents)
+        return self.contents[offset:end].strip()
+
+    def close(self):
+        if isinstance(self.contents, mmap.mmap):
+            self.contents.close()
+
+    def __enter__(self) -> SourceFile:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
-@dataclass
 class ParsedLine:
-    original: str
-    line_number: int
-    instruction: str
-    args: List[str] = field(default_factory=list)
-    label: Optional[str] = field(default=None)
+    """
+    One line of assembly, or one instruction once pseudo-instructions are expanded. There's one of
+    these for every instruction in the program, so they're kept small: no __dict__, mnemonics and
+    registers are shared (see lexer.py), and the original text is only read back out of the input
+    file when something asks for it.
+    """
+
+    __slots__ = ("line_number", "instruction", "args", "label", "source")
+
+    def __init__(
+        self,
+        original: str = "",
+        line_number: int = 0,
+        instruction: str = "",
+        args: Optional[List[Operand]] = None,
+        label: Optional[str] = None,
+        source: Optional[SourceFile] = None,
+    ):
+        self.line_number = line_number
+        self.instruction = instruction
+        self.args = [] if args is None else args
+        self.label = label
+        # The SourceFile the line is in, or just its text if it didn't come from one
+        self.source = original if source is None else source
+
+    @property
+    def original(self) -> str:
+        if isinstance(self.source, SourceFile):
+            return self.source.line(self.line_number)
+        return self.source
+
+    @property
+    def original_bytes(self) -> bytes:
+        if isinstance(self.source, SourceFile):
+            return self.source.line_bytes(self.line_number)
+        return self.source.encode()
+
+    def replace(self, **changes) -> ParsedLine:
+        """ A copy with some fields changed, like dataclasses.replace(). """
+        copy = ParsedLine.__new__(ParsedLine)
+        for name in self.__slots__:
+            setattr(copy, name, changes[name] if name in changes else getattr(self, name))
+        return copy
 
     @property
     def is_directive(self) -> bool:
@@ -41,164 +147,474 @@ class ParsedLine:
         if self.label:
             output += f"{self.label}: "
         output += f"{self.instruction} "
-        output += ', '.join(self.args)
+        output += ', '.join(str(a) for a in self.args)
 
         return f"`{output}`"
 
 
-COMMENTS_REGEX = r"\s*#.*"
-LABEL_REGEX = r"^([\w\(\)_\.]+):\s*(.*)"
-INSTRUCTION_REGEX = r"^([\w\.]+)\s*(.*)"
-
-
 class AssemblyProgram:
     parsed_lines: List[ParsedLine]
+    label_index: Optional[LabelIndex]
 
-    def __init__(self, start_address=0, labels=None):
+    def __init__(self, start_address=0, labels=None, stats=None):
+        self.start_address = start_address
         self.address = start_address
-        self.line_number = 0
+        self.line_number = 0  # lines read, in every file
+        # The file being read, and the number of the line in it. Lines are numbered in each file,
+        # so errors, annotations and the sourcemap point at the right line of the preamble too.
+        self.source: Optional[SourceFile] = None
+        self.source_line_number = 0
         self.labels = {}
         if labels:
             for k in labels:
                 self.labels[k] = labels[k]
+        self.label_index = None
+        self.latest_label = "root"  # the label with the highest address seen so far
+        self.latest_label_address = -1
         self.parsed_lines = []
+        self.section = "text"  # "data" in .data/.rodata/etc., None in sections we ignore
+        self.data = data.DataSegment()
+        self.stats = stats or Stats()
+        # Where each alignment directive's padding ends, kept apart from the labels but moved along
+        # with them, so relaxation can redo the padding
+        self.align_labels: Dict[str, int] = {}
+        self.align_directives: Dict[str, ParsedLine] = {}
+
+    def tokenize(self, lines: Iterable[Union[str, Tuple[SourceFile, str]]]) -> Iterator[ParsedLine]:
+        """
+        Split lines into labels, instructions and arguments. Lines that only have a label come out
+        with an empty instruction, blank lines and comments are skipped. Lines can be plain strings,
+        or (SourceFile, text) from read_lines().
+        """
+        for line in lines:
+            source = None
+            if not isinstance(line, str):
+                source, line = line
+                if source is not self.source:
+                    self.source = source
+                    self.source_line_number = 0
+            self.line_number += 1
+            self.source_line_number += 1
+            line = line.strip()
+            try:
+                tokens = lexer.tokenize_line(line)
+            except rv32i.LineException as e:
+                e.line = ParsedLine(line, self.source_line_number, "", source=source)
+                raise e
+            if tokens is None:
+                continue
+            label, instruction, args = tokens
 
-    def parse_args(self, args_str) -> List[str]:
-        return [
-            x.strip()
-            for x in args_str.split(",")
-            if x.strip() != ''
-        ]
+            yield ParsedLine(
+                original=line,
+                label=label,
+                line_number=self.source_line_number,
+                instruction=instruction,
+                args=args,
+                source=source,
+            )
+
+    def expand(self, parsed_lines: Iterable[ParsedLine]) -> Iterator[ParsedLine]:
+        """
+        Give labels their addresses and expand pseudo-instructions, yielding one ParsedLine per
+        real instruction. Data directives go into self.data, other directives are dropped. Any
+        LineException raised has the offending line attached as `e.line`.
+        """
+        for parsed in parsed_lines:
+            try:
+                yield from self.expand_line(parsed)
+            except rv32i.LineException as e:
+                e.line = parsed
+                raise e
+
+    def expand_line(self, parsed: ParsedLine) -> List[ParsedLine]:
+        if parsed.label:
+            self.define_label(parsed.label)
+
+        if not parsed.instruction:
+            return []
+
+        if parsed.is_directive:
+            new_parsed_lines = self.directive(parsed)
+        else:
+            new_parsed_lines = [parsed]
+
+            # Handle psuedo-instructions.
+            if parsed.is_pseudo:
+                pseudo = parsed.instruction
+                self.stats.pseudo[pseudo] += 1
+                pseudo_result = \
+                    rv32i.PSEUDO_INSTRUCTIONS[parsed.instruction](*parsed.args)
+
+                # NOTE: pseudo_result can either be a tuple in the form ('inst', [arg1, arg2]) or a
+                # list of tuples like that. We need to handle both cases
+
+                # if just one returned instruction
+                if not isinstance(pseudo_result[0], tuple):
+                    parsed.instruction, parsed.args = pseudo_result
+                else:  # otherwise, handle multiple
+                    new_parsed_lines = [
+                        parsed.replace(instruction=instruction, args=args)
+                        for instruction, args in pseudo_result
+                    ]
+
+                if pseudo == "li" and parsed.instruction == "lui":
+                    self.stats.saved["li"] += 1  # a lone lui, instead of lui + addi zero
+
+        if new_parsed_lines and self.section == "data":
+            raise rv32i.LineException("Instructions must be in the .text section.")
+        self.address += 4 * len(new_parsed_lines)
+        return new_parsed_lines
+
+    def define_label(self, label: str):
+        if self.section == "data":
+            self.labels[label] = self.data.address
+            return
+        self.labels[label] = self.address
+        if self.address > self.latest_label_address:
+            self.latest_label = label
+            self.latest_label_address = self.address
+
+    def directive(self, parsed: ParsedLine) -> List[ParsedLine]:
+        """
+        Handle an assembler directive. Returns any instructions it adds (nops to align code).
+        """
+        if parsed.instruction in data.COMMON_DIRECTIVES:
+            symbol, address = data.directive_common(self.data, parsed.args)
+            self.labels[symbol] = address
+            return []
+        section = data.section_name(parsed.instruction, parsed.args)
+        if section is not None:
+            self.section = data.section_kind(section)
+            return []
+        if self.section == "data" and parsed.instruction in data.DATA_DIRECTIVES:
+            data.DATA_DIRECTIVES[parsed.instruction](self.data, parsed.args, parsed)
+            return []
+        if self.section == "text" and parsed.instruction in data.ALIGN_DIRECTIVES:
+            padding = -self.address % data.alignment(parsed.instruction, parsed.args)
+            marker = f".align {len(self.align_directives)}"
+            self.align_labels[marker] = self.address + padding // 4 * 4
+            self.align_directives[marker] = parsed
+            return [
+                parsed.replace(instruction="addi", args=[rv32i.ZERO, rv32i.ZERO, 0])
+                for _ in range(padding // 4)
+            ]
+        log.debug("Detected assembler directive: %s, ignoring... %s", parsed.instruction, parsed)
+        return []
 
     def parse_line(self, line):
-        self.line_number += 1
-        line = line.strip()
-        original_line = line
-        label = None
-
-        # Remove Comments
-        line = re.sub(COMMENTS_REGEX, "", line)
-
-        # Check for Label
-        label_match = re.search(LABEL_REGEX, line)
-        if label_match:
-            label, line = label_match.groups()
-            self.labels[label] = self.address
-
-        # Parse Instruction
-        instruction_match = re.search(INSTRUCTION_REGEX, line)
-        if not instruction_match:
+        for parsed in self.expand(self.tokenize([line])):
+            self.parsed_lines.append(parsed)
+        return 0
+
+    def finish_data(self) -> int:
+        """
+        Fill in label addresses in the data segment. Call this once label addresses are final.
+        Prints an error and returns -1 if that fails.
+        """
+        try:
+            self.data.resolve(self.labels)
+            self.data.check_size()
+        except rv32i.LineException as e:
+            if getattr(e, "line", None):
+                self.print_line_error(e.line, e)
+            else:
+                log.error("Error in data: %s", e)
             return -1
-        instruction, args_str = instruction_match.groups()
-
-        parsed = ParsedLine(
-            original=original_line,
-            label=label,
-            line_number=self.line_number,
-            instruction=instruction,
-            args=self.parse_args(args_str)
+        self.stats.counters["data_bytes"] = len(self.data.contents)
+        return 0
+
+    def write_data(self, fn, hex_notbin=True, disable_annotations=False) -> int:
+        self.data.write_mem(fn, hex_notbin, disable_annotations, self.labels)
+        return 0
+
+    def optimize(self, gcc=False) -> Counter:
+        """
+        Run the peephole optimizer over the program. Call this once parsing is finished. gcc allows
+        optimizations that are only safe for GCC's output. Returns how many times each pattern
+        matched.
+        """
+        self.parsed_lines, labels, matches = optimize.optimize(
+            self.parsed_lines, self.all_labels(), self.start_address, gcc
         )
+        self.split_labels(labels)
+        self.address = self.start_address + 4 * len(self.parsed_lines)
+        return matches
 
-        if parsed.is_directive:
-            print(
-                f"Detected assembler directive: {parsed.instruction}, ignoring...", parsed)
-            return 0
-
-        new_parsed_lines = [parsed]
-
-        # Handle psuedo-instructions.
-        if parsed.is_pseudo:
-            pseudo_result = \
-                rv32i.PSEUDO_INSTRUCTIONS[parsed.instruction](*parsed.args)
-
-            # NOTE: pseudo_result can either be a tuple in the form ('inst', [arg1, arg2]) or a list
-            # of tuples like that. We need to handle both cases
-
-            # if just one returned instruction
-            if not isinstance(pseudo_result[0], tuple):
-                parsed.instruction, parsed.args = pseudo_result
-            else:  # otherwise, handle multiple
-                new_parsed_lines = [
-                    replace(parsed, instruction=instruction, args=args)
-                    for instruction, args in pseudo_result
-                ]
+    def relax(self, branches=True) -> int:
+        """
+        Rewrite branches and jumps that can't reach their labels into longer sequences that can,
+        and redo the padding of alignment directives. Call this once parsing is finished. With
+        branches=False, only the padding is redone. Returns how many were rewritten.
+        """
+        self.parsed_lines, labels, relaxed = relax.relax(
+            self.parsed_lines, self.all_labels(), self.start_address, self.align_directives,
+            branches=branches,
+        )
+        self.split_labels(labels)
+        self.address = self.start_address + 4 * len(self.parsed_lines)
+        return relaxed
 
-        for new_parsed_line in new_parsed_lines:
-            self.address += 4
-            self.parsed_lines.append(new_parsed_line)
+    def all_labels(self) -> Dict[str, int]:
+        """ The labels plus the alignment markers, for passes that move code around. """
+        return {**self.labels, **self.align_labels}
 
-        return 0
+    def split_labels(self, labels: Dict[str, int]):
+        """ Take back labels from all_labels() after a pass moved them. """
+        self.align_labels = {marker: labels.pop(marker) for marker in self.align_labels}
+        self.labels = labels
 
-    def write_mem(self, fn, hex_notbin=True, disable_annotations=False, disable_sourcemaps=False):
-        output: List[Tuple[BitArray, ParsedLine]] = []
-        address: int = 0
+    def control_flow_graph(self) -> cfg.ControlFlowGraph:
+        """ Build the control-flow graph. Call this once parsing is finished. """
+        roots = [label for _, _, label, _ in self.data.fixups]  # ex. `.word handler`
+        return cfg.ControlFlowGraph(self.parsed_lines, self.labels, self.start_address, roots)
 
-        # Convert all parsed instructions to binary
-        for parsed in self.parsed_lines:
+    def eliminate_dead_code(self) -> int:
+        """
+        Remove code that can never run. Call this once parsing is finished. Returns how many
+        instructions were removed.
+        """
+        graph = self.control_flow_graph()
+        dead = graph.dead_lines
+        if dead:
+            self.parsed_lines, labels = graph.eliminate(self.all_labels())
+            self.split_labels(labels)
+            self.address = self.start_address + 4 * len(self.parsed_lines)
+        return dead
+
+    def index_labels(self) -> LabelIndex:
+        """ Build the label index. Call this once parsing is finished. """
+        self.label_index = LabelIndex(self.labels)
+        return self.label_index
+
+    def print_line_error(self, parsed, e):
+        where = f" of {parsed.source.name}" if isinstance(parsed.source, SourceFile) else ""
+        log.error("Error on line %d%s (%s)", parsed.line_number, where, parsed.instruction)
+        log.error("  %s", e)
+        log.error("  original line: %s", parsed.original)
+
+    def encode_line(self, parsed, labels, address, allow_undefined=False) -> Optional[int]:
+        """
+        Encode a single line, printing an error and returning None if it can't be. With
+        allow_undefined, references to labels that aren't defined (yet) raise
+        UndefinedSymbolException instead.
+        """
+        try:
+            return rv32i.line_to_word(parsed, labels=labels, address=address)
+        except rv32i.UndefinedSymbolException as e:
+            if allow_undefined:
+                raise e
+            self.print_line_error(parsed, e)
+            return None
+        except rv32i.LineException as e:
+            self.print_line_error(parsed, e)
+            return None
+        except Exception as e:
+            log.error("Unhandled error, possible bug in assembler!!!")
+            self.print_line_error(parsed, e)
+            raise e
+
+    def encode(self, vectorized=False) -> Optional[Sequence[int]]:
+        """
+        Convert all parsed instructions to binary. Prints an error and returns None if any line
+        couldn't be assembled.
+        """
+        labels = self.index_labels()
+        if vectorized:
             try:
-                bits = rv32i.line_to_bits(
-                    parsed, labels=self.labels, address=address
-                )
+                return batch.assemble_words(self.parsed_lines, labels)
             except rv32i.LineException as e:
-                print(
-                    f"Error on line {parsed.line_number} ({parsed.instruction})"
-                )
-                print(f"  {e}")
-                print(f"  original line: {parsed.original}")
-                return -1
-            except Exception as e:
-                print(f"Unhandled error, possible bug in assembler!!!")
-                print(
-                    f"Error on line {parsed.line_number} ({parsed.instruction})"
-                )
-                print(f"  {e}")
-                print(f"  original line: {parsed.original}")
-                raise e
+                self.print_line_error(e.line, e)
+                return None
+
+        words: List[int] = []
+        address: int = 0
+        for parsed in self.parsed_lines:
+            word = self.encode_line(parsed, labels, address)
+            if word is None:
+                return None
             address += 4
-            output.append((bits, parsed))
+            words.append(word)
+        return words
+
+    def write_mem(self, fn, hex_notbin=True, disable_annotations=False, disable_sourcemaps=False, vectorized=False):
+        with self.stats.phase("encode"):
+            words = self.encode(vectorized=vectorized)
+        if words is None:
+            return -1
+
+        with self.stats.phase("sourcemap"):
+            if disable_sourcemaps:
+                nearest_labels = [None] * len(self.parsed_lines)
+            else:
+                nearest_labels = [
+                    self.label_index.nearest(address)
+                    for address in range(0, 4 * len(self.parsed_lines), 4)
+                ]
 
-        # Write to disk
         # Only write the file if the above completes without errors
-        source_map = []
-        with open(fn, "w") as f:
+        with self.stats.phase("write"), \
+                MemoryWriter(fn, hex_notbin, disable_annotations, disable_sourcemaps) as writer:
             address = 0
-            for bits, parsed in output:
-                annotation = f" // PC={hex(address)} line={parsed.line_number}: {parsed.original}"
-                if disable_annotations:
-                    annotation = ""
-                if not disable_sourcemaps:
-                    source_map.append((address, parsed.line_number))
-                if hex_notbin:
-                    f.write(f"{bits.hex}{annotation}\n")
-                else:
-                    f.write(bits.bin + "\n")
+            for word, parsed, nearest_label in zip(words, self.parsed_lines, nearest_labels):
+                writer.write(address, word, parsed, nearest_label)
                 address += 4
 
-        # Source maps
-        if not disable_sourcemaps:
-            # FIXME: This is *highly* inefficient
-            with open("tests/gtkwave_filters/assembly_sourcemap.txt", 'w') as f:
-                for address, line_no in source_map:
+        return 0
+
+    def write_object(self, fn, source) -> int:
+        """
+        Encode every instruction that doesn't depend on where this program ends up, and write an
+        object file for the linker (see link.py). Call this once parsing is finished.
+        """
+        local_labels = relax.text_label_lines(self.labels, len(self.parsed_lines), self.start_address)
+        words: List[int] = []
+        fixups: List[int] = []
+        address = self.start_address
+        for i, parsed in enumerate(self.parsed_lines):
+            if link.needs_fixup(parsed, local_labels):
+                fixups.append(i)
+                word = 0
+            else:
+                word = self.encode_line(parsed, self.labels, address)
+                if word is None:
+                    return -1
+            words.append(word)
+            address += 4
+        self.stats.counters["fixups"] = len(fixups)
+        try:
+            obj = link.make_object(
+                source, words, self.parsed_lines, fixups, self.labels, self.data, self.start_address
+            )
+        except rv32i.LineException as e:
+            self.print_line_error(self.parsed_lines[fixups[-1]], e)
+            return -1
+        link.write_object(obj, fn)
+        return 0
+
+    def assemble_stream(self, lines: Iterable[str], fn, hex_notbin=True, disable_annotations=False, disable_sourcemaps=False):
+        """
+        Parse, encode and write a program one line at a time, without holding all of it in memory.
+
+        Instructions that refer to labels that haven't been seen yet are written as placeholders
+        and patched in place once the whole input has been read. Only the label table and that
+        list of fixups are kept around.
+        """
+        fixups: List[Tuple[int, int, ParsedLine]] = []  # (file offset, address, line)
+        mnemonics = self.stats.mnemonics
+        with MemoryWriter(fn, hex_notbin, disable_annotations, disable_sourcemaps) as writer:
+            address = 0
+            with self.stats.phase("stream"):
+                for parsed in chain(self.expand(self.tokenize(lines)), [halt_line()]):
+                    mnemonics[parsed.instruction] += 1
                     try:
-                        nearest_label = sorted(
-                            filter(
-                                lambda entry: entry[1] <= address,
-                                self.labels.items()
-                            ),
-                            key=lambda entry: entry[1],
-                            reverse=True
-                        )[0][0]
-                    except IndexError:
-                        nearest_label = "root"
-                    f.write(f"{address:08X} {line_no}: {nearest_label}\n")
+                        word = self.encode_line(
+                            parsed, self.labels, address, allow_undefined=True
+                        )
+                    except rv32i.UndefinedSymbolException:
+                        word = 0
+                        fixups.append((writer.offset, address, parsed))
+                    if word is None:
+                        writer.abort()
+                        return -1
+                    writer.write(address, word, parsed, self.latest_label)
+                    address += 4
+
+            with self.stats.phase("fixups"):
+                for offset, address, parsed in fixups:
+                    word = self.encode_line(parsed, self.labels, address)
+                    if word is None:
+                        writer.abort()
+                        return -1
+                    writer.patch(offset, word)
 
         return 0
 
 
-def main():
+class MemoryWriter:
+    """
+    Writes instruction words to a memh (or memb) file, and the sourcemap for GTKWave, as they are
+    produced. Both go to temporary files which only replace the real ones once everything has been
+    written successfully.
+    """
+
+    def __init__(self, fn, hex_notbin=True, disable_annotations=False, disable_sourcemaps=False):
+        self.fn = fn
+        self.hex_notbin = hex_notbin
+        self.disable_annotations = disable_annotations
+        self.disable_sourcemaps = disable_sourcemaps
+        self.aborted = False
+        self.mem = open(fn + ".tmp", "wb")
+        self.sourcemap = None
+        if not disable_sourcemaps:
+            self.sourcemap = open(SOURCEMAP_PATH + ".tmp", "w")
+
+    @property
+    def offset(self) -> int:
+        """ Where in the memory file the next word will be written (for patch()). """
+        return self.mem.tell()
+
+    def format_word(self, word) -> str:
+        if self.hex_notbin:
+            return f"{word:08x}"
+        return f"{word:032b}"
+
+    def write(self, address, word, parsed, nearest_label):
+        line = self.format_word(word).encode()
+        if self.hex_notbin and not self.disable_annotations:
+            # The source line goes straight from the input file's bytes to this one
+            line += b" // PC=%#x line=%d: %s" % (address, parsed.line_number, parsed.original_bytes)
+        self.mem.write(line + b"\n")
+        if self.sourcemap:
+            self.sourcemap.write(f"{address:08X} {parsed.line_number}: {nearest_label}\n")
+
+    def patch(self, offset, word):
+        """ Overwrite a word that was already written at offset. """
+        end = self.mem.tell()
+        self.mem.seek(offset)
+        self.mem.write(self.format_word(word).encode())
+        self.mem.seek(end)
+
+    def abort(self):
+        """ Throw away everything written so far. """
+        self.aborted = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        success = exc_type is None and not self.aborted
+        self.mem.close()
+        if self.sourcemap:
+            self.sourcemap.close()
+        for tmp, fn in [(self.mem.name, self.fn), (SOURCEMAP_PATH + ".tmp", SOURCEMAP_PATH)]:
+            if fn == SOURCEMAP_PATH and not self.sourcemap:
+                continue
+            if success:
+                os.replace(tmp, fn)
+            else:
+                os.remove(tmp)
+
+
+def halt_line() -> ParsedLine:
+    """ Halt execution at the end of the file """
+    return ParsedLine(original='', line_number=-1, instruction='halt', args=[])
+
+
+def read_lines(sources: Iterable[SourceFile]) -> Iterator[Tuple[SourceFile, str]]:
+    """ (file, text) for every line of sources, for AssemblyProgram.tokenize(). """
+    for source in sources:
+        for line in source.lines():
+            yield source, line
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "input", help="input file name of human readable assembly"
+        "input",
+        nargs="+",
+        help="input file name of human readable assembly. Given several files (or a directory), "
+        "assembles all of them in parallel.",
     )
     parser.add_argument(
         "-o",
@@ -224,50 +640,401 @@ def main():
         default=os.environ.get('ASSEMBLER_VERBOSE', '0') == '1',
         help="increases verbosity of the script",
     )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        default=False,
+        help="remove redundant instructions (ex. `mv a5, a5`, or reloading a value that was just stored)",
+    )
+    parser.add_argument(
+        "--link",
+        action="store_true",
+        default=False,
+        help="link object files (made by assembling with `-o foo.rvo`) into one program, in the order given",
+    )
+    parser.add_argument(
+        "--dce",
+        action="store_true",
+        default=False,
+        help="remove code that can never run (after a `ret`/`j` with no label, or functions that are never called)",
+    )
+    parser.add_argument(
+        "--cfg",
+        metavar="FILE",
+        help="write the control-flow graph (basic blocks and the jumps between them) to FILE, as DOT if it ends in .dot, otherwise JSON",
+    )
+    parser.add_argument(
+        "--cycles",
+        nargs="?",
+        const="",
+        metavar="FILE",
+        help="estimate how many cycles the program takes on the multicycle core, per function and loop, as JSON (next to the output as foo.cycles.json, or in FILE)",
+    )
+    parser.add_argument(
+        "--disable_relaxation",
+        action="store_true",
+        default=False,
+        help="fail on branches and jumps that are out of range, instead of rewriting them into longer sequences",
+    )
     parser.add_argument(
         "-c",
         "--gcc",
         action="store_true",
         default=False,
-        help="add appropriate handling for assembly generated by GCC (preamble, etc.)",
+        help="add appropriate handling for assembly generated by GCC (preamble, s0 as a frame pointer for -O, etc.)",
+    )
+    parser.add_argument(
+        "--vectorized",
+        action="store_true",
+        default=False,
+        help="encode the whole program at once with NumPy (faster for large programs)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="assemble line by line without holding the whole program in memory (for very large inputs)",
+    )
+    parser.add_argument(
+        "--disable_cache",
+        action="store_true",
+        default=os.environ.get('ASSEMBLER_DISABLE_CACHE', '0') == '1',
+        help="always assemble, instead of restoring identical previous builds from the cache",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help=f"where to keep the build cache (default $ASSEMBLER_CACHE_DIR, or {DEFAULT_CACHE_DIR})",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="how many files to assemble in parallel when given several (default: one per core)",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--stats",
+        "--profile",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="print how long each phase of assembly took and instruction counts as JSON (or write them to FILE)",
+    )
+    args = parser.parse_args(argv)
+    configure_logging(args.verbose)
+
+    if args.stream and args.vectorized:
+        parser.error("--vectorized needs the whole program, so it can't be used with --stream")
+    if args.stream and args.optimize:
+        parser.error("-O needs the whole program, so it can't be used with --stream")
+    if args.stream and (args.dce or args.cfg or args.cycles is not None):
+        parser.error("--dce, --cfg and --cycles need the whole program, so they can't be used with --stream")
+
+    objects = args.output and link.is_object_file(args.output)
+    if objects and (args.dce or args.cfg or args.cycles is not None):
+        parser.error("--dce, --cfg and --cycles need the whole program, so they can't be used for object files")
+    if args.link and not args.output:
+        parser.error("--link needs an output file (-o)")
+
+    if args.link:
+        stats = Stats()
+        exit_code = link_files(args, stats)
+        if args.stats:
+            write_stats(stats.as_dict(), args.stats)
+        sys.exit(exit_code)
+
+    if len(args.input) == 1 and not path.isdir(args.input[0]):
+        args.input = args.input[0]
+        stats = Stats()
+        exit_code = build(args, stats)
+        if args.stats:
+            write_stats(stats.as_dict(), args.stats)
+        sys.exit(exit_code)
+
+    if args.output:
+        parser.error("-o can't be used with several inputs, each .memh is written next to its source")
+    sys.exit(build_many(args, find_inputs(args.input)))
+
 
+def build(args, stats=None) -> int:
+    """ Assemble args.input into args.output, using the build cache. Returns the exit code. """
     if not path.exists(args.input):
         raise Exception(f"input file {args.input} does not exist.")
-    ap = AssemblyProgram()
 
+    stats = stats or Stats()
+    stats.counters["input"] = args.input
     files = [args.input]
 
-    if args.gcc:
-        files.insert(0, 'asm/_preamble.s')  # TODO: account for CWD
+    if args.gcc and not link.is_object_file(args.output or ""):
+        files.insert(0, 'asm/_preamble.s')  # TODO: account for CWD. Objects link the preamble instead
+
+    if not args.output or args.disable_cache or args.cfg or args.cycles is not None:
+        return assemble(args, files, stats)
+
+    build_cache = BuildCache(args.cache_dir)
+    sourcemap = None if args.disable_sourcemaps else SOURCEMAP_PATH
+    data_output = data.data_path(args.output)
+    if link.is_object_file(args.output):
+        sourcemap = data_output = None  # Those come from linking
+    with stats.phase("cache"):
+        key = cache_key(files, {
+            "hex_notbin": not "memb" in args.output,
+            "disable_annotations": args.disable_annotations,
+            "disable_sourcemaps": args.disable_sourcemaps,
+            "optimize": args.optimize,
+            "dce": args.dce,
+            # -O only treats s0 as a frame pointer for GCC's output
+            "gcc": args.gcc,
+            # Both skip relaxation, so out of range branches fail instead
+            "disable_relaxation": args.disable_relaxation,
+            "stream": args.stream,
+            "object": link.is_object_file(args.output),
+        })
+        restored = build_cache.restore(key, args.output, sourcemap, data_output)
+    stats.counters["cache_hit"] = restored
+    if restored:
+        log.debug("Restored %s from the build cache (%s).", args.output, build_cache.cache_dir)
+        return 0
+
+    exit_code = assemble(args, files, stats)
+    if exit_code == 0:
+        build_cache.store(key, args.output, sourcemap, data_output)
+    return exit_code
+
 
-    for file in files:
-        with open(file, "r") as f:
-            for line in f:
-                ap.parse_line(line)
+def find_inputs(inputs: List[str]) -> List[str]:
+    """ Expand directories into the assembly files in them (skipping _preamble.s and friends). """
+    files = []
+    for input in inputs:
+        if path.isdir(input):
+            files += [
+                fn for fn in sorted(glob.glob(path.join(input, "*.s")))
+                if not path.basename(fn).startswith("_")
+            ]
+        else:
+            files.append(input)
+    return files
 
-    # Halt execution at the end of the file
-    ap.parsed_lines.append(
-        ParsedLine(original='', line_number=-1, instruction='halt', args=[])
+
+def build_quietly(args) -> Tuple[int, str, float, Dict[str, Any]]:
+    """ Run build(), capturing its output. Returns (exit code, output, seconds taken, stats). """
+    output = io.StringIO()
+    stats = Stats()
+    start = time.perf_counter()
+    with redirect_stdout(output):
+        try:
+            exit_code = build(args, stats)
+        except Exception:
+            traceback.print_exc(file=output)
+            exit_code = 1
+    return exit_code, output.getvalue(), time.perf_counter() - start, stats.as_dict()
+
+
+def build_many(args, inputs: List[str]) -> int:
+    """
+    Assemble several files across a pool of processes, writing each .memh next to its source.
+    """
+    jobs = []
+    for input in inputs:
+        job = argparse.Namespace(**vars(args))
+        job.input = input
+        job.output = path.splitext(input)[0] + ".memh"
+        # They'd all be fighting over the same sourcemap file
+        job.disable_sourcemaps = True
+        jobs.append(job)
+
+    start = time.perf_counter()
+    failures = 0
+    all_stats = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for job, (exit_code, output, elapsed, stats) in zip(jobs, pool.map(build_quietly, jobs)):
+            all_stats.append(stats)
+            status = "ok"
+            if exit_code != 0:
+                status = "FAILED"
+                failures += 1
+            print(f"{status:>6} {elapsed * 1000:8.1f}ms  {job.input} -> {job.output}")
+            if exit_code != 0 or args.verbose:
+                print("         " + output.rstrip().replace("\n", "\n         "))
+
+    print(
+        f"Assembled {len(jobs) - failures}/{len(jobs)} files in "
+        f"{time.perf_counter() - start:.2f}s. Sourcemaps are not written for multiple files."
     )
+    if args.stats:
+        write_stats({"files": all_stats, "total": round(time.perf_counter() - start, 6)}, args.stats)
+    return 0 if failures == 0 else 1
+
 
-    if args.verbose:
-        print(f"Parsed {len(ap.parsed_lines)} instructions. Label table:")
-        print(
-            "  " + ",\n  ".join([f"{k} -> {ap.labels[k]}" for k in ap.labels])
+def link_files(args, stats=None) -> int:
+    """ Link the object files args.input into args.output, returning the exit code. """
+    stats = stats or Stats()
+    try:
+        with stats.phase("parse"):
+            objects = [link.read_object(fn) for fn in args.input]
+        with stats.phase("link"):
+            program = link.link(objects)
+        program.data.check_size()
+    except rv32i.LineException as e:
+        log.error("Error linking %s", getattr(e, "source", ", ".join(args.input)))
+        if getattr(e, "line", None):
+            log.error("  line %d: %s", e.line.line_number, e.line.original)
+        log.error("  %s", e)
+        return -1
+    stats.counters.update(objects=len(objects), labels=len(program.labels))
+    stats.counters["data_bytes"] = len(program.data.contents)
+
+    labels = LabelIndex(program.labels)
+    hex_notbin = not "memb" in args.output
+    with stats.phase("write"):
+        with MemoryWriter(args.output, hex_notbin, args.disable_annotations, args.disable_sourcemaps) as writer:
+            for i, (word, line) in enumerate(zip(program.words, program.lines)):
+                writer.write(4 * i, word, line, labels.nearest(4 * i))
+        program.data.write_mem(
+            data.data_path(args.output), hex_notbin, args.disable_annotations, program.labels
         )
+    return 0
+
+
+def log_label_table(ap: AssemblyProgram, message: str):
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(message)
+        log.debug("  " + ",\n  ".join([f"{k} -> {ap.labels[k]}" for k in ap.labels]))
+
+
+def assemble(args, files, stats=None) -> int:
+    """ Assemble files according to the command line arguments, returning the exit code. """
+    # Lines are read back out of the files right up to the end (for annotations and errors)
+    with ExitStack() as stack:
+        sources = [stack.enter_context(SourceFile(fn)) for fn in files]
+        return assemble_sources(args, sources, stats)
+
+
+def assemble_sources(args, sources: List[SourceFile], stats=None) -> int:
+    """ assemble(), once the files are open. """
+    ap = AssemblyProgram(stats=stats)
+
+    if args.stream:
+        exit_code = 0
+        try:
+            if args.output:
+                exit_code = ap.assemble_stream(
+                    read_lines(sources),
+                    args.output,
+                    hex_notbin=not "memb" in args.output,
+                    disable_annotations=args.disable_annotations,
+                    disable_sourcemaps=args.disable_sourcemaps,
+                )
+            else:
+                with ap.stats.phase("stream"):
+                    for parsed in ap.expand(ap.tokenize(read_lines(sources))):
+                        ap.stats.mnemonics[parsed.instruction] += 1
+        except rv32i.LineException as e:
+            ap.print_line_error(e.line, e)
+            return -1
+        ap.stats.counters.update(lines=ap.line_number, labels=len(ap.labels))
+        log_label_table(ap, f"Assembled {ap.address // 4} instructions. Label table:")
+        if exit_code == 0:
+            exit_code = ap.finish_data()
+        if exit_code == 0 and args.output:
+            exit_code = ap.write_data(
+                data.data_path(args.output),
+                hex_notbin=not "memb" in args.output,
+                disable_annotations=args.disable_annotations,
+            )
+        return exit_code
+
+    try:
+        with ap.stats.phase("parse"):
+            tokens = list(ap.tokenize(read_lines(sources)))
+        with ap.stats.phase("expand"):
+            ap.parsed_lines.extend(ap.expand(tokens))
+    except rv32i.LineException as e:
+        ap.print_line_error(e.line, e)
+        return -1
+    del tokens
+
+    object_output = args.output and link.is_object_file(args.output)
+    if not object_output:
+        ap.parsed_lines.append(halt_line())
+
+    if args.optimize:
+        with ap.stats.phase("optimize"):
+            matches = ap.optimize(gcc=args.gcc)
+        ap.stats.counters["peephole"] = dict(matches)
+        ap.stats.saved["constants"] = matches["reuse_constant"]
+        log.debug("Peephole optimizer matched %d times: %s", sum(matches.values()), dict(matches))
+
+    if args.dce:
+        with ap.stats.phase("dce"):
+            dead = ap.eliminate_dead_code()
+        ap.stats.saved["dead_code"] = dead
+        if dead:
+            log.debug("Removed %d instructions that can never run.", dead)
+
+    if not args.disable_relaxation:
+        with ap.stats.phase("relax"):
+            relaxed = ap.relax()
+        ap.stats.counters["relaxed"] = relaxed
+        if relaxed:
+            log.debug("Relaxed %d out of range branches and jumps.", relaxed)
+    elif args.optimize or args.dce:
+        # Nothing is relaxed, but removing code can still have moved the code after an .align
+        ap.relax(branches=False)
+
+    if object_output:
+        ap.stats.counters.update(lines=ap.line_number, labels=len(ap.labels))
+        ap.stats.count_instructions(parsed.instruction for parsed in ap.parsed_lines)
+        with ap.stats.phase("encode"):
+            return ap.write_object(args.output, sources[-1].name)
+
+    if args.cfg or args.cycles is not None:
+        with ap.stats.phase("cfg"):
+            graph = ap.control_flow_graph()
+            if args.cfg:
+                graph.write(args.cfg)
+        ap.stats.counters["basic_blocks"] = len(graph.blocks)
+
+    if args.cycles is not None:
+        with ap.stats.phase("cycles"):
+            try:
+                estimate = cycles.estimate_cycles(graph)
+            except rv32i.LineException as e:
+                ap.print_line_error(e.line, e)
+                return -1
+        ap.stats.counters["estimated_cycles"] = estimate["total"]
+        destination = args.cycles or (cycles.cycles_path(args.output) if args.output else "-")
+        write_stats(estimate, destination)
+
+    ap.stats.counters.update(lines=ap.line_number, labels=len(ap.labels))
+    ap.stats.count_instructions(parsed.instruction for parsed in ap.parsed_lines)
+
+    log_label_table(ap, f"Parsed {len(ap.parsed_lines)} instructions. Label table:")
+
+    with ap.stats.phase("data"):
+        if ap.finish_data() != 0:
+            return -1
 
     if args.output:
         exit_code = ap.write_mem(
             args.output,
             hex_notbin=not "memb" in args.output,
             disable_annotations=args.disable_annotations,
-            disable_sourcemaps=args.disable_sourcemaps
+            disable_sourcemaps=args.disable_sourcemaps,
+            vectorized=args.vectorized,
         )
-        sys.exit(exit_code)
+        if exit_code == 0:
+            with ap.stats.phase("write"):
+                exit_code = ap.write_data(
+                    data.data_path(args.output),
+                    hex_notbin=not "memb" in args.output,
+                    disable_annotations=args.disable_annotations,
+                )
+        return exit_code
 
-    sys.exit(0)
+    return 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,255 @@
+"""
+A peephole optimizer (`-O`), which cleans up redundant instructions that GCC leaves in at -O0:
+
+    addi a5, a5, 0      ->  (nothing)
+    sw a5, -20(s0)      ->  sw a5, -20(s0)
+    lw a5, -20(s0)          (nothing, a5 already has that value)
+    j .L2               ->  (nothing, if .L2 is the next instruction)
+    .L2:
+
+It runs after pseudo-instructions are expanded, so every line is one real instruction. Each pattern
+looks at a small window of consecutive lines and returns what to replace them with (or None to leave
+them alone). To add a pattern, write a function and add it to PEEPHOLES.
+
+Patterns never span a label (or the target of a branch by a number of bytes, ex. `bne a0, a1, 8`):
+if something could jump into the middle of a window, the instructions before it might not have run.
+Labels on deleted instructions move to whatever comes next, and numeric offsets are adjusted.
+
+Before the peepholes, reuse_constants() loads constants from registers that already hold a nearby
+value (ex. several MMIO addresses in a row), instead of building each one from scratch.
+"""
+
+from __future__ import annotations
+from typing import *
+
+from collections import Counter
+from functools import partial
+
+from cfg import offset_jumps, patch_offset_jumps
+from constants import BTYPES, INSTRUCTION_FORMATS
+from lexer import Memory, Register, register
+from relax import text_label_lines
+import rv32i
+
+ZERO = register("zero")
+
+# Memory through the stack pointer is just local variables, never memory-mapped I/O, so reading back
+# what we just stored is guaranteed to give the same value. GCC also uses s0 as a frame pointer, but
+# hand-written code can keep anything in it (ex. the address of a peripheral).
+FRAME_REGISTERS = frozenset({register("sp")})
+GCC_FRAME_REGISTERS = frozenset({register("sp"), register("s0")})
+
+
+def addi_zero(lines, next_labels):
+    """ `addi x, x, 0` (ex. `mv a5, a5`) does nothing. Deliberate `nop`s are kept. """
+    (parsed,) = lines
+    if parsed.instruction != "addi" or len(parsed.args) != 3:
+        return None
+    rd, rs1, imm = parsed.args
+    if rd == rs1 and rd != ZERO and imm == 0:
+        return []
+    return None
+
+
+def store_reload(lines, next_labels, frame_registers=FRAME_REGISTERS):
+    """ Loading a word that was just stored to the stack: use the register it came from. """
+    store, load = lines
+    if store.instruction != "sw" or load.instruction != "lw":
+        return None
+    rs, stored_to = store.args
+    rd, loaded_from = load.args
+    if not isinstance(stored_to, Memory) or stored_to != loaded_from:
+        return None
+    if stored_to.base not in frame_registers:
+        return None
+    if rd == rs:
+        return [store]
+    return [store, load.replace(instruction="addi", args=[rd, rs, 0])]
+
+
+def jump_to_next(lines, next_labels):
+    """ A jump (that doesn't link) or branch to the very next instruction does nothing. """
+    (parsed,) = lines
+    if parsed.instruction == "jal" and len(parsed.args) == 2 and parsed.args[0] == ZERO:
+        target = parsed.args[1]
+    elif parsed.instruction in BTYPES and len(parsed.args) == 3:
+        target = parsed.args[2]
+    else:
+        return None
+    if target == 4 or target in next_labels:
+        return []
+    return None
+
+
+# (name, window size, pattern)
+PEEPHOLES = [
+    ("addi_zero", 1, addi_zero),
+    ("store_reload", 2, store_reload),
+    ("jump_to_next", 1, jump_to_next),
+]
+
+
+def peephole_pass(parsed_lines, labels_at, matches, peepholes=PEEPHOLES):
+    """
+    Apply peepholes once over parsed_lines. Returns the new lines, and where each old line ended
+    up (with one extra entry for the end).
+    """
+    count = len(parsed_lines)
+    new_lines = []
+    new_index = [0] * (count + 1)
+    i = 0
+    while i < count:
+        new_index[i] = len(new_lines)
+        for name, window, pattern in peepholes:
+            if i + window > count:
+                continue
+            if any(i + k in labels_at for k in range(1, window)):
+                continue
+            result = pattern(parsed_lines[i:i + window], labels_at.get(i + window, ()))
+            if result is not None:
+                for k in range(1, window):
+                    new_index[i + k] = len(new_lines) + min(k, len(result))
+                new_lines += result
+                i += window
+                matches[name] += 1
+                break
+        else:
+            new_lines.append(parsed_lines[i])
+            i += 1
+    new_index[count] = len(new_lines)
+    return new_lines, new_index
+
+
+def constant(lines, i, labels_at):
+    """
+    If the instructions starting at lines[i] load a constant (`addi rd, zero, imm`, `lui rd, upimm`
+    or `lui rd, upimm` + `addi rd, rd, imm`), returns (rd, value, how many instructions).
+    """
+    parsed = lines[i]
+    if parsed.instruction == "addi" and len(parsed.args) == 3:
+        rd, rs1, imm = parsed.args
+        if rs1 == ZERO and isinstance(rd, Register) and isinstance(imm, int):
+            return rd, imm & 0xFFFFFFFF, 1
+    if parsed.instruction != "lui" or len(parsed.args) != 2:
+        return None
+    rd, upimm = parsed.args
+    if not isinstance(rd, Register) or not isinstance(upimm, int):
+        return None
+    value = (upimm << 12) & 0xFFFFFFFF
+    if i + 1 < len(lines) and i + 1 not in labels_at:
+        after = lines[i + 1]
+        if after.instruction == "addi" and len(after.args) == 3:
+            rd2, rs1, imm = after.args
+            if rd2 == rd and rs1 == rd and isinstance(imm, int):
+                return rd, (value + imm) & 0xFFFFFFFF, 2
+    return rd, value, 1
+
+
+def destination(parsed) -> Optional[Register]:
+    """ The register an instruction writes to, if any. """
+    if INSTRUCTION_FORMATS.get(parsed.instruction) in ("S", "B") or not parsed.args:
+        return None
+    rd = parsed.args[0]
+    return rd if isinstance(rd, Register) else None
+
+
+def reuse_constants(parsed_lines, labels_at, matches):
+    """
+    Track which registers hold known constants within each basic block, and load constants by
+    reusing them instead of building them from scratch:
+
+        li t0, 0x10000000   ->  lui t0, 0x10000
+        li t1, 0x10000004   ->  addi t1, t0, 4       (instead of lui + addi)
+        li t0, 0x10000000   ->  (nothing, t0 already has it)
+
+    Known values are forgotten at labels (something could jump there) and after jal/jalr (the
+    function we called could have changed anything).
+    """
+    count = len(parsed_lines)
+    new_lines = []
+    new_index = [0] * (count + 1)
+    known: Dict[Register, int] = {}
+    i = 0
+    while i < count:
+        new_index[i] = len(new_lines)
+        if i in labels_at:
+            known.clear()
+        parsed = parsed_lines[i]
+
+        loaded = constant(parsed_lines, i, labels_at)
+        if loaded is not None and loaded[0] != ZERO:
+            rd, value, length = loaded
+            if known.get(rd) == value:
+                result = []
+            else:
+                result = parsed_lines[i:i + length]
+                if length > 1:
+                    for register, other in known.items():
+                        delta = rv32i.sign_extend((value - other) & 0xFFFFFFFF, 32)
+                        if rv32i.fits_imm(delta, 12):
+                            result = [parsed.replace(instruction="addi", args=[rd, register, delta])]
+                            break
+            if len(result) < length:
+                matches["reuse_constant"] += length - len(result)
+            for k in range(1, length):
+                new_index[i + k] = len(new_lines) + min(k, len(result))
+            new_lines += result
+            known[rd] = value
+            i += length
+            continue
+
+        new_lines.append(parsed)
+        rd = destination(parsed)
+        if rd is not None and rd != ZERO:
+            source = parsed.args[1] if parsed.instruction == "addi" else None
+            if source in known and isinstance(parsed.args[2], int):
+                known[rd] = (known[source] + parsed.args[2]) & 0xFFFFFFFF
+            else:
+                known.pop(rd, None)
+        if parsed.instruction in ("jal", "jalr"):
+            known.clear()
+        i += 1
+    new_index[count] = len(new_lines)
+    return new_lines, new_index
+
+
+def optimize(parsed_lines, labels, start_address=0, gcc=False):
+    """
+    Run every pass over parsed_lines until none of them change anything. labels maps names to
+    addresses, and gcc allows optimizations that are only safe for GCC's output. Returns the new
+    lines, the updated labels, and how many times each optimization applied.
+    """
+    peepholes = PEEPHOLES
+    if gcc:
+        peepholes = [
+            (name, window, partial(pattern, frame_registers=GCC_FRAME_REGISTERS))
+            if pattern is store_reload else (name, window, pattern)
+            for name, window, pattern in PEEPHOLES
+        ]
+    passes = [reuse_constants, partial(peephole_pass, peepholes=peepholes)]
+
+    label_lines = text_label_lines(labels, len(parsed_lines), start_address)
+    jumps = offset_jumps(parsed_lines)
+    matches: Counter = Counter()
+    changed = True
+    while changed:
+        changed = False
+        for optimization in passes:
+            labels_at: Dict[int, Set[str]] = {}
+            for label, line in label_lines.items():
+                labels_at.setdefault(line, set()).add(label)
+            for _, target in jumps:
+                labels_at.setdefault(target, set())  # Jumped to, but has no name
+
+            before = sum(matches.values())
+            new_lines, new_index = optimization(parsed_lines, labels_at, matches)
+            label_lines = {label: new_index[line] for label, line in label_lines.items()}
+            jumps = patch_offset_jumps(parsed_lines, new_lines, new_index, jumps)
+            parsed_lines = new_lines
+            changed = changed or sum(matches.values()) != before
+
+    new_labels = {
+        label: start_address + 4 * label_lines[label] if label in label_lines else address
+        for label, address in labels.items()
+    }
+    return parsed_lines, new_labels, matches
@@ -0,0 +1,187 @@
+"""
+Branch relaxation: rewriting branches and jumps whose targets are out of range into longer
+sequences that can reach them.
+
+    beq a0, a1, far     ->  bne a0, a1, 8             (skip the jump if the branch isn't taken)
+                            jal zero, far
+    beq a0, a1, farther ->  bne a0, a1, 12
+                            auipc t1, %pcrel_hi(farther)
+                            jalr zero, t1, %pcrel_lo(farther)
+    jal ra, far         ->  auipc ra, %pcrel_hi(far)
+                            jalr ra, ra, %pcrel_lo(far)
+
+Every branch starts out as a single instruction and only grows when it has to. Growing one
+instruction moves everything after it, which can push other branches out of range, so we keep going
+until nothing changes. Sequences never shrink, so this always terminates.
+
+Code after an alignment directive moves too, so its padding nops are recomputed from the new
+addresses on every pass instead of keeping however many were needed before relaxing.
+"""
+
+from __future__ import annotations
+from typing import *
+
+from itertools import accumulate
+
+from constants import BTYPES
+import data
+import rv32i
+
+# Longest sequence for each kind of relaxable instruction: branches can become an inverted branch
+# over a jal (2), or over an auipc/jalr pair (3); jal can become an auipc/jalr pair (2).
+MAX_LEVEL = {"B": 2, "J": 1}
+
+
+def relaxable(parsed) -> Optional[str]:
+    """ "B" or "J" if parsed is a branch or jal to a label, otherwise None. """
+    if parsed.instruction in BTYPES and len(parsed.args) == 3:
+        kind = "B"
+    elif parsed.instruction == "jal" and len(parsed.args) == 2:
+        kind = "J"
+    else:
+        return None
+    return kind if isinstance(parsed.args[-1], str) else None
+
+
+def in_range(kind, level, offset) -> bool:
+    """ Can a sequence of the given level reach offset (measured from its first instruction)? """
+    if level == MAX_LEVEL[kind]:
+        return True  # auipc/jalr can reach anywhere
+    if kind == "B" and level == 0:
+        return rv32i.fits_imm(offset >> 1, 12)
+    if kind == "B":
+        offset -= 4  # The jal comes after the inverted branch
+    return rv32i.fits_imm(offset >> 1, 20)
+
+
+def expand(parsed, kind, level):
+    if level == 0:
+        return [parsed]
+    if kind == "B":
+        rs1, rs2, label = parsed.args
+        sequence = rv32i.far_branch(parsed.instruction, rs1, rs2, label, far_jal=level == 2)
+    else:
+        rd, label = parsed.args
+        sequence = rv32i.far_jump(rd, label)
+    return [parsed.replace(instruction=instruction, args=args) for instruction, args in sequence]
+
+
+def relax(parsed_lines, labels, start_address=0, alignments=None, branches=True):
+    """
+    Relax out-of-range branches and jumps in parsed_lines, where every line is one instruction and
+    labels maps names to addresses. alignments maps labels that mark the end of an alignment
+    directive's padding to the directive, and that padding is redone to match the new addresses.
+    With branches=False, only the padding is redone. Returns the new lines, the updated labels,
+    and how many instructions were relaxed.
+    """
+    label_lines = text_label_lines(labels, len(parsed_lines), start_address)
+    candidates = [
+        (i, kind)
+        for i, kind in ((i, relaxable(parsed)) for i, parsed in enumerate(parsed_lines))
+        if branches and kind and parsed_lines[i].args[-1] in label_lines
+    ]
+    aligned = aligned_lines(parsed_lines, label_lines, alignments or {})
+    if not candidates and not aligned:
+        return parsed_lines, labels, 0
+
+    sizes = [1] * len(parsed_lines)
+    line_alignments = {}
+    for line, (first, directive) in aligned.items():
+        for i in range(first, line):
+            sizes[i] = 0  # the old padding, replaced by whatever line_addresses() works out
+        line_alignments[line] = data.alignment(directive.instruction, directive.args)
+
+    levels = {i: 0 for i, _ in candidates}
+    changed = True
+    while changed:
+        changed = False
+        addresses = line_addresses(sizes, start_address, line_alignments)
+        for i, kind in candidates:
+            level = levels[i]
+            offset = addresses[label_lines[parsed_lines[i].args[-1]]] - addresses[i]
+            while not in_range(kind, level, offset):
+                level += 1
+            if level != levels[i]:
+                levels[i] = level
+                sizes[i] = level + 1
+                changed = True
+
+    relaxed = [i for i, level in levels.items() if level]
+    if not relaxed and not aligned:
+        return parsed_lines, labels, 0
+
+    addresses = line_addresses(sizes, start_address, line_alignments)
+    new_lines = []
+    for i in range(len(parsed_lines) + 1):
+        if i in aligned:
+            nop = aligned[i][1].replace(instruction="addi", args=[rv32i.ZERO, rv32i.ZERO, 0])
+            padding = (addresses[i] - start_address) // 4 - len(new_lines)
+            new_lines += [nop.replace() for _ in range(padding)]
+        if i == len(parsed_lines) or not sizes[i]:
+            continue
+        parsed = parsed_lines[i]
+        if levels.get(i):
+            new_lines += expand(parsed, relaxable(parsed), levels[i])
+        else:
+            new_lines.append(parsed)
+    new_labels = {
+        label: addresses[label_lines[label]] if label in label_lines else address
+        for label, address in labels.items()
+    }
+    return new_lines, new_labels, len(relaxed)
+
+
+def aligned_lines(parsed_lines, label_lines, alignments) -> Dict[int, Tuple[int, Any]]:
+    """
+    For each line that an alignment directive aligns, the first line of its current padding (the
+    nops just before it that came from the directive) and the directive.
+    """
+    aligned = {}
+    for label, directive in alignments.items():
+        if label not in label_lines:
+            continue
+        line = first = label_lines[label]
+        while first and is_padding(parsed_lines[first - 1], directive):
+            first -= 1
+        aligned[line] = (first, directive)
+    return aligned
+
+
+def is_padding(parsed, directive) -> bool:
+    return (
+        parsed.line_number == directive.line_number
+        and parsed.source is directive.source
+        and parsed.instruction == "addi"
+        and parsed.args == [rv32i.ZERO, rv32i.ZERO, 0]
+    )
+
+
+def text_label_lines(labels, count, start_address=0) -> Dict[str, int]:
+    """
+    Which line each label in the code points to (count if it's at the very end). Labels outside
+    the code (ex. in data memory) are left out.
+    """
+    end_address = start_address + 4 * count
+    return {
+        label: (address - start_address) // 4
+        for label, address in labels.items()
+        if start_address <= address <= end_address
+    }
+
+
+def line_addresses(sizes, start_address=0, alignments=None) -> List[int]:
+    """
+    Address of each line given how many instructions each takes, plus the end address. alignments
+    maps lines to how many bytes they're aligned to.
+    """
+    if not alignments:
+        return list(accumulate((4 * size for size in sizes), initial=start_address))
+    addresses = []
+    address = start_address
+    for i in range(len(sizes) + 1):
+        if i in alignments:
+            address += -address % alignments[i] // 4 * 4
+        addresses.append(address)
+        if i < len(sizes):
+            address += 4 * sizes[i]
+    return addresses
@@ -1,14 +1,17 @@
-import re
-from dataclasses import replace
+from dataclasses import dataclass
 
-from helpers import BitArray, LineException
+from helpers import BitArray, LineException, UndefinedSymbolException, log, require_bitstring
 from constants import *
+from lexer import Memory, Register, Relocation, parse_number, parse_operand, register
+from symbols import LabelIndex
 
-pattern_immediate_offset_register = "(-?\d+)\((\w+)\)"
+ZERO = register("zero")
+RA = register("ra")
+T1 = register("t1")
 
 
 def register_to_bits(register):
-    return BitArray(uint=REGISTER_TO_INTEGER[register], length=5)
+    return BitArray(uint=register_number(register), length=5)
 
 
 def bits_to_register(bits):
@@ -17,7 +20,7 @@ def bits_to_register(bits):
     return REGISTER_NAMES[bits.uint][-1]
 
 
-def parse_int_immediate(imm):  # TODO: use this consistently
+def parse_int_immediate(imm):
     """
     Parse all valid number literals (0x for hex, 0b for binary, etc.). Does not parse labels.
     Returns signed values.
@@ -28,78 +31,93 @@ def parse_int_immediate(imm):  # TODO: use this consistently
     if isinstance(imm, int):
         return imm
     assert isinstance(imm, str), f"Unknown type for imm: {type(imm)} ({imm})"
+    return parse_number(imm.strip())
 
-    imm = imm.strip().lower()
-    if imm.startswith("0x"):  # hex
-        return int(imm[2:], 16)
-    elif imm.startswith("0b"):  # binary
-        return int(imm[2:], 2)
-    elif imm.startswith("0"):  # octal
-        return int(imm, 8)
-    else:  # decimal
-        return int(imm)
+
+def fits_imm(imm, bits):
+    """ Does imm fit in a signed immediate of the given width? """
+    return -(2 ** (bits - 1)) <= imm < 2 ** (bits - 1)
 
 
 def check_imm(imm, bits):
-    if imm >= 2 ** (bits - 1) or imm < -(2 ** (bits - 1)):
+    if not fits_imm(imm, bits):
         raise LineException(f"Immediate {imm} does not fit into {bits} bits.")
 
 
+def check_shift_amount(instruction, imm):
+    # Shift amounts are 5 bits, the rest of the immediate is funct7 (which tells srai from srli)
+    if instruction in ("slli", "srli", "srai") and not 0 <= imm < 32:
+        raise LineException(f"Shift amount {imm} must be between 0 and 31.")
+
+
 def pseudo_instruction_li(rd, expression):
     imm = parse_int_immediate(expression)
-    try:
-        check_imm(imm, 12)
-        return "addi", [rd, "zero", expression]
-    except LineException:  # need to do a full 32-bit li
-        # NOTE: addi does sign extension, so we need to be clever here. If the MSB is high, it will
-        # think imm12 is negative (resulting in a net change of -4096). Adding 1 to upimm will add
-        # 4096, thereby cancelling it out.
-        # Credit: https://stackoverflow.com/a/59546567
-        imm12 = imm & 0xFFF
-        upimm = imm >> 12
-        if imm12 >= 0x800:  # MSB is high
-            imm12 = -1  # This will be 0xFFF
-            upimm += 1
-        return [("lui", [rd, upimm]), ("addi", [rd, rd, imm12])]
+    if not -(2 ** 31) <= imm < 2 ** 32:
+        raise LineException(f"Immediate {imm} does not fit into 32 bits.")
+    return materialize_constant(rd, sign_extend(imm & 0xFFFFFFFF, 32))
+
+
+def materialize_constant(rd, value):
+    """
+    The shortest sequence that loads a 32-bit value into rd: addi if it fits in 12 bits, lui if
+    the low 12 bits are zero, otherwise lui then addi.
+    """
+    if fits_imm(value, 12):
+        return "addi", [rd, ZERO, value]
+    # NOTE: addi sign-extends its immediate, so if the low 12 bits look negative, hi20 rounds up to
+    # cancel that out.
+    upimm, imm12 = hi20(value), lo12(value)
+    if imm12 == 0:
+        return "lui", [rd, upimm]
+    return [("lui", [rd, upimm]), ("addi", [rd, rd, imm12])]
+
+
+def pseudo_instruction_la(rd, symbol):
+    if not isinstance(symbol, str):
+        raise LineException(f"Expected a label, not '{symbol}'.")
+    return [
+        ("lui", [rd, Relocation("hi", symbol)]),
+        ("addi", [rd, rd, Relocation("lo", symbol)]),
+    ]
 
 
 def pseudo_instruction_call(label):
-    print("WARNING: call only works with nearby functions")
-    return "jal", ["ra", label]
+    # Calls that turn out to be too far for jal are relaxed into auipc/jalr, see relax.py
+    return "jal", [RA, label]
 
 
 # Table from: https://michaeljclark.github.io/asm.html
 PSEUDO_INSTRUCTIONS = {
     # No operation
-    "nop": lambda: ("addi", ["zero", "zero", 0]),
+    "nop": lambda: ("addi", [ZERO, ZERO, 0]),
     # Copy register
     "mv": lambda rd, rs1: ("addi", [rd, rs1, 0]),
     # One's complement
     "not": lambda rd, rs1: ("xori", [rd, rs1, -1]),
     # Two's complement
-    "neg": lambda rd, rs1: ("sub", [rd, "zero", rs1]),
+    "neg": lambda rd, rs1: ("sub", [rd, ZERO, rs1]),
     # Two's complement Word
-    "negw": lambda rd, rs1: ("subw", [rd, "zero", rs1]),
+    "negw": lambda rd, rs1: ("subw", [rd, ZERO, rs1]),
     # Set if = zero
     "seqz": lambda rd, rs1: ("sltiu", [rd, rs1, 1]),
     # Set if ≠ zero
-    "snez": lambda rd, rs1: ("sltu", [rd, "zero", rs1]),
+    "snez": lambda rd, rs1: ("sltu", [rd, ZERO, rs1]),
     # Set if < zero
-    "sltz": lambda rd, rs1: ("slt", [rd, rs1, "zero"]),
+    "sltz": lambda rd, rs1: ("slt", [rd, rs1, ZERO]),
     # Set if > zero
-    "sgtz": lambda rd, rs1: ("slt", [rd, "zero", rs1]),
+    "sgtz": lambda rd, rs1: ("slt", [rd, ZERO, rs1]),
     # Branch if = zero
-    "beqz": lambda rs1, offset: ("beq", [rs1, "zero", offset]),
+    "beqz": lambda rs1, offset: ("beq", [rs1, ZERO, offset]),
     # Branch if ≠ zero
-    "bnez": lambda rs1, offset: ("bne", [rs1, "zero", offset]),
+    "bnez": lambda rs1, offset: ("bne", [rs1, ZERO, offset]),
     # Branch if ≤ zero
-    "blez": lambda rs1, offset: ("bge", ["zero", rs1, offset]),
+    "blez": lambda rs1, offset: ("bge", [ZERO, rs1, offset]),
     # Branch if ≥ zero
-    "bgez": lambda rs1, offset: ("bge", [rs1, "zero", offset]),
+    "bgez": lambda rs1, offset: ("bge", [rs1, ZERO, offset]),
     # Branch if < zero
-    "bltz": lambda rs1, offset: ("blt", [rs1, "zero", offset]),
+    "bltz": lambda rs1, offset: ("blt", [rs1, ZERO, offset]),
     # Branch if > zero
-    "bgtz": lambda rs1, offset: ("blt", ["zero", rs1, offset]),
+    "bgtz": lambda rs1, offset: ("blt", [ZERO, rs1, offset]),
     # Branch if >
     "bgt": lambda rs, rt, offset: ("blt", [rt, rs, offset]),
     # Branch if ≤
@@ -109,285 +127,503 @@ PSEUDO_INSTRUCTIONS = {
     # Branch if ≤, unsigned
     "bleu": lambda rs, rt, offset: ("bltu", [rt, rs, offset]),
     # Jump
-    "j": lambda offset: ("jal", ["zero", offset]),
+    "j": lambda offset: ("jal", [ZERO, offset]),
     # Jump register
     # NB: Other table said this should be jal x1, offset
-    "jr": lambda offset: ("jalr", ["zero", offset, 0]),
+    "jr": lambda offset: ("jalr", [ZERO, offset, 0]),
     # Return from subroutine
-    "ret": lambda: ("jalr", ["zero", "ra", 0]),
+    "ret": lambda: ("jalr", [ZERO, RA, 0]),
     # Call a function
     "call": pseudo_instruction_call,
     # Load immediate
     "li": pseudo_instruction_li,
     # Load address
-    "la": lambda rd, symbol: None,  # TODO
+    "la": pseudo_instruction_la,
+    "lla": pseudo_instruction_la,
     # TODO: What is this?
     # Sign extend Word
     # "sext.w": lambda rd, rs1: ("addiw", [rd, rs, 0]),
 }
 
 
-def line_to_bits(line, labels={}, address=0):
-    instruction = line.instruction
-    args = line.args
-    bits = None
-    if instruction in RTYPES:
-        if len(args) != 3:
-            raise LineException(
-                "R-type instructions require 3 arguments.",
-            )
-
-        try:
-            rd, rs1, rs2 = [register_to_bits(a) for a in args]
-        except KeyError:
-            # Sometimes, GCC likes to forget the I in immediate instructions, so if we couldn't
-            # parse the registers than try again with an i
-            return line_to_bits(
-                replace(line, instruction=line.instruction + "i"), labels, address
-            )
-
-        funct7 = BitArray(0, length=7)
-        if instruction in ["sub", "sra"]:
-            funct7 = BitArray("0b0100000")
-        bits = (
-            funct7 + rs2 + rs1 + FUNCT3_CODES[instruction] + rd + OP_CODES[instruction]
-        )
-    if instruction in ITYPES:
-        if len(args) != 3:
-            raise LineException(
-                "I-type instructions require 3 arguments.",
-            )
-        rd, rs1, imm12 = args
-        rd = register_to_bits(rd)
-        rs1 = register_to_bits(rs1)
-        imm12 = int(imm12)
-        check_imm(imm12, 12)
-        imm12 = BitArray(int=imm12, length=12)
-        bits = imm12 + rs1 + FUNCT3_CODES[instruction] + rd + OP_CODES[instruction]
-    # Not an official "type", but parsed differently
-    if instruction in LTYPES:
-        # ex: lw rd, imm(rs1)
-        rd, offset_rs = args
-        match = re.match(pattern_immediate_offset_register, offset_rs)
-        if not match:
-            raise LineException("Load: immediate offset incorrectly formatted.")
-        imm12 = int(match.group(1))
-        check_imm(imm12, 12)
-        imm12 = BitArray(int=int(match.group(1)), length=12)
-        if instruction in ["slli", "srli"]:
-            imm12[0:7] = "0b0000000"
-        if instruction == "srai":
-            imm12[0:7] = "0b0100000"
-        rs = register_to_bits(match.group(2))
-        rd = register_to_bits(rd)
-        bits = imm12 + rs + FUNCT3_CODES[instruction] + rd + OP_CODES[instruction]
-    if instruction in STYPES:
-        rs2, offset_rs = args
-        match = re.match(pattern_immediate_offset_register, offset_rs)
-        if not match:
-            raise LineException(
-                "Load: immediate offset incorrectly formatted.",
-            )
-        imm12 = int(match.group(1))
-        check_imm(imm12, 12)
-        imm12 = BitArray(int=int(match.group(1)), length=12)
-        rs1 = register_to_bits(match.group(2))
-        rs2 = register_to_bits(rs2)
-        # bitstring slicing is opposite to Verilog (0 is MSB)
-        bits = (
-            imm12[0:7]
-            + rs2
-            + rs1
-            + FUNCT3_CODES[instruction]
-            + imm12[7:]
-            + OP_CODES[instruction]
-        )
-    if instruction in BTYPES:
-        rs1, rs2, label = args
-        rs1 = register_to_bits(rs1)
-        rs2 = register_to_bits(rs2)
-        if label not in labels:
-            raise LineException(
-                f"label '{label}' was not in the stored table.",
-            )
-        offset = int(labels[label]) - address
-        offset = offset >> 1
-        check_imm(offset, 12)
-        imm12 = BitArray(int=offset, length=12)
-        print("#" * 48)
-
-        print(
-            f"Found a branch, setting BTA to offset = {offset}, "
-            f"imm12 = {imm12.int}, "
-            f"original offset = {int(labels[label]) - address} "
-        )
-        print("#" * 48 + "\n")
-
-        # Verilog: 12 11 10  9  8  7  6  5  4  3  2  1
-        #  Python:  0  1  2  3  4  5  6  7  8  9 10 11
-
-        print("BRANCH: imm[1:2] =", imm12[1:2])
-
-        bits = (
-            imm12[0:1]
-            + imm12[2:8]
-            + rs2
-            + rs1
-            + FUNCT3_CODES[instruction]
-            + imm12[8:12]
-            + imm12[1:2]
-            + OP_CODES[instruction]
+def is_register(operand):
+    return isinstance(operand, Register) or operand in REGISTER_TO_INTEGER
+
+
+def register_number(operand):
+    if isinstance(operand, Register):
+        return operand.number
+    try:
+        return REGISTER_TO_INTEGER[operand]
+    except (KeyError, TypeError):
+        raise LineException(f"Unknown register '{operand}'.")
+
+
+def immediate_value(operand, labels=None, address=0):
+    if isinstance(operand, int):
+        return operand
+    if isinstance(operand, Relocation) and labels is not None:
+        return resolve_relocation(operand, labels, address)
+    if isinstance(operand, str):
+        value = parse_operand(operand.strip())
+        if isinstance(value, int):
+            return value
+    raise LineException(f"Expected an immediate, not '{operand}'.")
+
+
+def memory_operand(operand, labels=None, address=0):
+    """ Returns (offset, base register number) for an `offset(base)` operand. """
+    if isinstance(operand, str):
+        operand = parse_operand(operand.strip())
+    if not isinstance(operand, Memory):
+        raise LineException("Load: immediate offset incorrectly formatted.")
+    offset = immediate_value(operand.offset, labels, address)
+    check_imm(offset, 12)
+    return offset, operand.base.number
+
+
+def immediate_field(imm, bits):
+    """ Two's complement of imm, truncated to the low `bits` bits. """
+    return imm & ((1 << bits) - 1)
+
+
+def encode_rtype(instruction, args, labels, address):
+    if len(args) != 3:
+        raise LineException(
+            "R-type instructions require 3 arguments.",
         )
-    if instruction == "jal":
-        rd, label = args
-        rd = register_to_bits(rd)
-        if label not in labels:
-            raise LineException(
-                f"label '{label}' was not in the stored table.",
-            )
-        offset = (labels[label] - address) >> 1
-        check_imm(offset, 20)
-        imm = BitArray(int=offset, length=20)
-
-        # imm[20|10:1|11|19:12] in normal bit order, this library makes us flip that
-        # imm20,10:1,11,19:12
-        imm20 = imm[0:1] + imm[10:20] + imm[9:10] + imm[1:9]
-        print(
-            f"Found a jal: offset = {offset}, imm={imm.bin}, imm20={imm20.bin} | {label}"
+    if not all(is_register(a) for a in args):
+        # Sometimes, GCC likes to forget the I in immediate instructions, so if we couldn't
+        # parse the registers than try again with an i
+        return encode_instruction(instruction + "i", args, labels, address)
+    rd, rs1, rs2 = [register_number(a) for a in args]
+    return BASE_WORDS[instruction] | (rs2 << 20) | (rs1 << 15) | (rd << 7)
+
+
+def encode_itype(instruction, args, labels, address):
+    if len(args) != 3:
+        raise LineException(
+            "I-type instructions require 3 arguments.",
         )
-        bits = imm20 + rd + OP_CODES[instruction]
-    if instruction in UTYPES:
-        rd, upimm = args
-        rd = register_to_bits(rd)
-        check_imm(upimm, 20)
-        upimm = BitArray(int=int(upimm), length=20)
-        bits = upimm + rd + OP_CODES[instruction]
+    rd, rs1, imm12 = args
+    imm12 = immediate_value(imm12, labels, address)
+    check_imm(imm12, 12)
+    check_shift_amount(instruction, imm12)
+    return (
+        BASE_WORDS[instruction]
+        | (immediate_field(imm12, 12) << 20)
+        | (register_number(rs1) << 15)
+        | (register_number(rd) << 7)
+    )
+
+
+def encode_ltype(instruction, args, labels, address):
+    # ex: lw rd, imm(rs1)
+    rd, offset_rs = args
+    imm12, rs1 = memory_operand(offset_rs, labels, address)
+    return (
+        BASE_WORDS[instruction]
+        | (immediate_field(imm12, 12) << 20)
+        | (rs1 << 15)
+        | (register_number(rd) << 7)
+    )
+
+
+def encode_stype(instruction, args, labels, address):
+    # ex: sw rs2, imm(rs1)
+    rs2, offset_rs = args
+    imm12, rs1 = memory_operand(offset_rs, labels, address)
+    imm12 = immediate_field(imm12, 12)
+    return (
+        BASE_WORDS[instruction]
+        | ((imm12 >> 5) << 25)
+        | (register_number(rs2) << 20)
+        | (rs1 << 15)
+        | ((imm12 & 0x1F) << 7)
+    )
+
+
+def label_offset(label, labels, address):
+    """ Offset from address to label. A number is taken as an offset already (ex. `bne a0, a1, 8`). """
+    if isinstance(label, int):
+        return label
+    if label not in labels:
+        raise UndefinedSymbolException(label)
+    return int(labels[label]) - address
+
+
+def hi20(value):
+    """
+    The lui/auipc half of a 32-bit value, as a signed 20-bit immediate. Rounded, since the other
+    half is sign-extended.
+    """
+    return sign_extend(((value + 0x800) >> 12) & 0xFFFFF, 20)
+
+
+def lo12(value):
+    """ The addi/jalr/load/store half of a 32-bit value, which is added to the hi20 half. """
+    return sign_extend(value & 0xFFF, 12)
+
+
+# kind -> (part of the value to use, is the value relative to the instruction's address?)
+RELOCATIONS = {
+    "hi": (hi20, False),
+    "lo": (lo12, False),
+    "pcrel_hi": (hi20, True),
+    "pcrel_lo": (lo12, True),
+}
+
+
+def resolve_relocation(relocation, labels, address):
+    """ The immediate a Relocation stands for, once labels are known. """
+    try:
+        part, pc_relative = RELOCATIONS[relocation.kind]
+    except KeyError:
+        raise LineException(f"Unsupported relocation %{relocation.kind}.")
+    if relocation.symbol not in labels:
+        raise UndefinedSymbolException(relocation.symbol)
+    value = int(labels[relocation.symbol]) + relocation.addend
+    if pc_relative:
+        value -= address + relocation.pc_offset
+    return part(value)
+
+
+def far_jump(rd, label):
+    """
+    jal rd, label for labels that are out of jal's range. Jumps that don't link (`j`) use t1 as
+    the scratch register, like GNU as's `tail`.
+    """
+    scratch = rd if register_number(rd) != 0 else T1
+    return [
+        ("auipc", [scratch, Relocation("pcrel_hi", label)]),
+        ("jalr", [rd, scratch, Relocation("pcrel_lo", label, -4)]),
+    ]
+
+
+INVERTED_BRANCHES = {
+    "beq": "bne",
+    "bne": "beq",
+    "blt": "bge",
+    "bge": "blt",
+    "bltu": "bgeu",
+    "bgeu": "bltu",
+}
+
+
+def far_branch(instruction, rs1, rs2, label, far_jal=False):
+    """
+    A branch to a label that's out of range: skip over a jump to label if the condition is false.
+    With far_jal, the jump itself is an auipc/jalr pair.
+    """
+    jump = far_jump(ZERO, label) if far_jal else [("jal", [ZERO, label])]
+    return [(INVERTED_BRANCHES[instruction], [rs1, rs2, 4 + 4 * len(jump)])] + jump
+
+
+def encode_btype(instruction, args, labels, address):
+    rs1, rs2, label = args
+    rs1 = register_number(rs1)
+    rs2 = register_number(rs2)
+    offset = label_offset(label, labels, address)
+    check_imm(offset >> 1, 12)
+    log.debug(
+        "Found a branch, setting BTA to offset = %d, original offset = %d", offset >> 1, offset
+    )
+
+    # imm[12|10:5] rs2 rs1 funct3 imm[4:1|11] opcode
+    imm = immediate_field(offset, 13)
+    return (
+        BASE_WORDS[instruction]
+        | ((imm >> 12) << 31)
+        | (((imm >> 5) & 0x3F) << 25)
+        | (rs2 << 20)
+        | (rs1 << 15)
+        | (((imm >> 1) & 0xF) << 8)
+        | (((imm >> 11) & 0x1) << 7)
+    )
+
+
+def encode_jtype(instruction, args, labels, address):
+    rd, label = args
+    rd = register_number(rd)
+    offset = label_offset(label, labels, address)
+    check_imm(offset >> 1, 20)
+    log.debug("Found a jal: offset = %d | %s", offset >> 1, label)
+
+    # imm[20|10:1|11|19:12] rd opcode
+    imm = immediate_field(offset, 21)
+    return (
+        BASE_WORDS[instruction]
+        | ((imm >> 20) << 31)
+        | (((imm >> 1) & 0x3FF) << 21)
+        | (((imm >> 11) & 0x1) << 20)
+        | (((imm >> 12) & 0xFF) << 12)
+        | (rd << 7)
+    )
+
+
+def encode_utype(instruction, args, labels, address):
+    rd, upimm = args
+    upimm = immediate_value(upimm, labels, address)
+    check_imm(upimm, 20)
+    return (
+        BASE_WORDS[instruction]
+        | (immediate_field(upimm, 20) << 12)
+        | (register_number(rd) << 7)
+    )
+
+
+ENCODERS = {
+    "R": encode_rtype,
+    "I": encode_itype,
+    "L": encode_ltype,
+    "S": encode_stype,
+    "B": encode_btype,
+    "J": encode_jtype,
+    "U": encode_utype,
+}
+
+
+def encode_instruction(instruction, args, labels={}, address=0):
+    """
+    Encode an instruction (given its mnemonic and operands) as an unsigned 32-bit int.
+    """
     if instruction == "halt":
-        bits = BitArray(0, length=32)  # zeroed by default
-        print("HALT:", not not bits)
-    if bits is None:
+        return 0  # halt is an all-zero instruction
+    try:
+        encoder = ENCODERS[INSTRUCTION_FORMATS[instruction]]
+    except KeyError:
         raise LineException(
             f"Instruction {instruction} was not handled.",
         )
-    if bits.length != 32:
-        raise LineException(
-            f"Internal: Hard coded values didn't line up to 32 bits (was {bits.length} instead)",
-        )
-    return bits
-
-
-def bits_to_line(bits, labels=None):
-    if bits.length != 32:
-        raise ValueError("instruction must be 32 bits")
-    op_code = bits[25:]
-    rd = bits_to_register(bits[31 - 11 : 31 - 7 + 1])
-    rs1 = bits_to_register(bits[31 - 19 : 31 - 15 + 1])
-    rs2 = bits_to_register(bits[31 - 24 : 31 - 20 + 1])
-    funct3 = bits[31 - 14 : 31 - 12 + 1]
-    imm12 = bits[0:12]
-    op = None
-    funct7 = bits[0:7]
-    if op_code.bin == "0110011":  # r-type
-        if funct3.bin == "000":
-            if funct7.bin == "0000000":
-                op = "add"
-            elif funct7.bin == "0100000":
-                op = "sub"
-            else:
-                raise ValueError(f"Invalid r-type add/sub funct7: {funct7.bin}")
-        elif funct3.bin == "101":
-            if funct7.bin == "0000000":
-                op = "srl"
-            elif funct7.bin == "0100000":
-                op = "sra"
-            else:
-                raise ValueError(f"Invalid r-type srl/sra funct7: {funct7.bin}")
-        else:
-            try:
-                op = RTYPE_FUNCT3_MAPPING[funct3.bin]
-            except KeyError as e:
-                raise ValueError(f"Invalid r-type funct3: {funct3.bin}")
-        return f"{op} {rd}, {rs1}, {rs2}"
-    if op_code.bin == "0010011":  # i-type
-        if funct3.bin == "101":
-            if funct7.bin == "0000000":
-                op = "srli"
-            elif funct7.bin == "0100000":
-                op = "srai"
-            else:
-                raise ValueError(f"Invalid i-type srl/sra funct7: {funct7.bin}")
-        else:
-            try:
-                op = ITYPE_FUNCT3_MAPPING[funct3.bin]
-            except KeyError as e:
-                raise ValueError(f"Invalid i-type funct3: {funct3.bin}")
-        immediate = imm12.int
-        if op in ["slli", "srli", "srai"]:
-            immediate = imm12[4:].uint
-        return f"{op} {rd}, {rs1}, {immediate}"
-    if op_code.bin == "0000011":  # l-type
-        try:
-            op = LTYPE_FUNCT3_MAPPING[funct3.bin]
-        except KeyError as e:
-            raise ValueError(f"Invalid load i-type funct3: {funct3.bin}")
-        immediate = imm12.int
-        return f"{op} {rd}, {immediate}({rs1})"
-    if op_code.bin == "0100011":  # s-type
-        try:
-            op = STYPE_FUNCT3_MAPPING[funct3.bin]
-        except KeyError:
-            raise ValueError(f"Invalid s-type funct3: {funct3.bin}")
-        imm12 = bits[31 - 31 : 31 - 25 + 1] + bits[31 - 11 : 31 - 11 + 5]
-        return f"{op} {rs2}, {imm12.int}({rs1})"
-    if op_code.bin == "1100011":  # b-type
-        try:
-            op = BTYPE_FUNCT3_MAPPING[funct3.bin]
-        except KeyError:
-            raise ValueError(f"Invalid b-type funct3: {funct3.bin}")
-        imm12 = BitArray(length=12)
-        imm12[0] = bits[0]
-        imm12[12 - 10 : 12 - 5 + 1] = bits[1:7]
-        imm12[12 - 4 : 12 - 1 + 1] = bits[31 - 11 : 31 - 7 + 1]
-        imm12[1] = bits[31 - 7 : 31 - 7 + 1]
-        address = imm12
-        if labels is None:
-            return f"{op} {rs1}, {rs2}, {address.uint}"
-        address = address.int * 2
-        if address not in labels:
-            labels[address] = f"LABEL_{len(labels)}"
-        return f"{op} {rs1}, {rs2}, {labels[address]} # {labels[address]} <- {address}"
-    imm20 = BitArray(length=21)
-    imm20 = bits[31:32] + bits[19:12] + bits[20:21] + bits[30:25]
-    imm20 = imm20 + BitArray(uint=1, length=1)
-    if op_code == OP_CODES["auipc"]:
-        return f"auipc {rd}, {imm20.int}"
-    if op_code == OP_CODES["lui"]:
-        return f"lui {rd}, {imm20.int}"
-    if op_code == OP_CODES["jalr"]:
-        if funct3.bin != "000":
-            raise ValueError(
-                f"Incorrectly formatted jalr: funct3 should be 000, not {funct3.bin}"
-            )
-        return f"jalr {rd}, {rs1}, {imm12.int}"
-
-    if op_code == OP_CODES["jal"]:
-        # original imm=00000000000000100100,
-        # packed      =00001000010000000000
-        # bad          00001000010000000000
-        tmp = [
-            bits[0:1],  # 31
-            bits[12:20],  # 19:12
-            bits[11:12],  # 11
-            bits[1:11],  # 30:25
-        ]
-        imm20 = bits[0:1] + bits[12:20] + bits[11:12] + bits[1:11]
-        address = imm20.int * 2
-        if address % 4:
-            raise Exception("Disassembly bug: computed misaligned jump address.")
+    return encoder(instruction, args, labels, address)
+
+
+def line_to_word(line, labels={}, address=0):
+    """
+    Encode a ParsedLine as a 32-bit instruction, returned as an unsigned int.
+    """
+    return encode_instruction(line.instruction, line.args, labels, address)
+
+
+def line_to_bits(line, labels={}, address=0):
+    """
+    Compatibility wrapper around line_to_word, which returns a BitArray. Requires bitstring.
+    """
+    require_bitstring()
+    return BitArray(uint=line_to_word(line, labels, address), length=32)
+
+
+def funct3_table(mapping):
+    """ Turn a {"101": "op"} mapping from constants.py into an 8-entry list indexed by funct3. """
+    table = [None] * 8
+    for funct3, op in mapping.items():
+        table[int(funct3, 2)] = op
+    return table
+
+
+RTYPE_FUNCT3_TABLE = funct3_table(RTYPE_FUNCT3_MAPPING)
+ITYPE_FUNCT3_TABLE = funct3_table(ITYPE_FUNCT3_MAPPING)
+LTYPE_FUNCT3_TABLE = funct3_table(LTYPE_FUNCT3_MAPPING)
+STYPE_FUNCT3_TABLE = funct3_table(STYPE_FUNCT3_MAPPING)
+BTYPE_FUNCT3_TABLE = funct3_table(BTYPE_FUNCT3_MAPPING)
+
+# Instructions that are only distinguished by funct7, keyed by (funct3, funct7)
+RTYPE_FUNCT7_OPS = {
+    (0b000, 0b0000000): "add",
+    (0b000, 0b0100000): "sub",
+    (0b101, 0b0000000): "srl",
+    (0b101, 0b0100000): "sra",
+}
+ITYPE_FUNCT7_OPS = {
+    (0b101, 0b0000000): "srli",
+    (0b101, 0b0100000): "srai",
+}
+
+
+def sign_extend(value, bits):
+    if value & (1 << (bits - 1)):
+        return value - (1 << bits)
+    return value
+
+
+@dataclass
+class DecodedInstruction:
+    """ A disassembled instruction. Immediates are sign-extended, registers are numbers. """
+
+    op: str
+    format: str
+    rd: int = 0
+    rs1: int = 0
+    rs2: int = 0
+    imm: int = 0
+
+    def format_line(self, labels=None, address=None):
+        """
+        Format as assembly. Branch and jump targets are looked up in labels, which is either a
+        LabelIndex (needs the instruction's address) or a dict of {offset: name} that new
+        LABEL_n names are added to.
+        """
+        rd = REGISTER_NAMES[self.rd][-1]
+        rs1 = REGISTER_NAMES[self.rs1][-1]
+        rs2 = REGISTER_NAMES[self.rs2][-1]
+        if self.format == "R":
+            return f"{self.op} {rd}, {rs1}, {rs2}"
+        if self.format == "I":
+            return f"{self.op} {rd}, {rs1}, {self.imm}"
+        if self.format == "L":
+            return f"{self.op} {rd}, {self.imm}({rs1})"
+        if self.format == "S":
+            return f"{self.op} {rs2}, {self.imm}({rs1})"
+        if self.format == "U":
+            return f"{self.op} {rd}, {self.imm}"
+        if self.format == "halt":
+            return "halt"
+        if self.format == "B":
+            operands = f"{rs1}, {rs2}"
+        else:  # J
+            operands = rd
         if labels is None:
-            # TODO(avinash) - add flag that lets this pick out labels from an assembly file.
-            return f"jal {rd}, {address}"
-        if address not in labels:
-            labels[address] = f"LABEL_{len(labels)}"
-        return f"jal {rd}, {labels[address]} # {labels[address]} <- {address}"
-    raise ValueError(f"Unsupported opcode: {op_code.bin} ({op_code.uint})")
+            return f"{self.op} {operands}, {self.imm}"
+        if isinstance(labels, LabelIndex):
+            label = None if address is None else labels.at(address + self.imm)
+            if label is None:
+                return f"{self.op} {operands}, {self.imm}"
+            return f"{self.op} {operands}, {label}"
+        if self.imm not in labels:
+            labels[self.imm] = f"LABEL_{len(labels)}"
+        label = labels[self.imm]
+        return f"{self.op} {operands}, {label} # {label} <- {self.imm}"
+
+    def __str__(self):
+        return self.format_line()
+
+
+def decode_rtype(word, funct3, rd, rs1, rs2):
+    funct7 = word >> 25
+    op = RTYPE_FUNCT7_OPS.get((funct3, funct7))
+    if op is None:
+        if funct3 in (0b000, 0b101):
+            raise ValueError(f"Invalid r-type funct7: {funct7:07b}")
+        op = RTYPE_FUNCT3_TABLE[funct3]
+        if op is None:
+            raise ValueError(f"Invalid r-type funct3: {funct3:03b}")
+    return DecodedInstruction(op, "R", rd, rs1, rs2)
+
+
+def decode_itype(word, funct3, rd, rs1, rs2):
+    if funct3 == 0b101:
+        funct7 = word >> 25
+        op = ITYPE_FUNCT7_OPS.get((funct3, funct7))
+        if op is None:
+            raise ValueError(f"Invalid i-type srl/sra funct7: {funct7:07b}")
+    else:
+        op = ITYPE_FUNCT3_TABLE[funct3]
+        if op is None:
+            raise ValueError(f"Invalid i-type funct3: {funct3:03b}")
+    if op in ["slli", "srli", "srai"]:
+        return DecodedInstruction(op, "I", rd, rs1, imm=rs2)  # shamt lives where rs2 would be
+    return DecodedInstruction(op, "I", rd, rs1, imm=sign_extend(word >> 20, 12))
+
+
+def decode_ltype(word, funct3, rd, rs1, rs2):
+    op = LTYPE_FUNCT3_TABLE[funct3]
+    if op is None:
+        raise ValueError(f"Invalid load i-type funct3: {funct3:03b}")
+    return DecodedInstruction(op, "L", rd, rs1, imm=sign_extend(word >> 20, 12))
+
+
+def decode_stype(word, funct3, rd, rs1, rs2):
+    op = STYPE_FUNCT3_TABLE[funct3]
+    if op is None:
+        raise ValueError(f"Invalid s-type funct3: {funct3:03b}")
+    imm12 = ((word >> 25) << 5) | rd  # imm[4:0] lives where rd would be
+    return DecodedInstruction(op, "S", rs1=rs1, rs2=rs2, imm=sign_extend(imm12, 12))
+
+
+def decode_btype(word, funct3, rd, rs1, rs2):
+    op = BTYPE_FUNCT3_TABLE[funct3]
+    if op is None:
+        raise ValueError(f"Invalid b-type funct3: {funct3:03b}")
+    # imm[12|10:5] rs2 rs1 funct3 imm[4:1|11] opcode
+    imm = (
+        ((word >> 31) << 12)
+        | (((word >> 25) & 0x3F) << 5)
+        | (((word >> 8) & 0xF) << 1)
+        | (((word >> 7) & 0x1) << 11)
+    )
+    return DecodedInstruction(op, "B", rs1=rs1, rs2=rs2, imm=sign_extend(imm, 13))
+
+
+def decode_jal(word, funct3, rd, rs1, rs2):
+    # imm[20|10:1|11|19:12] rd opcode
+    imm = (
+        ((word >> 31) << 20)
+        | (((word >> 21) & 0x3FF) << 1)
+        | (((word >> 20) & 0x1) << 11)
+        | (((word >> 12) & 0xFF) << 12)
+    )
+    imm = sign_extend(imm, 21)
+    if imm % 4:
+        raise ValueError("Disassembly bug: computed misaligned jump address.")
+    return DecodedInstruction("jal", "J", rd, imm=imm)
+
+
+def decode_jalr(word, funct3, rd, rs1, rs2):
+    if funct3 != 0b000:
+        raise ValueError(
+            f"Incorrectly formatted jalr: funct3 should be 000, not {funct3:03b}"
+        )
+    return DecodedInstruction("jalr", "I", rd, rs1, imm=sign_extend(word >> 20, 12))
+
+
+def decode_lui(word, funct3, rd, rs1, rs2):
+    return DecodedInstruction("lui", "U", rd, imm=sign_extend(word >> 12, 20))
+
+
+def decode_auipc(word, funct3, rd, rs1, rs2):
+    return DecodedInstruction("auipc", "U", rd, imm=sign_extend(word >> 12, 20))
+
+
+# Indexed by the 7-bit opcode
+OP_CODE_DECODERS = [None] * 128
+OP_CODE_DECODERS[OP_CODE_VALUES["add"]] = decode_rtype
+OP_CODE_DECODERS[OP_CODE_VALUES["addi"]] = decode_itype
+OP_CODE_DECODERS[OP_CODE_VALUES["lw"]] = decode_ltype
+OP_CODE_DECODERS[OP_CODE_VALUES["sw"]] = decode_stype
+OP_CODE_DECODERS[OP_CODE_VALUES["beq"]] = decode_btype
+OP_CODE_DECODERS[OP_CODE_VALUES["jal"]] = decode_jal
+OP_CODE_DECODERS[OP_CODE_VALUES["jalr"]] = decode_jalr
+OP_CODE_DECODERS[OP_CODE_VALUES["lui"]] = decode_lui
+OP_CODE_DECODERS[OP_CODE_VALUES["auipc"]] = decode_auipc
+
+
+def decode_word(word):
+    """
+    Decode a 32-bit instruction (as an unsigned int) into a DecodedInstruction.
+    Raises ValueError if it isn't a valid instruction.
+    """
+    if word == 0:
+        return DecodedInstruction("halt", "halt")  # The assembler emits halt as an all-zero word
+    op_code = word & 0x7F
+    decoder = OP_CODE_DECODERS[op_code]
+    if decoder is None:
+        raise ValueError(f"Unsupported opcode: {op_code:07b} ({op_code})")
+    return decoder(
+        word,
+        (word >> 12) & 0x7,  # funct3
+        (word >> 7) & 0x1F,  # rd
+        (word >> 15) & 0x1F,  # rs1
+        (word >> 20) & 0x1F,  # rs2
+    )
+
+
+def bits_to_line(bits, labels=None, address=None):
+    """
+    Disassemble a single instruction, which can either be an int or a 32-bit BitArray. See
+    DecodedInstruction.format_line for labels/address.
+    """
+    if not isinstance(bits, int):
+        if bits.length != 32:
+            raise ValueError("instruction must be 32 bits")
+        bits = bits.uint
+    return decode_word(bits).format_line(labels, address)
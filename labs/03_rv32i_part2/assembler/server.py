@@ -0,0 +1,184 @@
+"""
+An optional long-lived assembler process, so that back-to-back builds (ex. several `make test_*`
+runs) don't each pay for starting Python and importing the assembler.
+
+    python3 ./assembler --server          # start listening (runs until stopped)
+    python3 ./assembler --server --stop   # stop a running server
+
+While a server is running, `python3 ./assembler ...` hands its arguments to the server instead of
+assembling in-process. If there's no server (or it has gone away), it just assembles normally.
+
+This module is imported on every run, so it should stay cheap to import: standard library only.
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import os.path as path
+import socket
+import socketserver
+import sys
+import tempfile
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+
+DEFAULT_SOCKET = os.environ.get(
+    "ASSEMBLER_SOCKET",
+    path.join(tempfile.gettempdir(), f"rv32i-assembler-{os.getuid()}.sock"),
+)
+
+ASSEMBLER_DIR = path.dirname(path.abspath(__file__))
+# Seconds to wait for a client to send its request. Clients send it as soon as they connect, this
+# is only so that one that never does can't hold up everyone else.
+REQUEST_TIMEOUT = 5
+# Settings the assembler reads from the environment. Requests use the client's, not the server's.
+FORWARDED_ENVIRONMENT = (
+    "ASSEMBLER_VERBOSE",
+    "ASSEMBLER_DISABLE_CACHE",
+    "ASSEMBLER_CACHE_DIR",
+    "ASSEMBLER_CACHE_MAX_BYTES",
+)
+
+
+def source_version():
+    """ Changes whenever any of the assembler's source files do. """
+    return [
+        (fn, os.stat(fn).st_mtime_ns)
+        for fn in sorted(glob.glob(path.join(ASSEMBLER_DIR, "*.py")))
+    ]
+
+
+def send(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode())
+
+
+def receive(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode())
+
+
+def forwarded_environment():
+    return {name: os.environ[name] for name in FORWARDED_ENVIRONMENT if name in os.environ}
+
+
+def request(argv, socket_path=DEFAULT_SOCKET):
+    """
+    Ask a running server to assemble with the given command line arguments. Prints the server's
+    output, and returns the exit code, or None if there's no usable server.
+    """
+    if not path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            send(sock, {"argv": argv, "cwd": os.getcwd(), "env": forwarded_environment()})
+            response = receive(sock)
+    except (OSError, ValueError):
+        return None
+    if response.get("stale"):
+        return None
+    sys.stdout.write(response["output"])
+    return response["exit_code"]
+
+
+class AssemblerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        message = self.server.message
+        output = io.StringIO()
+        exit_code = 0
+        # Each request runs in its own forked child, so changing directory and environment is safe
+        os.chdir(message["cwd"])
+        for name in FORWARDED_ENVIRONMENT:
+            os.environ.pop(name, None)
+        os.environ.update(message.get("env", {}))
+        with redirect_stdout(output), redirect_stderr(output):
+            try:
+                self.server.assemble(message["argv"])
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+        send(self.connection, {"exit_code": exit_code, "output": output.getvalue()})
+
+
+class AssemblerServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    def __init__(self, socket_path):
+        # Import everything up front, so forked children start warm
+        from main import main
+
+        self.assemble = main
+        self.version = source_version()
+        self.running = True
+        super().__init__(socket_path, AssemblerRequestHandler)
+
+    def verify_request(self, request, client_address):
+        # Runs in the server process before forking, so the child sees self.message.
+        request.settimeout(REQUEST_TIMEOUT)
+        try:
+            self.message = receive(request)
+        except (OSError, ValueError):
+            return False  # Gave up waiting, or it wasn't a request
+        request.settimeout(None)
+        if self.message.get("stop"):
+            send(request, {"stopped": True})
+            self.running = False
+            return False
+        # If the assembler has been edited since we started, we'd be assembling with stale code:
+        # tell the client to do it itself, and quit.
+        if source_version() != self.version:
+            send(request, {"stale": True})
+            self.running = False
+            return False
+        return True
+
+
+def serve(socket_path=DEFAULT_SOCKET):
+    if path.exists(socket_path):
+        os.remove(socket_path)
+    with AssemblerServer(socket_path) as server:
+        print(f"Assembler server listening on {socket_path}")
+        try:
+            while server.running:
+                server.handle_request()
+                server.collect_children()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+def stop(socket_path=DEFAULT_SOCKET):
+    """ Ask a running server to shut down. """
+    if not path.exists(socket_path):
+        print("No assembler server running.")
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            send(sock, {"stop": True})
+            receive(sock)
+    except (OSError, ValueError):
+        os.remove(socket_path)  # Nobody was listening
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="assembler --server")
+    parser.add_argument(
+        "--socket", default=DEFAULT_SOCKET, help="path of the Unix socket to listen on"
+    )
+    parser.add_argument(
+        "--stop", action="store_true", default=False, help="stop a running server"
+    )
+    args = parser.parse_args(argv)
+    if args.stop:
+        stop(args.socket)
+    else:
+        serve(args.socket)
@@ -0,0 +1,78 @@
+"""
+Instrumentation for the assembler: how long each phase of a build took, and what was in the program.
+
+    python3 ./assembler asm/fibonacci.s -o mem/fibonacci.memh --stats          # print JSON
+    python3 ./assembler asm/fibonacci.s -o mem/fibonacci.memh --stats out.json # or write it out
+
+The phases of a normal build are:
+    - parse: reading the files and splitting lines into labels, instructions and operands
+    - expand: assigning addresses to labels and expanding pseudo-instructions
+    - encode: turning instructions into machine code
+    - sourcemap: finding the nearest label for each instruction
+    - write: formatting words as hex (or binary) and writing the output files
+In --stream mode everything happens at once, so there's just "stream" and "fixups" (patching
+forward references at the end).
+"""
+
+from __future__ import annotations
+from typing import *
+
+import json
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from constants import INSTRUCTION_FORMATS
+
+
+class Stats:
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.mnemonics: Counter = Counter()  # real instructions, after pseudo-instruction expansion
+        self.pseudo: Counter = Counter()  # pseudo-instructions, before expansion
+        self.saved: Counter = Counter()  # instructions saved, by which optimization saved them
+        self.counters: Dict[str, Any] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """ Time a block of code. Timing the same phase more than once adds up. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def count_instructions(self, instructions: Iterable[str]):
+        self.mnemonics.update(instructions)
+
+    @property
+    def formats(self) -> Counter:
+        """ Instruction counts by format (R, I, L, S, B, J, U). """
+        formats: Counter = Counter()
+        for mnemonic, count in self.mnemonics.items():
+            formats[INSTRUCTION_FORMATS.get(mnemonic, mnemonic)] += count
+        return formats
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "total": round(sum(self.phases.values()), 6),
+            **self.counters,
+            "instructions": sum(self.mnemonics.values()),
+            "formats": dict(self.formats.most_common()),
+            "mnemonics": dict(self.mnemonics.most_common()),
+            "pseudo_instructions": dict(self.pseudo.most_common()),
+            "saved_instructions": dict(self.saved.most_common()),
+        }
+
+
+def write_stats(stats: Dict[str, Any], destination: str):
+    """ Write stats as JSON to a file, or to stdout if destination is "-". """
+    if destination == "-":
+        json.dump(stats, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    with open(destination, "w") as f:
+        json.dump(stats, f, indent=2)
+        f.write("\n")
@@ -0,0 +1,82 @@
+from __future__ import annotations
+from typing import *
+
+from bisect import bisect_right
+from collections.abc import Mapping
+
+
+class LabelIndex(Mapping):
+    """
+    Two-way lookups between labels and addresses.
+
+    Behaves like the {label: address} dict it was built from (so it can be passed anywhere the
+    label table is expected), but also keeps the addresses sorted so that finding the label at or
+    before an address is a binary search instead of a scan of every label.
+    """
+
+    def __init__(self, labels: Mapping[str, int] = {}):
+        self.labels: Dict[str, int] = dict(labels)
+
+        # If several labels share an address, the first one defined wins
+        by_address: Dict[int, str] = {}
+        for label, address in self.labels.items():
+            by_address.setdefault(int(address), label)
+        self.by_address = by_address
+        self.addresses: List[int] = sorted(by_address)
+        self.names: List[str] = [by_address[a] for a in self.addresses]
+
+    def __getitem__(self, label: str) -> int:
+        return self.labels[label]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.labels)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def at(self, address: int) -> Optional[str]:
+        """ The label defined exactly at address, if any. """
+        return self.by_address.get(address)
+
+    def nearest(self, address: int, default: str = "root") -> str:
+        """ The closest label at or before address. """
+        i = bisect_right(self.addresses, address) - 1
+        if i < 0:
+            return default
+        return self.names[i]
+
+
+# Where the assembler writes the sourcemap (relative to the lab directory) for GTKWave
+SOURCEMAP_PATH = "tests/gtkwave_filters/assembly_sourcemap.txt"
+
+
+class SourcemapEntry(NamedTuple):
+    address: int
+    line_number: int
+    label: str  # the nearest label at or before address
+
+
+def read_sourcemap(fn: str) -> Iterator[SourcemapEntry]:
+    """ The assembler's sourcemap (lines of `0000000C 6: func_eql`), one entry per instruction. """
+    with open(fn, "r") as f:
+        for line in f:
+            address, _, rest = line.partition(" ")
+            line_number, _, label = rest.partition(":")
+            if not line_number:
+                continue
+            yield SourcemapEntry(int(address, 16), int(line_number), label.strip())
+
+
+def sourcemap_labels(entries: Iterable[SourcemapEntry], default: str = "root") -> Dict[str, int]:
+    """
+    Where each label was defined, from a sourcemap: the sourcemap only has the nearest label for
+    each instruction, so a label starts wherever that changes. Instructions before the first label
+    are marked with default (like LabelIndex.nearest), which isn't a label.
+    """
+    labels: Dict[str, int] = {}
+    previous = default
+    for entry in entries:
+        if entry.label != previous:
+            labels.setdefault(entry.label, entry.address)
+            previous = entry.label
+    return labels
@@ -0,0 +1,64 @@
+"""
+Shared fixtures for the assembler's tests. Run them from labs/03_rv32i_part2 with `make test_python`
+(or `python3 -m pytest assembler/tests`).
+"""
+
+import glob
+import os
+import os.path as path
+import sys
+
+import pytest
+
+LAB_DIR = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+ASSEMBLER_DIR = path.join(LAB_DIR, "assembler")
+# The assembler's modules import each other by name, and disassembler.py/gtkwave_filter.py are
+# scripts in the lab directory
+for directory in (ASSEMBLER_DIR, LAB_DIR):
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+
+# Every example program that assembles (functions_ari doesn't)
+PROGRAMS = [
+    fn
+    for fn in sorted(glob.glob(path.join(LAB_DIR, "asm", "*.s")))
+    if path.basename(fn) not in ("_preamble.s", "functions_ari.s")
+]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """ A scratch lab directory to assemble in (the sourcemap is always written relative to it). """
+    os.makedirs(tmp_path / "tests" / "gtkwave_filters")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def assemble(workdir):
+    """
+    Run the assembler's command line on some source, returning its exit code. With no source, the
+    inputs are whatever is in flags (ex. for --link).
+    """
+    import main
+
+    def run(source, *flags, output="program.memh", fn="program.s"):
+        argv = ["--cache_dir", str(workdir / "cache"), *flags]
+        if source is not None:
+            with open(fn, "w") as f:
+                f.write(source)
+            argv.insert(0, fn)
+        if output:
+            argv += ["-o", output]
+        try:
+            main.main(argv)
+        except SystemExit as e:
+            return e.code or 0
+        return 0
+
+    return run
+
+
+def read_words(fn="program.memh"):
+    with open(fn) as f:
+        return [int(line[:8], 16) for line in f if line.strip()]
@@ -0,0 +1,76 @@
+import pytest
+
+from conftest import PROGRAMS, read_words
+from helpers import LineException
+from main import ParsedLine
+import rv32i
+
+np = pytest.importorskip("numpy")
+import batch
+
+
+def line(instruction, *args):
+    return ParsedLine("", 0, instruction, list(args))
+
+
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_matches_line_to_word(assemble, program):
+    with open(program) as f:
+        source = f.read()
+    assert assemble(source, output="scalar.memh") == 0
+    assert assemble(source, "--vectorized", output="vectorized.memh") == 0
+    assert read_words("vectorized.memh") == read_words("scalar.memh")
+    with open("vectorized.memh") as vectorized, open("scalar.memh") as scalar:
+        assert vectorized.read() == scalar.read()
+
+
+def test_encodes_every_format():
+    labels = {"top": 0, "bottom": 28}
+    lines = [
+        line("add", "a0", "a1", "a2"),
+        line("add", "a0", "a0", "-5"),  # GCC's missing i
+        line("lw", "a0", "-8(sp)"),
+        line("sw", "ra", "12(sp)"),
+        line("beq", "a0", "zero", "top"),
+        line("jal", "ra", "bottom"),
+        line("lui", "t0", "-1"),
+        line("srai", "a0", "a0", "3"),
+        line("halt"),
+    ]
+    words = batch.assemble_words(lines, labels, start_address=0)
+    assert words.dtype == np.uint32
+    assert list(words) == [
+        rv32i.line_to_word(l, labels, address=4 * i) for i, l in enumerate(lines)
+    ]
+
+
+@pytest.mark.parametrize("bad", [
+    line("addi", "a0", "a0", "2048"),
+    line("srai", "a0", "a0", "32"),
+    line("sw", "ra", "-2049(sp)"),
+    line("beq", "a0", "zero", "nowhere"),
+    line("addi", "a0", "x99", "1"),
+    line("frobnicate", "a0"),
+])
+def test_errors_name_the_line(bad):
+    lines = [line("addi", "a0", "zero", "1"), bad, line("halt")]
+    with pytest.raises(LineException) as e:
+        batch.assemble_words(lines, {})
+    assert e.value.line is bad
+
+
+def test_far_branches_are_out_of_range():
+    lines = [line("beq", "a0", "zero", "far")]
+    with pytest.raises(LineException, match="does not fit into 12 bits"):
+        batch.assemble_words(lines, {"far": 4096})
+
+
+def test_decode_reports_the_first_invalid_word():
+    words = [0x00100513, 0x00000000, 0xFFFFFFFF, 0x0000007F]
+    with pytest.raises(ValueError) as batch_error:
+        batch.disassemble_words(words)
+    with pytest.raises(ValueError) as scalar_error:
+        rv32i.decode_word(words[2])
+    assert batch_error.value.index == 2
+    assert str(batch_error.value) == str(scalar_error.value)
+    assert batch.disassemble_words(words[:2]) == ["addi a0, zero, 1", "halt"]
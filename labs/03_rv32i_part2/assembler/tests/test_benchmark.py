@@ -0,0 +1,55 @@
+from benchmark import compare, generate_program
+from main import AssemblyProgram
+
+BASELINE = {
+    "generated_10000": {
+        "instructions": 10000,
+        "assemble_per_second": 1000.0,
+        "disassemble_per_second": 2000.0,
+        "peak_rss_mb": 50.0,
+    },
+    "fibonacci.s": {"instructions": 40, "assemble_per_second": 1000.0},
+}
+
+
+def run(assemble, disassemble=2000.0, name="generated_10000", instructions=10000, peak=50.0):
+    return {
+        name: {
+            "instructions": instructions,
+            "assemble_per_second": assemble,
+            "disassemble_per_second": disassemble,
+            "peak_rss_mb": peak,
+        }
+    }
+
+
+def test_drops_within_the_threshold_pass():
+    assert compare(run(800.0), BASELINE, 0.2) == []
+    assert compare(run(5000.0), BASELINE, 0.2) == []
+
+
+def test_drops_past_the_threshold_are_reported():
+    regressions = compare(run(799.0, disassemble=1000.0), BASELINE, 0.2)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("generated_10000 assemble_per_second: 799 vs 1,000 (-20%)")
+    assert regressions[1].startswith("generated_10000 disassemble_per_second")
+    # A looser threshold lets the same run through
+    assert compare(run(799.0, disassemble=1000.0), BASELINE, 0.6) == []
+
+
+def test_only_throughputs_are_compared():
+    assert compare(run(1000.0, peak=500.0), BASELINE, 0.2) == []
+
+
+def test_small_and_new_programs_are_not_compared():
+    assert compare(run(1.0, name="fibonacci.s", instructions=40), BASELINE, 0.2) == []
+    assert compare(run(1.0, name="generated_20000", instructions=20000), BASELINE, 0.2) == []
+
+
+def test_generated_programs_assemble():
+    source = generate_program(500, seed=1)
+    assert source == generate_program(500, seed=1)
+    ap = AssemblyProgram()
+    lines = list(ap.expand(ap.tokenize(source.splitlines())))
+    assert len([p for p in lines if p.instruction]) == 500
+    assert {"L0", "L62"} <= set(ap.labels) and "L63" not in ap.labels
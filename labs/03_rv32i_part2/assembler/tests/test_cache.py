@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+import main
+from cache import BuildCache
+from conftest import read_words
+from symbols import SOURCEMAP_PATH
+
+SOURCE = "start: addi a0, zero, 1\nbne a0, zero, start\n"
+# The beq can't reach `far` in 12 bits, so it has to be relaxed
+FAR_BRANCH = "beq a0, a1, far\n" + "addi zero, zero, 0\n" * 1100 + "far:\naddi a0, a0, 1\n"
+
+
+def read(fn):
+    with open(fn) as f:
+        return f.read()
+
+
+def test_restores_identical_build(assemble, monkeypatch):
+    assert assemble(SOURCE) == 0
+    output, sourcemap = read("program.memh"), read(SOURCEMAP_PATH)
+    os.remove("program.memh")
+    os.remove(SOURCEMAP_PATH)
+    monkeypatch.setattr(main, "assemble", lambda args, files: pytest.fail("expected a cache hit"))
+    assert assemble(SOURCE) == 0
+    assert read("program.memh") == output
+    assert read(SOURCEMAP_PATH) == sourcemap
+
+
+def test_disable_relaxation_is_not_restored_from_a_relaxed_build(assemble):
+    assert assemble(FAR_BRANCH) == 0
+    assert assemble(FAR_BRANCH, "--disable_relaxation") != 0
+
+
+def test_stream_is_not_restored_from_a_relaxed_build(assemble):
+    assert assemble(FAR_BRANCH) == 0
+    assert assemble(FAR_BRANCH, "--stream") != 0
+
+
+def test_changed_source_misses(assemble):
+    assert assemble(SOURCE) == 0
+    assert assemble(SOURCE.replace("1", "2")) == 0
+    assert read_words()[0] == 0x00200513
+
+
+def test_flags_change_the_key(assemble):
+    assert assemble(SOURCE) == 0
+    assert assemble(SOURCE, "--disable_annotations") == 0
+    assert "//" not in read("program.memh")
+    assert assemble(SOURCE, output="program.memb") == 0
+    assert read("program.memb").split()[0] == f"{0x00100513:032b}"
+    assert assemble("mv a0, a0\n" + SOURCE) == 0
+    plain = read_words()
+    assert assemble("mv a0, a0\n" + SOURCE, "-O") == 0
+    assert len(read_words()) == len(plain) - 1
+    # Objects don't get the preamble either way, only -O sees --gcc
+    frame = "sw a5, -20(s0)\nlw a5, -20(s0)\n"
+    assert assemble(frame, "-O", output="program.rvo") == 0
+    hand_written = read("program.rvo")
+    assert assemble(frame, "-O", "--gcc", output="program.rvo") == 0
+    assert read("program.rvo") != hand_written
+    assert "lw a5, -20(s0)" not in read("program.rvo")
+
+
+def test_failed_builds_are_not_stored(assemble, workdir):
+    assert assemble("beq a0, zero, nowhere\n") != 0
+    assert not os.path.exists(workdir / "cache")
+
+
+def test_disable_cache(assemble, workdir):
+    assert assemble(SOURCE, "--disable_cache") == 0
+    assert not os.path.exists(workdir / "cache")
+
+
+def test_evicts_least_recently_used(tmp_path):
+    output = tmp_path / "program.memh"
+    output.write_bytes(b"x" * 100)
+    build_cache = BuildCache(str(tmp_path / "cache"), max_bytes=250)
+    for i, key in enumerate(["a", "b"]):
+        build_cache.store(key, str(output))
+        os.utime(tmp_path / "cache" / key, (i, i))
+    assert build_cache.restore("a", str(tmp_path / "restored"))  # a is now the most recent
+    build_cache.store("c", str(output))
+    assert sorted(os.listdir(tmp_path / "cache")) == ["a", "c"]
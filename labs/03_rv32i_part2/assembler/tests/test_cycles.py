@@ -0,0 +1,88 @@
+import json
+import os
+
+LOOP = """
+    li t0, 0
+loop:
+    addi t0, t0, 1
+    bne t0, a0, loop  # iterations: {}
+    halt
+"""
+
+
+def estimate(assemble, source):
+    assert assemble(source, "--cycles", "cycles.json") == 0
+    with open("cycles.json") as f:
+        return json.load(f)
+
+
+def test_annotated_loop(assemble):
+    result = estimate(assemble, LOOP.format(5))
+    # li, 5 times (addi + bne), 4 taken branches back to the top, halt
+    assert result["total"] == 3 + 5 * (3 + 3) + 4 * 1 + 4
+    (loop,) = result["loops"]
+    assert (loop["header"], loop["iterations"], loop["iterations_from"]) == ("loop", 5, "annotation")
+
+
+def test_inferred_loop(assemble):
+    source = """
+    li t0, 0
+    li t1, 10
+loop:
+    addi t0, t0, 1
+    blt t0, t1, loop
+    halt
+"""
+    (loop,) = estimate(assemble, source)["loops"]
+    assert (loop["iterations"], loop["iterations_from"]) == (10, "inferred")
+
+
+def test_calls_add_the_callee(assemble):
+    source = """
+    call f
+    call f
+    halt
+f:
+    addi a0, a0, 1
+    ret
+"""
+    result = estimate(assemble, source)
+    functions = {f["name"]: f for f in result["functions"]}
+    assert functions["f"]["cycles"] == 6
+    assert result["total"] == 3 + 3 + 4 + 2 * 6
+
+
+
+def test_zero_iterations_is_an_error(assemble, capsys):
+    assert assemble(LOOP.format(0), "--cycles", "cycles.json") != 0
+    assert "Error on line 5 of program.s (bne)" in capsys.readouterr().out
+    assert not os.path.exists("cycles.json")
+
+
+def test_unknown_loops_default_to_ten(assemble):
+    source = "loop:\n    lw t0, 0(a0)\n    beq t0, zero, loop\n    halt\n"
+    result = estimate(assemble, source)
+    (loop,) = result["loops"]
+    assert (loop["iterations"], loop["iterations_from"]) == (10, "assumed")
+    assert result["suggested_max_cycles"] == max(100, 2 * result["total"])
+
+
+def test_recursion_is_flagged(assemble):
+    source = """
+    call f
+    halt
+f:
+    beq a0, zero, done
+    addi a0, a0, -1
+    call f
+done:
+    ret
+"""
+    functions = {f["name"]: f for f in estimate(assemble, source)["functions"]}
+    assert functions["f"]["recursive"]
+
+
+def test_written_next_to_the_output(assemble):
+    assert assemble(LOOP.format(2), "--cycles") == 0
+    with open("program.cycles.json") as f:
+        assert json.load(f)["loops"][0]["iterations"] == 2
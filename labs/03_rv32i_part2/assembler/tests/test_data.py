@@ -0,0 +1,98 @@
+import os
+
+from conftest import read_words
+
+DATA = 0x30000000
+NOP = 0x00000013
+
+SOURCE = """
+.text
+main:
+    addi a0, zero, 1
+.section .rodata
+.align 2
+table:
+    .word 1, -1, main, after
+    .half 0x1234, 0x5678
+    .byte 1, 2
+    .align 2
+greeting:
+    .asciz "hi, #1"
+.data
+    .zero 3
+    .balign 4
+counter:
+    .word greeting
+.text
+after:
+    addi a0, a0, 2
+"""
+
+
+def test_lays_out_data(assemble):
+    assert assemble(SOURCE) == 0
+    assert read_words() == [0x00100513, 0x00250513, 0]
+    words = read_words("program.data.memh")
+    assert len(words) == 1024
+    assert words[:10] == [
+        1,
+        0xFFFFFFFF,
+        0,  # main
+        4,  # after
+        0x56781234,
+        0x00000201,
+        int.from_bytes(b"hi, ", "little"),
+        int.from_bytes(b"#1\0\0", "little"),  # the string, then the .zero
+        0,
+        DATA + 24,  # counter: .word greeting
+    ]
+    assert not any(words[10:])
+    with open("program.data.memh") as f:
+        annotations = [line.split("// ")[1].strip() for line in f if "//" in line]
+    assert annotations == [
+        f"{hex(DATA)}: table", f"{hex(DATA + 24)}: greeting", f"{hex(DATA + 36)}: counter"
+    ]
+
+
+def test_stream_lays_out_the_same_data(assemble):
+    assert assemble(SOURCE, output="whole.memh") == 0
+    assert assemble(SOURCE, "--stream", output="stream.memh") == 0
+    with open("whole.data.memh") as whole, open("stream.data.memh") as stream:
+        assert stream.read() == whole.read()
+
+
+def test_word_labels_use_final_code_addresses(assemble):
+    source = "beq a0, a1, far\n" + "nop\n" * 1100 + "far:\nnop\n.data\n.word far\n"
+    assert assemble(source) == 0
+    code = read_words()
+    assert read_words("program.data.memh")[0] == 4 * (len(code) - 2)  # relaxed, so one further
+
+
+def test_aligns_code_with_nops(assemble):
+    assert assemble("addi a0, zero, 1\n.align 4\naligned: addi a0, a0, 1\n.balign 8\nnop\n") == 0
+    assert read_words() == [0x00100513, NOP, NOP, NOP, 0x00150513, NOP, NOP, 0]
+
+
+def test_ignores_other_sections(assemble):
+    assert assemble(".section .comment\n.string \"GCC\"\n.text\nnop\n") == 0
+    assert not any(read_words("program.data.memh"))
+
+
+def test_errors(assemble):
+    assert assemble(".data\naddi a0, a0, 1\n") != 0
+    assert assemble(".data\n.zero 4097\n") != 0
+    assert assemble(".data\n.byte 256\n") != 0
+    assert assemble(".data\n.word nowhere\n") != 0
+    assert assemble(".data\n.balign 3\n") != 0
+    assert assemble(".balign 3\nnop\n") != 0
+    assert assemble(".align -1\nnop\n") != 0
+    assert not os.path.exists("program.memh")
+    assert not os.path.exists("program.data.memh")
+
+
+def test_cache_restores_data(assemble):
+    assert assemble(SOURCE) == 0
+    words = read_words("program.data.memh")
+    os.remove("program.data.memh")
+    assert assemble(SOURCE) == 0
+    assert read_words("program.data.memh") == words
@@ -0,0 +1,85 @@
+import json
+
+from conftest import read_words
+
+PROGRAM = """\
+main:
+    li a0, 3
+    call double
+    beq a0, zero, main
+    j end
+    addi a0, a0, 100      # after a j, nothing jumps here
+end:
+    ret
+double:
+    add a0, a0, a0
+    ret
+unused:
+    addi a0, a0, 1        # never called
+    ret
+"""
+
+LIVE = """\
+main:
+    li a0, 3
+    call double
+    beq a0, zero, main
+    j end
+end:
+    ret
+double:
+    add a0, a0, a0
+    ret
+"""
+
+
+def test_removes_unreachable_code(assemble):
+    # The halt at the end goes too, nothing gets past the rets
+    assert assemble(LIVE, "--dce", output="live.memh", fn="live.s") == 0
+    assert assemble(PROGRAM, "--dce") == 0
+    assert read_words() == read_words("live.memh")
+
+
+def test_without_dce_nothing_is_removed(assemble):
+    assert assemble(PROGRAM) == 0
+    assert len(read_words()) == 11
+
+
+def test_keeps_code_whose_address_is_taken(assemble):
+    source = PROGRAM + ".data\nhandlers:\n    .word unused\n"
+    assert assemble(source, "--dce") == 0
+    assert len(read_words()) == 9  # only the addi after the j (and the halt) go
+
+
+def test_keeps_code_reached_by_numeric_offsets(assemble):
+    source = "beq a0, a1, 8\nj end\naddi a0, a0, 1\nend:\nret\n"
+    assert assemble(source, "--dce") == 0
+    assert len(read_words()) == 4  # the beq skips the j to the addi
+
+
+def test_cfg_json(assemble):
+    assert assemble(PROGRAM, "--cfg", "cfg.json") == 0
+    with open("cfg.json") as f:
+        graph = json.load(f)
+    blocks = {", ".join(block["labels"]) or block["index"]: block for block in graph["blocks"]}
+    assert not blocks["unused"]["reachable"]
+    assert blocks["main"]["reachable"] and blocks["double"]["reachable"]
+    assert blocks["double"]["successors"] == []  # returns go nowhere
+    # beq a0, zero, main is the only loop
+    main = blocks["main"]["index"]
+    assert [loop["to"] for loop in graph["loops"]] == [main]
+
+
+def test_cfg_dot(assemble):
+    assert assemble(PROGRAM, "--cfg", "cfg.dot") == 0
+    with open("cfg.dot") as f:
+        dot = f.read()
+    assert dot.startswith("digraph cfg {")
+    assert "[color=red]" in dot  # the loop back to main
+    assert "style=dashed" in dot  # unreachable blocks
+
+
+def test_saved_instructions(assemble):
+    assert assemble(PROGRAM, "--dce", "--stats", "stats.json") == 0
+    with open("stats.json") as f:
+        assert json.load(f)["saved_instructions"] == {"dead_code": 4}
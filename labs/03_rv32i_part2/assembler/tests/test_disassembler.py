@@ -0,0 +1,99 @@
+import io
+import os.path as path
+import struct
+import sys
+
+import pytest
+
+import disassembler
+from conftest import PROGRAMS, read_words
+from symbols import LabelIndex
+
+
+def listing(words, vectorized=False, labels=True):
+    index = None
+    if labels:
+        targets, count = disassembler.branch_targets(words, vectorized=vectorized)
+        index = LabelIndex(disassembler.recover_labels(targets, count))
+    out = io.StringIO()
+    disassembler.disassemble(words, out, index, vectorized=vectorized)
+    return out.getvalue()
+
+
+def test_disassembles_memh(assemble, monkeypatch):
+    source = "start: addi a0, zero, 1\nbeq a0, zero, start\nlw a1, 4(sp)\n"
+    assert assemble(source) == 0
+    monkeypatch.setattr(sys, "argv", ["disassembler", "program.memh", "-o", "program.dis"])
+    disassembler.main()
+    with open("program.dis") as f:
+        lines = f.read().splitlines()
+    assert lines == ["addi a0, zero, 1", "beq a0, zero, -4", "lw a1, 4(sp)", "halt"]
+    assert len(read_words()) == len(lines)
+
+
+def test_raw_words(tmp_path):
+    words = [0x00100513, 0xFFF50513, 0x0000006F]
+    fn = tmp_path / "dump.bin"
+    fn.write_bytes(struct.pack("<3I", *words))
+    assert list(disassembler.read_raw_words(str(fn))) == words
+
+
+def test_raw_input_to_stdout(tmp_path, monkeypatch, capsys):
+    fn = tmp_path / "dump.bin"
+    fn.write_bytes(struct.pack("<2I", 0x00100513, 0x00A00593))
+    monkeypatch.setattr(sys, "argv", ["disassembler", str(fn), "--raw"])
+    disassembler.main()
+    assert capsys.readouterr().out.splitlines() == ["addi a0, zero, 1", "addi a1, zero, 10"]
+
+
+def test_blank_lines_are_skipped(tmp_path):
+    fn = tmp_path / "program.memh"
+    fn.write_text("00100513\n\n  \n00a00593 // li a1, 10\n")
+    assert list(disassembler.read_text_words(str(fn), "hex")) == [0x00100513, 0x00A00593]
+
+
+@pytest.mark.parametrize("fn", PROGRAMS, ids=path.basename)
+def test_listing_reassembles_to_the_same_words(assemble, fn):
+    with open(fn) as f:
+        assert assemble(f.read()) == 0
+    words = read_words()
+    assert assemble(listing(words), "--disable_relaxation") == 0
+    assert read_words()[:-1] == words  # the listing ends with the halt, and gets another one
+
+
+@pytest.mark.parametrize("fn", PROGRAMS, ids=path.basename)
+@pytest.mark.parametrize("labels", [False, True])
+def test_vectorized_matches_scalar(assemble, monkeypatch, fn, labels):
+    pytest.importorskip("numpy")
+    # Small chunks, so programs span several of them
+    chunks = disassembler.chunks
+    monkeypatch.setattr(disassembler, "chunks", lambda words: chunks(words, 7))
+    with open(fn) as f:
+        assert assemble(f.read()) == 0
+    words = read_words()
+    assert listing(words, vectorized=True, labels=labels) == listing(words, labels=labels)
+
+
+def test_recovered_labels(assemble):
+    assert assemble("start: beq a0, zero, end\nj start\nend: addi a0, a0, 1\n") == 0
+    assert listing(read_words()).splitlines() == [
+        "LABEL_0:",
+        "beq a0, zero, LABEL_1",
+        "jal zero, LABEL_0",
+        "LABEL_1:",
+        "addi a0, a0, 1",
+        "halt",
+    ]
+
+
+def test_labels_from_the_sourcemap(assemble, monkeypatch, capsys):
+    assert assemble("main: li a0, 3\nloop: addi a0, a0, -1\nbnez a0, loop\n") == 0
+    monkeypatch.setattr(sys, "argv", ["disassembler", "program.memh", "--sourcemap"])
+    disassembler.main()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:4] == ["main:", "addi a0, zero, 3", "loop:", "addi a0, a0, -1"]
+    assert lines[4] == "bne a0, zero, loop"
+
+
+def test_targets_outside_the_program_stay_numeric():
+    assert disassembler.recover_labels({-8, 2, 4, 400}, 3) == {"LABEL_0": 4}
@@ -0,0 +1,102 @@
+import json
+import os.path as path
+import subprocess
+import sys
+
+import gtkwave_filter
+from conftest import LAB_DIR
+from symbols import SOURCEMAP_PATH
+
+SOURCE = """\
+main:
+    li a0, 1  # the first argument
+    jal ra, func
+func:
+    addi a0, a0, 1
+"""
+
+
+def test_translate():
+    assert gtkwave_filter.translate("00100513\n") == "addi a0, zero, 1"
+    assert gtkwave_filter.translate("xxxxxxxx") == "< X >"
+    assert gtkwave_filter.translate("0513") == "0513"
+    assert gtkwave_filter.translate("ffffffff") == " > ??? < "
+
+
+def test_translate_batch():
+    batch = gtkwave_filter.translate_batch([b"00100513", b"xxxxxxxx", b"ffffffff"])
+    assert batch == b"addi a0, zero, 1\n< X >\n > ??? < \n"
+
+
+def test_filter_translates_every_line():
+    words = ["00100513", "00a00593", "zzzzzzzz", "ffffffff"] * 5000
+    # The last value doesn't end with a newline
+    stdin = ("\n".join(words)).encode("ascii")
+    result = subprocess.run(
+        [sys.executable, path.join(LAB_DIR, "gtkwave_filter.py")],
+        input=stdin,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    lines = result.stdout.decode("ascii").splitlines()
+    assert lines[:4] == ["addi a0, zero, 1", "addi a1, zero, 10", "zzzzzzzz", " > ??? < "]
+    assert lines == lines[:4] * 5000
+    assert result.stderr == b""
+
+
+def test_table_shows_source_lines(assemble):
+    assert assemble(SOURCE) == 0
+    table = gtkwave_filter.load_table("program.memh", SOURCEMAP_PATH)
+    assert table[0x00100513] == "addi a0, zero, 1  # line 2: li a0, 1 (main)"
+    assert table[0x004000EF] == "jal ra, func  # line 3: jal ra, func (main)"
+    assert table[0x00150513] == "addi a0, a0, 1  # line 5: addi a0, a0, 1 (func)"
+    assert gtkwave_filter.translate("004000ef", table) == "jal ra, func  # line 3: jal ra, func (main)"
+
+
+def test_table_without_sourcemap(assemble):
+    assert assemble(SOURCE) == 0
+    table = gtkwave_filter.load_table("program.memh", None)
+    assert table[0x004000EF] == "jal ra, 4  # line 3: jal ra, func"
+
+
+def test_sourcemap_for_another_program_is_ignored(assemble):
+    assert assemble(SOURCE) == 0
+    assert assemble("nop\nnop\n", output="other.memh") == 0
+    table = gtkwave_filter.load_table("program.memh", SOURCEMAP_PATH)
+    # Without labels, but the .memh's own annotations still give the source
+    assert table[0x00100513] == "addi a0, zero, 1  # line 2: li a0, 1"
+
+
+def test_repeated_words_list_every_line(assemble):
+    assert assemble("nop\nnop\n.align 4\nnop\n") == 0
+    table = gtkwave_filter.load_table("program.memh", SOURCEMAP_PATH)
+    assert table[0x00000013] == "addi zero, zero, 0  # lines 1, 2, 3, ...: nop / .align 4 (root)"
+
+
+def test_table_is_saved_next_to_the_program(assemble):
+    assert assemble(SOURCE) == 0
+    table = gtkwave_filter.load_table("program.memh", SOURCEMAP_PATH)
+    with open("program.gtkwave.json") as f:
+        saved = json.load(f)
+    assert saved["table"]["00100513"] == table[0x00100513]
+    # A saved table for the same files is used as is
+    saved["table"]["00100513"] = "from the saved table"
+    with open("program.gtkwave.json", "w") as f:
+        json.dump(saved, f)
+    assert gtkwave_filter.load_table("program.memh", SOURCEMAP_PATH)[0x00100513] == "from the saved table"
+    # and rebuilt once the program changes
+    assert assemble(SOURCE + "    ret\n") == 0
+    assert gtkwave_filter.load_table("program.memh", SOURCEMAP_PATH)[0x00100513] == table[0x00100513]
+
+
+def test_tables_from_older_versions_are_rebuilt(assemble):
+    assert assemble(SOURCE) == 0
+    table = gtkwave_filter.load_table("program.memh", SOURCEMAP_PATH)
+    with open("program.gtkwave.json") as f:
+        saved = json.load(f)
+    saved["version"] -= 1
+    saved["table"]["00100513"] = "addi a0, zero, 1  # line 2: main"
+    with open("program.gtkwave.json", "w") as f:
+        json.dump(saved, f)
+    assert gtkwave_filter.load_table("program.memh", SOURCEMAP_PATH) == table
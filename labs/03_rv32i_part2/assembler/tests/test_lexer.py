@@ -0,0 +1,47 @@
+import pytest
+
+import lexer
+from helpers import LineException
+from lexer import Memory, register, tokenize_line
+
+
+@pytest.mark.parametrize("line, tokens", [
+    ("", None),
+    ("   # just a comment", None),
+    ("loop:", ("loop", "", [])),
+    ("loop: addi a0, a0, -1  # count down", ("loop", "addi", [register("a0"), register("a0"), -1])),
+    ("\tsw ra, 12(sp)", (None, "sw", [register("ra"), Memory(12, register("sp"))])),
+    ("lw a0, (a1)", (None, "lw", [register("a0"), Memory(0, register("a1"))])),
+    ("jal ra, main", (None, "jal", [register("ra"), "main"])),
+    ("ret", (None, "ret", [])),
+    (".globl main", (None, ".globl", ["main"])),
+    ("main.L2: nop", ("main.L2", "nop", [])),
+])
+def test_tokenize_line(line, tokens):
+    assert tokenize_line(line) == tokens
+
+
+@pytest.mark.parametrize("text, value", [
+    ("12", 12), ("-12", -12), ("+3", 3), ("0", 0),
+    ("0x1F", 31), ("-0x10", -16), ("0b101", 5), ("010", 8),
+])
+def test_numbers(text, value):
+    assert lexer.parse_operand(text) == value
+
+
+def test_invalid_number():
+    with pytest.raises(LineException):
+        lexer.parse_number("09")
+
+
+def test_registers_compare_by_number():
+    assert register("x10") == register("a0") == register(10)
+    assert str(register(10)) == "a0" and str(register("x10")) == "x10"
+    assert register("s0") == register("fp")
+    assert len({register("x8"), register("s0"), register("fp")}) == 1
+
+
+def test_unknown_names_stay_strings():
+    assert lexer.parse_operand("x99") == "x99"
+    assert lexer.parse_operand("4(nowhere)") == "4(nowhere)"
+    assert str(Memory(-4, register("sp"))) == "-4(sp)"
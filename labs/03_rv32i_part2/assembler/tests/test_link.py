@@ -0,0 +1,92 @@
+import os
+import os.path as path
+import shutil
+
+from conftest import LAB_DIR, read_words
+from symbols import SOURCEMAP_PATH
+
+MAIN = """\
+main:
+    addi sp, sp, -4
+    sw ra, 0(sp)
+    la a0, message
+    call length
+    lw ra, 0(sp)
+    addi sp, sp, 4
+    ret
+.data
+message:
+    .asciz "hello"
+"""
+
+LENGTH = """\
+.text
+length:
+    mv t1, a0
+.Lloop:
+    lbu t0, 0(t1)
+    beq t0, zero, .Ldone
+    addi t1, t1, 1
+    j .Lloop
+.Ldone:
+    sub a0, t1, a0
+    ret
+"""
+
+
+def read(fn):
+    with open(fn) as f:
+        return f.read()
+
+
+def test_linked_program_matches_one_big_build(assemble):
+    preamble = read(path.join(LAB_DIR, "asm", "_preamble.s"))
+    assert assemble(preamble, fn="preamble.s", output="preamble.rvo") == 0
+    assert assemble(MAIN, fn="main.s", output="main.rvo") == 0
+    assert assemble(LENGTH, fn="length.s", output="length.rvo") == 0
+    objects = ["preamble.rvo", "main.rvo", "length.rvo"]
+    assert assemble(None, "--link", *objects, output="linked.memh") == 0
+
+    assert assemble(preamble + "\n" + MAIN + LENGTH, output="whole.memh") == 0
+    assert read_words("linked.memh") == read_words("whole.memh")
+    assert read_words("linked.data.memh") == read_words("whole.data.memh")
+
+
+def test_local_labels_are_private(assemble):
+    assert assemble(LENGTH, fn="a.s", output="a.rvo") == 0
+    assert assemble(LENGTH.replace("length", "other"), fn="b.s", output="b.rvo") == 0
+    assert assemble(None, "--link", "a.rvo", "b.rvo") == 0
+
+
+def test_duplicate_labels_are_an_error(assemble):
+    assert assemble(LENGTH, fn="a.s", output="a.rvo") == 0
+    assert assemble(LENGTH, fn="b.s", output="b.rvo") == 0
+    assert assemble(None, "--link", "a.rvo", "b.rvo") != 0
+
+
+def test_undefined_labels_are_an_error(assemble):
+    assert assemble(MAIN, fn="main.s", output="main.rvo") == 0
+    assert assemble(None, "--link", "main.rvo") != 0
+
+
+def test_linking_the_preamble_matches_gcc_mode(assemble):
+    os.mkdir("asm")
+    shutil.copy(path.join(LAB_DIR, "asm", "_preamble.s"), "asm")
+    assert assemble(None, "asm/_preamble.s", output="asm/_preamble.rvo") == 0
+    assert assemble(MAIN + LENGTH, fn="main.s", output="main.rvo") == 0
+    assert assemble(None, "--link", "asm/_preamble.rvo", "main.rvo", output="linked.memh") == 0
+    linked_sourcemap = read(SOURCEMAP_PATH)
+    assert assemble(MAIN + LENGTH, "--gcc", fn="main.s", output="gcc.memh") == 0
+    assert read_words("linked.memh") == read_words("gcc.memh")
+    assert read_words("linked.data.memh") == read_words("gcc.data.memh")
+    assert read(SOURCEMAP_PATH) == linked_sourcemap  # lines are numbered in each file either way
+
+
+def test_gcc_objects_link_the_preamble_instead_of_including_it(assemble):
+    os.mkdir("asm")
+    shutil.copy(path.join(LAB_DIR, "asm", "_preamble.s"), "asm")
+    assert assemble(MAIN + LENGTH, "--gcc", fn="main.s", output="main.rvo") == 0
+    assert assemble(None, "asm/_preamble.s", output="asm/_preamble.rvo") == 0
+    assert assemble(None, "--link", "asm/_preamble.rvo", "main.rvo", output="linked.memh") == 0
+    assert assemble(MAIN + LENGTH, "--gcc", fn="main.s", output="gcc.memh") == 0
+    assert read_words("linked.memh") == read_words("gcc.memh")
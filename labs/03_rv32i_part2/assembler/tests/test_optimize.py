@@ -0,0 +1,163 @@
+import json
+
+import pytest
+
+from conftest import read_words
+from main import AssemblyProgram
+import rv32i
+
+
+def optimized(source, gcc=False):
+    ap = AssemblyProgram()
+    ap.parsed_lines.extend(ap.expand(ap.tokenize(source.strip().splitlines())))
+    ap.optimize(gcc=gcc)
+    labels = ap.index_labels()
+    return [
+        rv32i.bits_to_line(rv32i.line_to_word(parsed, labels, 4 * i), labels, 4 * i)
+        for i, parsed in enumerate(ap.parsed_lines)
+    ]
+
+
+def test_removes_redundant_instructions():
+    assert optimized("""
+    mv a5, a5
+    sw a5, -20(sp)
+    lw a5, -20(sp)
+    j next
+next:
+    addi a0, a0, 1
+""") == ["sw a5, -20(sp)", "addi a0, a0, 1"]
+
+
+def test_reload_into_another_register_is_a_move():
+    assert optimized("sw a5, 8(sp)\nlw a4, 8(sp)\n") == ["sw a5, 8(sp)", "addi a4, a5, 0"]
+
+
+@pytest.mark.parametrize("gcc", [False, True])
+def test_s0_is_only_a_frame_pointer_for_gcc(gcc):
+    lines = optimized("sw a5, 0(s0)\nlw a5, 0(s0)\n", gcc=gcc)
+    # Hand-written code can keep an I/O address in s0, where loads can return something else
+    expected = ["sw a5, 0(fp)"] if gcc else ["sw a5, 0(fp)", "lw a5, 0(fp)"]
+    assert lines == expected
+
+
+def test_numeric_offsets_follow_removed_code():
+    lines = optimized("""
+    bne a0, a1, 12
+    mv a5, a5
+    addi a0, a0, 1
+    addi a0, a0, 2
+    jal zero, -12
+""")
+    assert lines == [
+        "bne a0, a1, 8",
+        "addi a0, a0, 1",
+        "addi a0, a0, 2",
+        "jal zero, -8",
+    ]
+
+
+def test_windows_dont_span_numeric_targets():
+    # Jumping straight to the lw skips the sw, so the value has to come from memory
+    lines = optimized("""
+    beq a0, a1, 8
+    sw a5, -4(sp)
+    lw a5, -4(sp)
+""")
+    assert lines == ["beq a0, a1, 8", "sw a5, -4(sp)", "lw a5, -4(sp)"]
+
+
+def test_keeps_what_it_cant_prove_redundant():
+    source = """
+    nop
+    sw a5, 8(sp)
+    lw a5, 12(sp)
+    sw a5, 0(a0)
+    lw a5, 0(a0)
+    beq a0, a1, skip
+    addi a0, a0, 1
+skip:
+    addi a0, a0, 2
+"""
+    assert optimized(source) == [
+        "addi zero, zero, 0",
+        "sw a5, 8(sp)",
+        "lw a5, 12(sp)",
+        "sw a5, 0(a0)",  # a0 could point at memory-mapped I/O
+        "lw a5, 0(a0)",
+        "beq a0, a1, skip",
+        "addi a0, a0, 1",
+        "addi a0, a0, 2",
+    ]
+
+
+def test_windows_dont_span_labels():
+    # Jumping to `reload` skips the sw, so the value has to come from memory
+    assert optimized("""
+    sw a5, -4(sp)
+reload:
+    lw a5, -4(sp)
+    j reload
+""") == ["sw a5, -4(sp)", "lw a5, -4(sp)", "jal zero, reload"]
+
+
+def test_labels_move_past_removed_code():
+    assert optimized("""
+    j loop
+gone:
+    mv a0, a0
+loop:
+    mv a1, a1
+    addi a0, a0, 1
+    bne a0, zero, gone
+""") == ["addi a0, a0, 1", "bne a0, zero, gone"]  # then `j loop` goes to the next instruction
+
+
+def test_command_line(assemble):
+    source = "mv a5, a5\naddi a0, a0, 1\nmv a5, a5\n"
+    assert assemble(source, "-O", "--stats", "stats.json") == 0
+    assert read_words() == [0x00150513, 0]
+    with open("stats.json") as f:
+        assert json.load(f)["peephole"] == {"addi_zero": 2}
+    assert assemble(source, "-O", "--stream") == 2
+
+
+def test_constants_are_reused():
+    assert optimized("li t0, 0x10000000\nli t1, 0x10000004\nli t0, 0x10000000\n") == [
+        "lui t0, 65536",
+        "addi t1, t0, 4",
+    ]
+
+
+def test_constants_are_forgotten_at_labels_and_calls():
+    assert optimized("""
+    li t0, 0x10000000
+    jal ra, function
+    li t0, 0x10000000
+function:
+    li t1, 0x10000004
+    ret
+""") == [
+        "lui t0, 65536",
+        "jal ra, function",
+        "lui t0, 65536",
+        "lui t1, 65536",
+        "addi t1, t1, 4",
+        "jalr zero, ra, 0",
+    ]
+
+
+def test_overwritten_constants_are_forgotten():
+    assert optimized("li t0, 0x10000000\nlw t0, 0(sp)\nli t0, 0x10000000\n") == [
+        "lui t0, 65536",
+        "lw t0, 0(sp)",
+        "lui t0, 65536",
+    ]
+
+
+def test_saved_instructions(assemble):
+    source = "li t0, 0x10000000\nli t1, 0x10000004\nli t0, 0x10000000\n"
+    assert assemble(source, "-O", "--stats", "stats.json") == 0
+    with open("stats.json") as f:
+        # Both t0s are a lone lui, t1 is one addi instead of two, and the reload is dropped
+        assert json.load(f)["saved_instructions"] == {"li": 2, "constants": 2}
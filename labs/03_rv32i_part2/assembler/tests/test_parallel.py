@@ -0,0 +1,46 @@
+import os
+import shutil
+
+import main
+from conftest import PROGRAMS, read_words
+
+
+def run(*argv):
+    try:
+        main.main(list(argv))
+    except SystemExit as e:
+        return e.code or 0
+    return 0
+
+
+def test_directory_matches_single_file_builds(assemble, workdir, capsys):
+    os.mkdir("asm")
+    for fn in PROGRAMS[:4]:
+        shutil.copy(fn, "asm")
+    with open("asm/_preamble.s", "w") as f:
+        f.write("not an instruction\n")
+    assert run("asm", "-j", "2", "--cache_dir", str(workdir / "cache")) == 0
+    assert "Assembled 4/4 files" in capsys.readouterr().out
+    assert not os.path.exists("asm/_preamble.memh")
+    for fn in PROGRAMS[:4]:
+        name = os.path.splitext(os.path.basename(fn))[0]
+        with open(fn) as f:
+            assert assemble(f.read(), "--disable_cache") == 0
+        assert read_words(f"asm/{name}.memh") == read_words()
+
+
+def test_failures_are_reported(workdir, capsys):
+    with open("good.s", "w") as f:
+        f.write("addi a0, zero, 1\n")
+    with open("bad.s", "w") as f:
+        f.write("beq a0, zero, nowhere\n")
+    assert run("good.s", "bad.s", "--disable_cache") == 1
+    out = capsys.readouterr().out
+    assert "FAILED" in out and "nowhere" in out
+    assert "Assembled 1/2 files" in out
+    assert read_words("good.memh")[0] == 0x00100513
+    assert not os.path.exists("bad.memh")
+
+
+def test_output_needs_a_single_input(workdir):
+    assert run("a.s", "b.s", "-o", "program.memh") == 2
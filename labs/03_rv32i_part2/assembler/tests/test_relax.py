@@ -0,0 +1,137 @@
+import pytest
+
+import relax
+import rv32i
+from conftest import read_words
+from lexer import Relocation, register
+from main import ParsedLine
+
+FAR = 0x00250513  # addi a0, a0, 2
+NOP = 0x00000013
+AIM = 0x00150513  # addi a0, a0, 1
+
+
+def jal_offset(word):
+    offset = (
+        (word >> 31) << 20
+        | ((word >> 12) & 0xFF) << 12
+        | ((word >> 20) & 1) << 11
+        | ((word >> 21) & 0x3FF) << 1
+    )
+    return offset - (1 << 21) if offset & (1 << 20) else offset
+
+
+def far_branch(before_align=0, align="", padding=1100):
+    return (
+        "beq a0, a1, far\n"
+        + "nop\n" * before_align
+        + align
+        + "aligned:\naddi a0, a0, 1\n"
+        + "nop\n" * padding
+        + "far:\naddi a0, a0, 2\n"
+    )
+
+
+def test_far_branch_is_relaxed(assemble):
+    assert assemble(far_branch()) == 0
+    words = read_words()
+    assert words[0] == 0x00B51463  # bne a0, a1, 8 skips over the jal
+    assert 4 + jal_offset(words[1]) == 4 * words.index(FAR)
+
+
+def test_near_branch_is_left_alone(assemble):
+    assert assemble(far_branch(padding=10)) == 0
+    assert read_words()[0] & 0x7F == 0x63  # still a single branch
+
+
+def test_backward_branch_is_relaxed(assemble):
+    assert assemble("far: addi a0, a0, 2\n" + "nop\n" * 1100 + "bne a0, zero, far\n") == 0
+    words = read_words()
+    assert words[-3] == 0x00050463  # beq a0, zero, 8
+    assert 4 * (len(words) - 2) + jal_offset(words[-2]) == 0
+
+
+def test_alignment_survives_relaxation(assemble):
+    # The .align needs no padding until the beq grows into two instructions
+    for before_align in range(4):
+        assert assemble(far_branch(before_align, "    .align 4\n")) == 0
+        words = read_words()
+        assert words.index(AIM) % 4 == 0
+        assert set(words[1 + before_align + 1:words.index(AIM)]) <= {NOP}
+        assert 4 + jal_offset(words[1]) == 4 * words.index(FAR)
+
+
+def test_alignment_survives_dead_code_elimination(assemble):
+    source = "jal zero, start\n" + "addi a1, a1, 1\n" * 2 + "start:\n" + far_branch(0, "    .align 4\n")
+    assert assemble(source, "--dce") == 0
+    words = read_words()
+    assert words.index(AIM) % 4 == 0
+    assert 0x00158593 not in words  # addi a1, a1, 1 was removed
+
+
+def test_alignment_survives_the_optimizer(assemble):
+    source = "mv a5, a5\n" * 3 + far_branch(0, "    .align 4\n")
+    assert assemble(source, "-O") == 0
+    words = read_words()
+    assert words.index(AIM) % 4 == 0
+    assert 0x00078793 not in words  # mv a5, a5 was removed
+
+
+@pytest.mark.parametrize("flag", ["-O", "--dce"])
+def test_alignment_without_relaxation(assemble, flag):
+    # Nothing needs relaxing, but -O or --dce still moves the code after the .align
+    source = "jal zero, start\nmv a5, a5\nmv a5, a5\nstart:\n" + far_branch(0, "    .align 4\n", 10)
+    assert assemble(source, flag, "--disable_relaxation") == 0
+    words = read_words()
+    assert words.index(AIM) % 4 == 0
+    assert 0x00078793 not in words  # mv a5, a5 was removed
+
+
+def test_growing_moves_other_branches_out_of_range(assemble):
+    # The bne can just reach back (-4096) until the beq in between grows
+    source = "back: nop\nbeq a0, a1, far\n" + "nop\n" * 1022 + "bne a0, a1, back\nfar: nop\n"
+    assert assemble(source, "--stats", "stats.json") == 0
+    with open("stats.json") as f:
+        assert '"relaxed": 2' in f.read()
+
+
+def test_out_of_range_without_relaxation(assemble):
+    assert assemble(far_branch(), "--disable_relaxation") != 0
+    assert assemble(far_branch(), "--stream") != 0
+
+
+def test_vectorized_matches_scalar(assemble):
+    pytest.importorskip("numpy")
+    assert assemble(far_branch(), output="scalar.memh") == 0
+    assert assemble(far_branch(), "--vectorized", "--disable_cache", output="vectorized.memh") == 0
+    assert read_words("vectorized.memh") == read_words("scalar.memh")
+
+
+def line(instruction, *args):
+    return ParsedLine("", 0, instruction, list(args))
+
+
+@pytest.mark.parametrize("target", [-(1 << 20) - 8, 1 << 20, 0x7FFFF000])
+@pytest.mark.parametrize("rd", ["ra", "zero"])
+def test_auipc_jalr_reach_anywhere(target, rd):
+    labels = {"far": target}
+    sequence = relax.expand(line("jal", register(rd), "far"), "J", relax.MAX_LEVEL["J"])
+    assert [parsed.instruction for parsed in sequence] == ["auipc", "jalr"]
+    auipc, jalr = (rv32i.line_to_word(parsed, labels, 4 * i) for i, parsed in enumerate(sequence))
+    upper = rv32i.sign_extend(auipc >> 12, 20) << 12
+    lower = rv32i.sign_extend(jalr >> 20, 12)
+    assert upper + lower == target
+    assert (jalr >> 7) & 0x1F == (1 if rd == "ra" else 0)
+    assert (auipc >> 7) & 0x1F == (1 if rd == "ra" else 6)  # t1 is the scratch register
+
+
+def test_branch_levels():
+    assert relax.in_range("B", 0, 4094) and not relax.in_range("B", 0, 4096)
+    assert relax.in_range("B", 1, 1 << 20) and not relax.in_range("B", 1, (1 << 20) + 8)
+    assert relax.in_range("B", 2, 1 << 30)
+    sequence = relax.expand(line("blt", register("a0"), register("a1"), "far"), "B", 2)
+    assert [(p.instruction, p.args[-1]) for p in sequence] == [
+        ("bge", 12),
+        ("auipc", Relocation("pcrel_hi", "far")),
+        ("jalr", Relocation("pcrel_lo", "far", -4)),
+    ]
@@ -0,0 +1,93 @@
+import pytest
+
+import lexer
+import rv32i
+from conftest import read_words
+from lexer import Memory, Relocation, register
+
+DATA = 0x30000000
+
+
+def lui_value(word):
+    return rv32i.sign_extend(word >> 12, 20) << 12
+
+
+def i_value(word):
+    return rv32i.sign_extend(word >> 20, 12)
+
+
+def s_value(word):
+    return rv32i.sign_extend(((word >> 25) << 5) | ((word >> 7) & 0x1F), 12)
+
+
+@pytest.mark.parametrize("text, operand", [
+    ("%hi(table)", Relocation("hi", "table")),
+    ("%lo( table + 8 )", Relocation("lo", "table", addend=8)),
+    ("%pcrel_hi(.LC0-4)", Relocation("pcrel_hi", ".LC0", addend=-4)),
+    ("%lo(counter)(a5)", Memory(Relocation("lo", "counter"), register("a5"))),
+    ("%lo(counter+4)(a5)", Memory(Relocation("lo", "counter", addend=4), register("a5"))),
+])
+def test_parses_relocations(text, operand):
+    assert lexer.parse_operand(text) == operand
+
+
+def test_hi_lo_with_addends(assemble):
+    source = """
+    lui a5, %hi(table+8)
+    lw a0, %lo(table+8)(a5)
+    sw a0, %lo(table-4)(a5)
+    addi a1, a5, %lo(table)
+.data
+    .zero 0x7F8
+table:
+    .word 1, 2, 3
+"""
+    assert assemble(source) == 0
+    lui, lw, sw, addi, _ = read_words()
+    table = DATA + 0x7F8
+    # table+8 is past 0x800, so %hi rounds up and %lo is negative
+    assert lui_value(lui) == DATA + 0x1000
+    assert lui_value(lui) + i_value(lw) == table + 8
+    assert s_value(sw) == 0x7F4
+    assert i_value(addi) == 0x7F8
+
+def test_la_and_comm(assemble):
+    source = """
+    la a0, counter
+    lla a1, buffer
+    la a2, main
+main:
+    .comm counter, 4, 4
+    .lcomm buffer, 10, 16
+.data
+    .byte 1
+"""
+    assert assemble(source) == 0
+    words = read_words()
+    addresses = [lui_value(words[i]) + i_value(words[i + 1]) for i in (0, 2, 4)]
+    assert addresses == [DATA, DATA + 16, 24]
+    assert read_words("program.data.memh")[:8] == [0] * 6 + [0x00010000, 0]  # after buffer
+
+
+def test_stream_backpatches_forward_symbols(assemble):
+    source = "la a0, later\nlw a1, %lo(later)(a0)\n.data\n.zero 0x900\nlater: .word 5\n"
+    assert assemble(source, output="whole.memh") == 0
+    assert assemble(source, "--stream", output="stream.memh") == 0
+    assert read_words("stream.memh") == read_words("whole.memh")
+
+
+def test_vectorized_matches_scalar(assemble):
+    pytest.importorskip("numpy")
+    source = (
+        "la a0, later\nlw a1, %lo(later+4)(a0)\nsw a1, %lo(later-8)(a0)\n"
+        ".data\n.zero 0x900\nlater:\n"
+    )
+    assert assemble(source, output="scalar.memh") == 0
+    assert assemble(source, "--vectorized", "--disable_cache", output="vectorized.memh") == 0
+    assert read_words("vectorized.memh") == read_words("scalar.memh")
+
+
+def test_errors(assemble):
+    assert assemble("lui a0, %hi(nowhere)\n") != 0
+    assert assemble("lui a0, %got(table)\ntable:\n") != 0
+    assert assemble("la a0, 12\n") != 0
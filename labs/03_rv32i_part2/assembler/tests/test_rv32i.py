@@ -0,0 +1,154 @@
+import pytest
+
+from conftest import PROGRAMS, read_words
+from helpers import LineException
+from main import ParsedLine
+import rv32i
+
+
+def encode(text, labels={}, address=0):
+    instruction, _, args = text.partition(" ")
+    args = [a.strip() for a in args.split(",")] if args else []
+    return rv32i.line_to_word(ParsedLine(text, 0, instruction, args), labels, address)
+
+
+@pytest.mark.parametrize("text, word", [
+    ("add a0, a1, a2", 0x00C58533),
+    ("sub t0, t1, t2", 0x407302B3),
+    ("addi a0, a0, -1", 0xFFF50513),
+    ("srli a0, a0, 3", 0x00355513),
+    ("srai a0, a0, 3", 0x40355513),
+    ("sra a0, a0, a1", 0x40B55533),
+    ("lw a0, 8(sp)", 0x00812503),
+    ("sw ra, 12(sp)", 0x00112623),
+    ("lui a0, 0x12345", 0x12345537),
+    ("halt", 0),
+])
+def test_encodes_each_format(text, word):
+    assert encode(text) == word
+
+
+def test_encodes_label_offsets():
+    labels = {"ahead": 8, "behind": 0}
+    assert encode("beq a0, a1, ahead", labels) == 0x00B50463
+    assert encode("jal ra, behind", labels, address=4) == 0xFFDFF0EF
+
+
+def test_gcc_missing_immediate_suffix():
+    assert encode("add a0, a0, 1") == encode("addi a0, a0, 1") == 0x00150513
+
+
+@pytest.mark.parametrize("text", [
+    "addi a0, a0, 2048",
+    "srai a0, a0, 32",
+    "slli a0, a0, -1",
+    "addi a0, x99, 1",
+    "lw a0, sp",
+    "frobnicate a0",
+    "beq a0, a1, nowhere",
+])
+def test_rejects_bad_lines(text):
+    with pytest.raises(LineException):
+        encode(text, {"ahead": 8})
+
+
+def test_line_to_bits_wraps_line_to_word():
+    pytest.importorskip("bitstring")
+    line = ParsedLine("", 0, "sw", ["ra", "12(sp)"])
+    assert rv32i.line_to_bits(line).uint == rv32i.line_to_word(line)
+
+
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_examples_assemble(assemble, program, workdir):
+    with open(program) as f:
+        assert assemble(f.read()) == 0
+    assert read_words()[-1] == 0  # halt
+
+
+def reencode(word):
+    """ Disassemble a word and assemble it again, resolving branch targets through its labels. """
+    labels = {}
+    text = rv32i.decode_word(word).format_line(labels).split(" #")[0]
+    return encode(text, {name: offset for offset, name in labels.items()})
+
+
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_decode_round_trips(assemble, program):
+    with open(program) as f:
+        assert assemble(f.read()) == 0
+    for word in read_words():
+        assert reencode(word) == word
+
+
+@pytest.mark.parametrize("text, line", [
+    ("lui a0, 0x12345", "lui a0, 74565"),
+    ("lui a0, -1", "lui a0, -1"),
+    ("addi a0, a0, -1", "addi a0, a0, -1"),
+    ("srli t0, t1, 3", "srli t0, t1, 3"),
+    ("sw ra, -4(sp)", "sw ra, -4(sp)"),
+    ("halt", "halt"),
+])
+def test_decodes_immediates(text, line):
+    assert rv32i.bits_to_line(encode(text)) == line
+
+
+def test_decodes_branch_offsets():
+    labels = {"behind": 0}
+    assert rv32i.bits_to_line(encode("bne a0, a1, behind", labels, address=12)) == "bne a0, a1, -12"
+    assert rv32i.bits_to_line(encode("jal ra, behind", labels, address=4)) == "jal ra, -4"
+
+
+def test_bits_to_line_accepts_bit_arrays():
+    bitstring = pytest.importorskip("bitstring")
+    word = encode("add a0, a1, a2")
+    assert rv32i.bits_to_line(bitstring.BitArray(uint=word, length=32)) == "add a0, a1, a2"
+
+
+def test_rejects_unknown_opcodes():
+    with pytest.raises(ValueError):
+        rv32i.decode_word(0x7F)
+
+
+def li(value):
+    sequence = rv32i.PSEUDO_INSTRUCTIONS["li"]("a0", value)
+    if isinstance(sequence, tuple):
+        sequence = [sequence]
+    return [(instruction, args[-1]) for instruction, args in sequence]
+
+
+@pytest.mark.parametrize("value, sequence", [
+    (5, [("addi", 5)]),
+    (-2048, [("addi", -2048)]),
+    (2047, [("addi", 2047)]),
+    (2048, [("lui", 1), ("addi", -2048)]),
+    (0x1000, [("lui", 1)]),
+    (0x12345678, [("lui", 0x12345), ("addi", 0x678)]),
+    (0x7FFFFFFF, [("lui", -0x80000), ("addi", -1)]),
+    (0x80000000, [("lui", -0x80000)]),
+    (0xFFFFFFFF, [("addi", -1)]),
+    (-(2 ** 31), [("lui", -0x80000)]),
+])
+def test_li_uses_the_shortest_sequence(value, sequence):
+    assert li(value) == sequence
+
+
+def test_li_values_are_exact(assemble):
+    values = [2048, 0x7FFFFFFF, 0x12345FFF, -2049, 0xDEADBEEF]
+    assert assemble("".join(f"li a0, {v}\n" for v in values)) == 0
+    words = read_words()[:-1]
+    loaded = []
+    while words:
+        word = words.pop(0)
+        if word & 0x7F == 0x37:  # lui
+            value = word & 0xFFFFF000
+            if words and words[0] & 0x7F == 0x13 and (words[0] >> 15) & 0x1F == 10:
+                value += rv32i.sign_extend(words.pop(0) >> 20, 12)
+        else:
+            value = rv32i.sign_extend(word >> 20, 12)
+        loaded.append(value & 0xFFFFFFFF)
+    assert loaded == [v & 0xFFFFFFFF for v in values]
+
+
+def test_li_out_of_range():
+    with pytest.raises(LineException):
+        li(2 ** 32)
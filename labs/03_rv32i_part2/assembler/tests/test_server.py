@@ -0,0 +1,114 @@
+import os
+import socket
+import threading
+import time
+
+import server
+from conftest import read_words
+
+
+def serve_one(socket_path, client, *args):
+    """ Run client(*args, socket_path) in a thread while the server handles one request. """
+    result = []
+    thread = threading.Thread(target=lambda: result.append(client(*args, socket_path)))
+    thread.start()
+    return thread, result
+
+
+def test_request_is_assembled_in_the_clients_directory(assemble, workdir, capsys):
+    source = "start: addi a0, zero, 1\nbne a0, zero, start\n"
+    assert assemble(source, output="local.memh") == 0
+    socket_path = str(workdir / "assembler.sock")
+    with server.AssemblerServer(socket_path) as assembler_server:
+        argv = ["program.s", "-o", "served.memh", "-v"]
+        thread, result = serve_one(socket_path, server.request, argv)
+        assembler_server.handle_request()
+        thread.join()
+        assembler_server.collect_children()
+    assert result == [0]
+    assert read_words("served.memh") == read_words("local.memh")
+    assert "Label table" in capsys.readouterr().out  # the child's output is passed along
+
+
+def test_request_uses_the_clients_environment(workdir, monkeypatch, capsys):
+    with open("program.s", "w") as f:
+        f.write("addi a0, zero, 1\n")
+    monkeypatch.setenv("ASSEMBLER_CACHE_DIR", str(workdir / "server_cache"))
+    monkeypatch.setattr(
+        server,
+        "forwarded_environment",
+        lambda: {"ASSEMBLER_CACHE_DIR": "client_cache", "ASSEMBLER_VERBOSE": "1"},
+    )
+    socket_path = str(workdir / "assembler.sock")
+    with server.AssemblerServer(socket_path) as assembler_server:
+        thread, result = serve_one(socket_path, server.request, ["program.s", "-o", "served.memh"])
+        assembler_server.handle_request()
+        thread.join()
+        assembler_server.collect_children()
+    assert result == [0]
+    assert os.path.isdir("client_cache") and not os.path.exists("server_cache")
+    assert "Label table" in capsys.readouterr().out
+    # The server's own environment is left alone
+    assert os.environ["ASSEMBLER_CACHE_DIR"] == str(workdir / "server_cache")
+
+
+def test_forwarded_environment(monkeypatch):
+    for name in server.FORWARDED_ENVIRONMENT:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("ASSEMBLER_VERBOSE", "1")
+    monkeypatch.setenv("ASSEMBLER_SOCKET", "/tmp/other.sock")
+    assert server.forwarded_environment() == {"ASSEMBLER_VERBOSE": "1"}
+
+
+def test_stale_server_sends_clients_back(workdir):
+    socket_path = str(workdir / "assembler.sock")
+    with server.AssemblerServer(socket_path) as assembler_server:
+        assembler_server.version = []  # as if the assembler had been edited since it started
+        thread, result = serve_one(socket_path, server.request, ["program.s"])
+        assembler_server.handle_request()
+        thread.join()
+        assert result == [None]
+        assert not assembler_server.running
+
+
+def test_stop(workdir):
+    socket_path = str(workdir / "assembler.sock")
+    with server.AssemblerServer(socket_path) as assembler_server:
+        thread, _ = serve_one(socket_path, server.stop)
+        assembler_server.handle_request()
+        thread.join()
+        assert not assembler_server.running
+
+
+def test_no_server(workdir):
+    assert server.request(["program.s"], str(workdir / "missing.sock")) is None
+
+
+def test_silent_client_does_not_block_the_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "REQUEST_TIMEOUT", 0.1)
+    socket_path = str(tmp_path / "assembler.sock")
+    with server.AssemblerServer(socket_path) as assembler_server:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as silent:
+            silent.connect(socket_path)
+            start = time.monotonic()
+            assembler_server.handle_request()
+            assert time.monotonic() - start < 5
+            assert silent.recv(1) == b""  # the server hung up on it
+
+        # And it's still listening
+        client = threading.Thread(target=server.stop, args=(socket_path,))
+        client.start()
+        assembler_server.handle_request()
+        client.join()
+        assert not assembler_server.running
+
+
+def test_garbage_request_is_rejected(tmp_path):
+    socket_path = str(tmp_path / "assembler.sock")
+    with server.AssemblerServer(socket_path) as assembler_server:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(b"not json\n")
+            assembler_server.handle_request()
+            assert client.recv(1) == b""
+        assert assembler_server.running
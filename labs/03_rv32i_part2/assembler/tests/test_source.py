@@ -0,0 +1,96 @@
+import os
+import os.path as path
+import shutil
+
+import pytest
+
+import main
+from conftest import LAB_DIR
+from main import AssemblyProgram, ParsedLine, SourceFile, read_lines
+
+
+def test_source_file_closes(tmp_path):
+    fn = tmp_path / "program.s"
+    fn.write_text("li a0, 1\n  addi a0, a0, 1  \nret")
+    with SourceFile(str(fn)) as source:
+        assert list(source.lines()) == ["li a0, 1", "  addi a0, a0, 1  ", "ret"]
+        assert [source.line(n) for n in (3, 2, 1)] == ["ret", "addi a0, a0, 1", "li a0, 1"]
+    assert source.contents.closed
+
+
+def test_empty_source_file(tmp_path):
+    fn = tmp_path / "empty.s"
+    fn.write_text("")
+    with SourceFile(str(fn)) as source:
+        assert list(source.lines()) == []
+
+
+def test_parsed_lines_are_slotted():
+    parsed = ParsedLine("addi a0, a0, 1", 3, "addi", ["a0", "a0", 1], label="loop")
+    with pytest.raises(AttributeError):
+        parsed.extra = True
+    copy = parsed.replace(args=["a1", "a1", 2], label=None)
+    assert (copy.original, copy.line_number, copy.instruction) == ("addi a0, a0, 1", 3, "addi")
+    assert (copy.args, copy.label) == (["a1", "a1", 2], None)
+    assert parsed.args == ["a0", "a0", 1] and parsed.label == "loop"
+
+
+def test_original_text_comes_from_the_file(tmp_path):
+    fn = tmp_path / "program.s"
+    fn.write_text("main:\n    li a0, 0x12345678   # big\n    ret\n")
+    ap = AssemblyProgram()
+    with SourceFile(str(fn)) as source:
+        lines = list(ap.expand(ap.tokenize(read_lines([source]))))
+        assert [(p.instruction, p.line_number) for p in lines] == [("lui", 2), ("addi", 2), ("jalr", 3)]
+        assert all(p.source is source for p in lines)
+        assert lines[1].original == "li a0, 0x12345678   # big"
+
+
+def test_files_are_closed_after_assembling(assemble, monkeypatch):
+    opened = []
+
+    class Tracked(SourceFile):
+        def __init__(self, fn):
+            super().__init__(fn)
+            opened.append(self)
+
+    monkeypatch.setattr(main, "SourceFile", Tracked)
+    assert assemble("li a0, 1\n", "--disable_cache") == 0
+    assert opened and all(source.contents.closed for source in opened)
+
+
+def test_annotations_keep_the_source_text(assemble):
+    assert assemble("main:\n  li a0, 1  # à la carte\n") == 0
+    with open("program.memh", encoding="utf-8") as f:
+        assert f.readline() == "00100513 // PC=0x0 line=2: li a0, 1  # à la carte\n"
+
+
+def test_lines_are_numbered_in_each_file(tmp_path):
+    first, second = tmp_path / "preamble.s", tmp_path / "program.s"
+    first.write_text("PREAMBLE:\n    li sp, 0x30001000\n    j main\n")
+    second.write_text("main:\n    li a0, 1\n")
+    ap = AssemblyProgram()
+    with SourceFile(str(first)) as preamble, SourceFile(str(second)) as program:
+        lines = list(ap.expand(ap.tokenize(read_lines([preamble, program]))))
+        where = [(p.source.name, p.line_number, p.original) for p in lines if p.instruction]
+    assert where == [
+        (str(first), 2, "li sp, 0x30001000"),
+        (str(first), 3, "j main"),
+        (str(second), 2, "li a0, 1"),
+    ]
+    assert ap.line_number == 5
+
+
+def test_errors_and_annotations_name_the_line_in_its_file(assemble, capsys):
+    os.mkdir("asm")
+    shutil.copy(path.join(LAB_DIR, "asm", "_preamble.s"), "asm")
+    assert assemble("main:\n    li a0, 1\n", "--gcc") == 0
+    with open("program.memh") as f:
+        annotations = [line.split("//")[1] for line in f if "line=" in line]
+    with open("asm/_preamble.s") as f:
+        first = next(i for i, line in enumerate(f, 1) if line.strip().startswith("li sp"))
+    assert annotations[0].startswith(f" PC=0x0 line={first}: li sp, ")
+    assert annotations[-2] == f" PC={4 * (len(annotations) - 2):#x} line=2: li a0, 1\n"
+    capsys.readouterr()
+    assert assemble("main:\n    li a0, nowhere\n", "--gcc") != 0
+    assert "Error on line 2 of program.s (li)" in capsys.readouterr().out
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import main
+
+SOURCE = """
+main:
+    li a0, 5
+    li a1, 0x12345678
+loop:
+    addi a0, a0, -1
+    bnez a0, loop
+    sw a1, 0(sp)
+"""
+
+
+def read_stats(fn="stats.json"):
+    with open(fn) as f:
+        return json.load(f)
+
+
+def test_counts_instructions(assemble):
+    assert assemble(SOURCE, "--stats", "stats.json") == 0
+    stats = read_stats()
+    assert stats["pseudo_instructions"] == {"li": 2, "bnez": 1}
+    # li of a large constant is lui + addi, and there's a halt at the end
+    assert stats["mnemonics"] == {"addi": 3, "lui": 1, "bne": 1, "sw": 1, "halt": 1}
+    assert stats["formats"] == {"I": 3, "U": 1, "B": 1, "S": 1, "halt": 1}
+    assert stats["instructions"] == 7
+    assert stats["labels"] == 2
+    assert set(stats["phases"]) >= {"parse", "expand", "encode", "sourcemap", "write"}
+    assert stats["total"] == pytest.approx(sum(stats["phases"].values()), abs=1e-5)
+
+
+def test_stream_phases(assemble):
+    assert assemble(SOURCE, "--stream", "--profile", "stats.json") == 0
+    stats = read_stats()
+    assert set(stats["phases"]) >= {"stream", "fixups"}
+    assert stats["mnemonics"]["addi"] == 3
+
+
+def test_cache_hits_are_counted(assemble):
+    assert assemble(SOURCE) == 0
+    assert assemble(SOURCE, "--stats", "stats.json") == 0
+    assert read_stats()["cache_hit"] is True
+
+
+def test_one_entry_per_file(workdir):
+    for name in ("a", "b"):
+        with open(f"{name}.s", "w") as f:
+            f.write(SOURCE)
+    with pytest.raises(SystemExit) as e:
+        main.main(["a.s", "b.s", "-j", "1", "--disable_cache", "--stats", "stats.json"])
+    assert e.value.code == 0
+    stats = read_stats()
+    assert [entry["instructions"] for entry in stats["files"]] == [7, 7]
+
+
+def test_debug_messages_need_verbose(assemble, capsys):
+    assert assemble(SOURCE) == 0
+    assert "Label table" not in capsys.readouterr().out
+    assert assemble(SOURCE, "-v", "--disable_cache") == 0
+    assert "Label table" in capsys.readouterr().out
+
+
+def test_stats_on_stdout_are_only_json(assemble, capsys):
+    source = """
+    .globl main
+    .type main, @function
+main:
+    li a0, 5
+    ret
+    .size main, .-main
+"""
+    assert assemble(source, "--stats") == 0
+    stats = json.loads(capsys.readouterr().out)
+    assert stats["instructions"] == 3
+    # -v adds the assembler's diagnostics, so it shows the ignored directives
+    assert assemble(source, "--disable_cache", "-v") == 0
+    assert "Detected assembler directive: .globl" in capsys.readouterr().out
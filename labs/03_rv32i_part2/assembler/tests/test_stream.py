@@ -0,0 +1,45 @@
+import os
+import os.path as path
+
+import pytest
+
+from conftest import PROGRAMS, read_words
+from symbols import SOURCEMAP_PATH
+
+
+def read(fn):
+    with open(fn) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("fn", PROGRAMS, ids=path.basename)
+def test_stream_matches_whole_program_build(assemble, fn):
+    source = read(fn)
+    assert assemble(source, output="whole.memh") == 0
+    whole_sourcemap = read(SOURCEMAP_PATH)
+    assert assemble(source, "--stream", output="stream.memh") == 0
+    assert read("stream.memh") == read("whole.memh")
+    assert read(SOURCEMAP_PATH) == whole_sourcemap
+
+
+@pytest.mark.parametrize("output", ["program.memh", "program.memb"])
+def test_forward_references_are_patched(assemble, output):
+    source = "beq a0, zero, done\njal ra, done\naddi a0, a0, 1\ndone: addi a0, a0, 2\n"
+    assert assemble(source, output="whole." + output.split(".")[1]) == 0
+    assert assemble(source, "--stream", output=output) == 0
+    assert read(output) == read("whole." + output.split(".")[1])
+    if output.endswith(".memh"):
+        assert read_words(output)[:2] == [0x00050663, 0x008000EF]
+
+
+def test_failed_build_leaves_no_output(assemble, workdir):
+    with open("program.memh", "w") as f:
+        f.write("old\n")
+    assert assemble("addi a0, zero, 1\nbeq a0, zero, nowhere\n", "--stream") != 0
+    assert read("program.memh") == "old\n"
+    assert not os.path.exists(SOURCEMAP_PATH)
+    assert sorted(os.listdir(workdir)) == ["program.memh", "program.s", "tests"]
+
+
+def test_stream_and_vectorized_conflict(assemble):
+    assert assemble("addi a0, zero, 1\n", "--stream", "--vectorized") == 2
@@ -0,0 +1,51 @@
+import rv32i
+from main import ParsedLine
+from symbols import SOURCEMAP_PATH, LabelIndex
+
+
+def test_nearest_and_at():
+    index = LabelIndex({"main": 0, "loop": 8, "done": 20})
+    assert [index.nearest(a) for a in (0, 4, 8, 16, 20, 400)] == [
+        "main", "main", "loop", "loop", "done", "done"
+    ]
+    assert index.at(8) == "loop"
+    assert index.at(12) is None
+
+
+def test_before_first_label():
+    index = LabelIndex({"late": 16})
+    assert index.nearest(0) == "root"
+    assert index.nearest(0, default=None) is None
+    assert LabelIndex().nearest(4) == "root"
+
+
+def test_first_defined_label_wins():
+    index = LabelIndex({"outer": 4, "inner": 4})
+    assert index.at(4) == "outer"
+    assert index.nearest(8) == "outer"
+
+
+def test_acts_as_the_label_table():
+    labels = {"a": 0, "b": 12}
+    index = LabelIndex(labels)
+    assert dict(index) == labels
+    assert index["b"] == 12 and "a" in index and len(index) == 2
+
+
+def test_decoder_names_branch_targets():
+    index = LabelIndex({"loop": 4})
+    word = rv32i.line_to_word(ParsedLine("", 0, "bne", ["a0", "zero", "loop"]), index, address=12)
+    assert rv32i.bits_to_line(word, index, address=12) == "bne a0, zero, loop"
+    # Without an address (or a label at the target), the offset is printed
+    assert rv32i.bits_to_line(word, index) == "bne a0, zero, -8"
+    assert rv32i.bits_to_line(word, index, address=16) == "bne a0, zero, -8"
+
+
+def test_sourcemap_uses_nearest_label(assemble):
+    source = "addi a0, zero, 1\nmain:\naddi a0, a0, 1\nloop: addi a0, a0, 1\nbne a0, zero, loop\n"
+    assert assemble(source) == 0
+    with open(SOURCEMAP_PATH) as f:
+        assert [line.split(": ")[1] for line in f.read().splitlines()] == [
+            "root", "main", "loop", "loop", "loop"
+        ]
+
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmarks for the assembler, the disassembler and the GTKWave filter.
+
+Runs every program in asm/ plus generated programs of different sizes (with a realistic mix of
+instruction types and labels) through each of them, and reports instructions per second and peak
+memory use. Each program runs in its own process, so peak memory is for that program alone.
+
+    ./benchmark.py                      # run, and compare against the saved baseline if there is one
+    ./benchmark.py --save               # run, and save the results as the new baseline
+    ./benchmark.py --sizes 1000000      # just a 1M instruction program
+
+Comparing fails (exit code 1) if any throughput drops more than --threshold below the baseline (the
+programs in asm/ are too small to time reliably, so that's only for the generated ones).
+Baselines depend on the machine, so save one before making changes, not on someone else's computer.
+"""
+
+from __future__ import annotations
+from typing import *
+
+import argparse
+import glob
+import json
+import os
+import os.path as path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not on Windows, so no peak memory there
+
+ROOT = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(ROOT, "assembler"))
+from constants import BTYPES, ITYPES, LTYPES, REGISTER_NAMES, RTYPES, UTYPES
+from main import AssemblyProgram, SourceFile, halt_line, read_lines
+import rv32i
+from symbols import LabelIndex
+
+DEFAULT_BASELINE = path.join(ROOT, "tests", "benchmark_baseline.json")
+DEFAULT_SIZES = [10_000, 100_000]
+
+# Roughly what GCC's output for our programs looks like (by format)
+INSTRUCTION_MIX = {"R": 20, "I": 35, "L": 15, "S": 10, "B": 10, "J": 5, "U": 5}
+# About how many instructions between labels
+LABEL_SPACING = 8
+# Programs smaller than this finish too quickly to time reliably, so they aren't compared
+MIN_COMPARED_INSTRUCTIONS = 1000
+
+
+def generate_program(count: int, seed=0) -> str:
+    """ Assembly for a program with count instructions, in INSTRUCTION_MIX proportions. """
+    rng = random.Random(seed)
+    registers = [names[-1] for names in REGISTER_NAMES]
+    formats = list(INSTRUCTION_MIX)
+    weights = list(INSTRUCTION_MIX.values())
+    label_count = (count - 1) // LABEL_SPACING + 1
+    lines = []
+    for i in range(count):
+        if i % LABEL_SPACING == 0:
+            lines.append(f"L{i // LABEL_SPACING}:")
+        rd, rs1, rs2 = rng.choice(registers), rng.choice(registers), rng.choice(registers)
+        fmt = rng.choices(formats, weights)[0]
+        # Branches stay within a few hundred instructions, so everything is in range
+        label = f"L{min(max(i // LABEL_SPACING + rng.randint(-30, 30), 0), label_count - 1)}"
+        if fmt == "R":
+            lines.append(f"{rng.choice(RTYPES)} {rd}, {rs1}, {rs2}")
+        elif fmt == "I":
+            op = rng.choice([op for op in ITYPES if op != "jalr"])
+            imm = rng.randint(0, 31) if op in ("slli", "srli", "srai") else rng.randint(-2048, 2047)
+            lines.append(f"{op} {rd}, {rs1}, {imm}")
+        elif fmt == "L":
+            lines.append(f"{rng.choice(LTYPES)} {rd}, {rng.randint(-2048, 2047)}({rs1})")
+        elif fmt == "S":
+            lines.append(f"sw {rs2}, {rng.randint(-2048, 2047)}({rs1})")
+        elif fmt == "B":
+            lines.append(f"{rng.choice(BTYPES)} {rs1}, {rs2}, {label}")
+        elif fmt == "J":
+            lines.append(f"jal {rd}, {label}")
+        else:
+            lines.append(f"{rng.choice(UTYPES)} {rd}, {rng.randint(0, 0x7FFFF)}")
+    return "\n".join(lines) + "\n"
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 1) if seconds > 0 else float("inf")
+
+
+def benchmark_program(fn: str) -> Dict[str, Any]:
+    """ Assemble, disassemble, and filter one program. Runs in its own process. """
+    results: Dict[str, Any] = {}
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    os.makedirs(path.join(workdir, "tests", "gtkwave_filters"))
+    cwd = os.getcwd()
+    os.chdir(workdir)  # The sourcemap goes in tests/gtkwave_filters, keep it out of the real one
+    source = SourceFile(fn)
+    try:
+        start = time.perf_counter()
+        ap = AssemblyProgram()
+        try:
+            ap.parsed_lines.extend(ap.expand(ap.tokenize(read_lines([source]))))
+        except rv32i.LineException as e:
+            return {"error": f"line {e.line.line_number}: {e}"}
+        ap.parsed_lines.append(halt_line())
+        ap.relax()
+        parsed = time.perf_counter()
+        if ap.write_mem("program.memh") != 0:
+            return {"error": "couldn't be encoded"}
+        end = time.perf_counter()
+        count = len(ap.parsed_lines)
+        results["instructions"] = count
+        results["assemble_per_second"] = rate(count, end - start)
+        results["parse_per_second"] = rate(count, parsed - start)
+        results["write_mem_per_second"] = rate(count, end - parsed)
+
+        with open("program.memh") as f:
+            words = [int(line[:8], 16) for line in f]
+        labels = LabelIndex(ap.labels)
+        start = time.perf_counter()
+        for i, word in enumerate(words):
+            rv32i.bits_to_line(word, labels, 4 * i)
+        results["disassemble_per_second"] = rate(len(words), time.perf_counter() - start)
+        results["peak_rss_mb"] = peak_rss_mb()
+
+        # The GTKWave filter reads one word per line on stdin, like GTKWave sends them
+        stdin = "".join(f"{word:08x}\n" for word in words).encode()
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, path.join(ROOT, "gtkwave_filter.py")],
+            input=stdin,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        results["gtkwave_filter_per_second"] = rate(len(words), time.perf_counter() - start)
+    finally:
+        source.close()
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return results
+
+
+def run_isolated(fn: str) -> Dict[str, Any]:
+    """ benchmark_program() in a fresh process, so its peak memory is its own. """
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(benchmark_program, fn).result()
+
+
+def compare(results, baseline, threshold) -> List[str]:
+    """ Every throughput that's more than threshold (a fraction) below the baseline. """
+    regressions = []
+    for name, result in results.items():
+        if result.get("instructions", 0) < MIN_COMPARED_INSTRUCTIONS:
+            continue
+        for metric, value in result.items():
+            old = baseline.get(name, {}).get(metric)
+            if not metric.endswith("_per_second") or not old:
+                continue
+            if value < old * (1 - threshold):
+                regressions.append(
+                    f"{name} {metric}: {value:,.0f} vs {old:,.0f} ({value / old - 1:+.0%})"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="comma separated sizes (in instructions) of the generated programs, ex. 10000,1000000",
+    )
+    parser.add_argument(
+        "--disable_corpus", action="store_true", help="only run the generated programs, not asm/*.s"
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="where the baseline is kept")
+    parser.add_argument(
+        "--save", action="store_true", help="save these results as the baseline, instead of comparing"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fail if throughput drops by more than this fraction of the baseline (default 0.2)",
+    )
+    parser.add_argument("-o", "--output", help="also write the results to this file, as JSON")
+    args = parser.parse_args()
+
+    programs = {}
+    if not args.disable_corpus:
+        for fn in sorted(glob.glob(path.join(ROOT, "asm", "*.s"))):
+            if not path.basename(fn).startswith("_"):
+                programs[path.relpath(fn, ROOT)] = fn
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as tmp:
+        for size in [int(size) for size in args.sizes.split(",") if size]:
+            fn = path.join(tmp, f"synthetic_{size}.s")
+            with open(fn, "w") as f:
+                f.write(generate_program(size))
+            programs[f"synthetic_{size}"] = fn
+
+        results = {}
+        for name, fn in programs.items():
+            result = run_isolated(fn)
+            results[name] = result
+            if "error" in result:
+                print(f"{name:>24}  skipped ({result['error']})")
+                continue
+            print(
+                f"{name:>24}  {result['instructions']:>8} instructions  "
+                f"assemble {result['assemble_per_second']:>10,.0f}/s  "
+                f"disassemble {result['disassemble_per_second']:>10,.0f}/s  "
+                f"filter {result['gtkwave_filter_per_second']:>10,.0f}/s  "
+                f"peak {result['peak_rss_mb']} MB"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+
+    if not path.exists(args.baseline):
+        print(f"No baseline to compare against, save one with --save ({args.baseline}).")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"Throughput dropped more than {args.threshold:.0%} below the baseline:")
+        print("  " + "\n  ".join(regressions))
+        return 1
+    print(f"No throughput dropped more than {args.threshold:.0%} below the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,158 @@
 #!/usr/bin/env python3
 import argparse
-from bitstring import BitArray
-from io import UnsupportedOperation
+import mmap
+import os
 import os.path as path
+import struct
+import sys
+from itertools import islice
+from typing import *
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "assembler"))
+import batch
 import rv32i
+from symbols import SOURCEMAP_PATH, LabelIndex, read_sourcemap, sourcemap_labels
+
+
+def read_text_words(fn: str, radix: str) -> Iterator[int]:
+    """ One word per line of hex or binary text (ex. a .memh), yielded as they're read. """
+    with open(fn, "r") as f:
+        yield from parse_text_words(f, radix)
+
+
+def parse_text_words(f, radix: str) -> Iterator[int]:
+    for i, line in enumerate(f):
+        if "#" in line:
+            line = line.split("#")[0]
+        if "//" in line:
+            line = line.split("//")[0]
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if radix == "hex":
+                length = len(line) * 4
+                word = int(line, 16)
+            else:
+                length = len(line)
+                word = int(line, 2)
+        except ValueError:
+            raise ValueError(f"Error: Couldn't parse line {i+1}")
+        if length != 32:
+            raise ValueError(f"Error: line {i+1} was {length} bits, not 32.")
+        yield word
+
+
+def read_raw_words(fn: str) -> Iterator[int]:
+    """
+    Little-endian 32 bit words from a binary file (ex. a memory dump). The file is mmap'd and viewed
+    as an array of words, so nothing is copied and big files don't need to fit in memory.
+    """
+    with open(fn, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size % 4:
+            raise ValueError(f"Error: {fn} is {size} bytes, not a whole number of 32 bit words.")
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if sys.byteorder != "little":
+                for (word,) in struct.iter_unpack("<I", mm):
+                    yield word
+                return
+            words = memoryview(mm).cast("I")
+            try:
+                yield from words
+            finally:
+                # The mmap can't be closed while something still has a view of it
+                words.release()
+
+
+# Words decoded at once by --vectorized
+CHUNK_WORDS = 1 << 16
+
+
+def chunks(words: Iterable[int], size=CHUNK_WORDS) -> Iterator[List[int]]:
+    words = iter(words)
+    while True:
+        chunk = list(islice(words, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def branch_targets(words: Iterable[int], start_address=0, vectorized=False) -> Tuple[Set[int], int]:
+    """ First pass: the address every branch and jal goes to, and how many words there are. """
+    targets = set()
+    count = 0
+    if vectorized:
+        for chunk in chunks(words):
+            targets |= batch.branch_targets(chunk, start_address + 4 * count)
+            count += len(chunk)
+        return targets, count
+    for count, word in enumerate(words, 1):
+        try:
+            decoded = rv32i.decode_word(word)
+        except ValueError:
+            continue  # The second pass reports it
+        if decoded.format in ("B", "J"):
+            targets.add(start_address + 4 * (count - 1) + decoded.imm)
+    return targets, count
+
+
+def recover_labels(targets: Set[int], count: int, named: Dict[str, int] = {}, start_address=0) -> Dict[str, int]:
+    """
+    Labels for the listing: every label in named (ex. from the sourcemap), then LABEL_n (in address
+    order) for targets that don't have one. Only addresses of instructions in the program get one,
+    anything else stays a number.
+    """
+    end = start_address + 4 * count
+
+    def in_program(address):
+        return start_address <= address < end and (address - start_address) % 4 == 0
+
+    labels = {label: address for label, address in named.items() if in_program(address)}
+    taken = set(labels.values())
+    for address in sorted(targets):
+        if in_program(address) and address not in taken:
+            labels[f"LABEL_{len(labels)}"] = address
+    return labels
+
+
+def disassemble(words: Iterable[int], out, labels: Optional[LabelIndex] = None, start_address=0, vectorized=False) -> int:
+    """
+    Decode and write each word as it's read, so memory use doesn't grow with the input. With labels,
+    each one is written before the instruction it's at, and branches and jumps go to them.
+    vectorized decodes CHUNK_WORDS at a time with NumPy instead (same output).
+    """
+    count = 0
+    if vectorized:
+        for chunk in chunks(words):
+            try:
+                lines = batch.disassemble_words(chunk, labels, start_address + 4 * count)
+            except ValueError as e:
+                print(f"Error on word {count + e.index + 1}: ", file=sys.stderr)
+                raise e
+            for line in lines:
+                if labels is not None:
+                    label = labels.at(start_address + 4 * count)
+                    if label is not None:
+                        out.write(f"{label}:\n")
+                out.write(line + "\n")
+                count += 1
+        return count
+    for count, word in enumerate(words, 1):
+        address = start_address + 4 * (count - 1)
+        try:
+            line = rv32i.bits_to_line(word, labels, address)
+        except Exception as e:
+            print(f"Error on word {count}: ", file=sys.stderr)
+            raise e
+        if labels is not None:
+            label = labels.at(address)
+            if label is not None:
+                out.write(f"{label}:\n")
+        out.write(line + "\n")
+    return count
 
 
 def main():
@@ -13,7 +162,7 @@ def main():
         "-o",
         "--output",
         default=None,
-        help="output file name to store human readable assembly",
+        help="output file name to store human readable assembly (default: stdout)",
     )
     parser.add_argument(
         "-r",
@@ -24,7 +173,26 @@ def main():
     parser.add_argument(
         "--raw",
         action="store_true",
-        help="Treat input as raw binary values (not ascii text).",
+        help="Treat input as raw binary values (little-endian 32 bit words, not ascii text).",
+    )
+    parser.add_argument(
+        "-l",
+        "--labels",
+        action="store_true",
+        help="Read the input twice: once to find every branch/jump target, then to write a listing with labels at them.",
+    )
+    parser.add_argument(
+        "-s",
+        "--sourcemap",
+        nargs="?",
+        const=SOURCEMAP_PATH,
+        default=None,
+        help=f"Take label names from the assembler's sourcemap (default {SOURCEMAP_PATH}). Implies --labels.",
+    )
+    parser.add_argument(
+        "--vectorized",
+        action="store_true",
+        help="Decode many words at once with NumPy. Much faster for big inputs, same output.",
     )
     parser.add_argument(
         "-v",
@@ -35,42 +203,30 @@ def main():
     args = parser.parse_args()
     if not path.exists(args.input):
         raise Exception(f"input file {args.input} does not exist.")
-    if args.raw:
-        raise NotImplemented("Haven't implemented raw parsing yet.")
-    if args.radix not in ["hex", "bin"]:
+    if not args.raw and args.radix not in ["hex", "bin"]:
         raise ValueError(f"Radix {args.radix} not supported.")
-    instructions = []
-    with open(args.input, "r") as f:
-        for i, line in enumerate(f):
-            if "#" in line:
-                line = line.split("#")[0]
-            if "//" in line:
-                line = line.split("//")[0]
-            line = line.strip()
-            bits = None
-            if args.radix == "hex":
-                bits = BitArray(hex=line)
-            if args.radix == "bin":
-                bits = BitArray(bin=line)
-            if not bits:
-                raise ValueError(f"Error: Couldn't parse line {i+1}")
-            if bits.length != 32:
-                raise ValueError(
-                    f"Error: line {i+1} was {bits.length} bits, not 32."
-                )
-            instructions.append(bits)
+
+    def read_words():
+        return read_raw_words(args.input) if args.raw else read_text_words(args.input, args.radix)
+
     labels = {}
-    with open(args.output, "w") as f:
-        for i, bits in enumerate(instructions):
-            try:
-                line = rv32i.bits_to_line(bits, labels=None)
-            except Exception as e:
-                print(f"Error on line {i+1}: ")
-                raise e
-            f.write(line + "\n")
+    if args.labels or args.sourcemap:
+        named = {}
+        if args.sourcemap:
+            named = sourcemap_labels(read_sourcemap(args.sourcemap))
+        targets, count = branch_targets(read_words(), vectorized=args.vectorized)
+        labels = recover_labels(targets, count, named)
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        count = disassemble(read_words(), out, LabelIndex(labels) if labels else None, vectorized=args.vectorized)
+    finally:
+        if out is not sys.stdout:
+            out.close()
     if args.verbose:
-        print(f"Disassembled {args.input} -> {args.output}. Label table: ")
-        print("  " + ",\n  ".join([f"{k} <- {labels[k]}" for k in labels]))
+        # Keep stdout for the assembly when that's where it's going
+        log = sys.stdout if args.output else sys.stderr
+        print(f"Disassembled {count} words: {args.input} -> {args.output or 'stdout'}. Label table: ", file=log)
+        print("  " + ",\n  ".join([f"{k} <- {labels[k]}" for k in labels]), file=log)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,224 @@
 #!/usr/bin/env python3
+"""
+GTKWave "Translate Filter Process" that shows instruction words as assembly.
+
+GTKWave can't pass arguments to a filter, so the program being run is given with environment
+variables (`make waves_*` sets them):
+    GTKWAVE_FILTER_PROGRAM    the .memh the simulation loaded. Its instructions are disassembled
+                              once at startup (with labels, the source line of each instruction from
+                              the .memh's annotations, and its label from the sourcemap), and saved
+                              next to it as .gtkwave.json so the next session starts with them.
+    GTKWAVE_FILTER_SOURCEMAP  the assembler's sourcemap (default tests/gtkwave_filters/assembly_sourcemap.txt)
+    GTKWAVE_FILTER_LOG        set to log every value to stderr (slow, only for debugging the filter)
+"""
+import argparse
 import asyncio
-from bitstring import BitArray
-import rv32i
+import hashlib
+import json
+import os
+import os.path as path
+import re
 import sys
+from functools import lru_cache
+from typing import *
+
+ROOT = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(ROOT, "assembler"))
+import rv32i
+from symbols import SOURCEMAP_PATH, LabelIndex, read_sourcemap, sourcemap_labels
 
 # Based on Matt Venn's work: https://github.com/mattvenn/gtkwave-python-filter-process
 # Modified to be async to avoid delays
 
+LOG = bool(os.environ.get("GTKWAVE_FILTER_LOG"))
+# Most bytes to take from stdin at once
+READ_SIZE = 1 << 16
+# Words that aren't in the program (ex. while the IR is still being loaded) that are remembered
+CACHE_SIZE = 4096
+# Most source lines (and labels) to list for an instruction word that's in the program more than once
+MAX_LINES = 3
+TABLE_VERSION = 2
+
+# The assembler's annotations end with `line=5: li a0, 1`
+ANNOTATION_LINE_REGEX = re.compile(r"\bline=(-?\d+):?(.*)")
+
+
+def log(message: str):
+    if LOG:
+        sys.stderr.write(f">>> {message}\n")
+
+
+def table_path(program: str) -> str:
+    """ Where the translations for a program are saved: foo.memh -> foo.gtkwave.json """
+    root, _ = path.splitext(program)
+    return root + ".gtkwave.json"
+
+
+class SourceLine(NamedTuple):
+    line_number: int
+    text: str  # the line as it was written, without its comment
+
+
+def read_program(fn: str) -> Tuple[List[int], List[Optional[SourceLine]]]:
+    """ The words in a .memh, and the source line of each (from the assembler's annotations). """
+    words = []
+    lines = []
+    with open(fn, "r") as f:
+        for line in f:
+            text, _, comment = line.partition("//")
+            text = text.split("#")[0].strip()
+            if not text:
+                continue
+            words.append(int(text, 16))
+            match = ANNOTATION_LINE_REGEX.search(comment)
+            if match:
+                text = match.group(2).split("#")[0].strip()
+                lines.append(SourceLine(int(match.group(1)), text))
+            else:
+                lines.append(None)
+    return words, lines
+
+
+def first(items: List[str]) -> List[str]:
+    """ The first MAX_LINES distinct items, and "..." if there were more. """
+    items = list(dict.fromkeys(items))
+    return items[:MAX_LINES] + (["..."] if len(items) > MAX_LINES else [])
+
+
+def describe(entries, sources=()) -> str:
+    """
+    Where an instruction word is in the source, ex. `line 5: li a0, 1 (func_eql)`, from its
+    sourcemap entries and/or its source lines.
+    """
+    numbers = [source.line_number for source in sources if source]
+    if not numbers:
+        numbers = [entry.line_number for entry in entries]
+    lines = first([str(number) for number in numbers if number > 0])
+    texts = first([source.text for source in sources if source and source.text])
+    labels = ", ".join(first([entry.label for entry in entries]))
+    if not lines:
+        return labels
+    where = f"line {lines[0]}" if len(lines) == 1 else "lines " + ", ".join(lines)
+    if texts:
+        where += ": " + " / ".join(texts)
+    return f"{where} ({labels})" if labels else where
+
+
+def build_table(words: List[int], entries, sources=()) -> Dict[int, str]:
+    """
+    Text for every instruction word in a program. Branch and jump targets are shown as labels
+    (unless the same word goes to different places in different parts of the program), and the
+    source line (from the .memh's annotations) and label (from the sourcemap) of the instruction
+    are added.
+    """
+    labels = LabelIndex(sourcemap_labels(entries)) if entries else None
+    places: Dict[int, List[int]] = {}
+    for i, word in enumerate(words):
+        places.setdefault(word, []).append(i)
+    table = {}
+    for word, indices in places.items():
+        try:
+            texts = {rv32i.bits_to_line(word, labels, 4 * i) for i in indices}
+            text = texts.pop() if len(texts) == 1 else rv32i.bits_to_line(word)
+        except ValueError:
+            continue  # Not an instruction, translate() reports it like any other bad word
+        where = describe(
+            [entries[i] for i in indices] if entries else [],
+            [sources[i] for i in indices] if sources else [],
+        )
+        if where:
+            text += f"  # {where}"
+        table[word] = text
+    return table
 
-async def instruction_filter():
+
+def load_table(program: str, sourcemap: Optional[str]) -> Dict[int, str]:
+    """
+    The table for a program, from its saved .gtkwave.json if that was made from the same .memh
+    and sourcemap, otherwise built (and saved for next time). The sourcemap is left out if it's
+    for some other program (it's always for the last program assembled).
+    """
+    contents = []
+    for fn in (program, sourcemap):
+        if fn and path.exists(fn):
+            with open(fn, "rb") as f:
+                contents.append(f.read())
+    key = hashlib.sha256(b"\0".join(contents)).hexdigest()
+
+    saved = table_path(program)
+    try:
+        with open(saved, "r") as f:
+            cached = json.load(f)
+        if cached.get("version") == TABLE_VERSION and cached.get("key") == key:
+            log(f"Loaded {saved}")
+            return {int(word, 16): text for word, text in cached["table"].items()}
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    words, sources = read_program(program)
+    entries = []
+    if len(contents) > 1:
+        entries = list(read_sourcemap(sourcemap))
+        matches = len(entries) == len(words) and all(
+            source is None or source.line_number == entry.line_number
+            for source, entry in zip(sources, entries)
+        )
+        if not matches:
+            log(f"{sourcemap} isn't for {program}, not using it")
+            entries = []
+    table = build_table(words, entries, sources)
+    try:
+        with open(saved + ".tmp", "w") as f:
+            json.dump({
+                "version": TABLE_VERSION,
+                "key": key,
+                "table": {f"{word:08x}": text for word, text in table.items()},
+            }, f)
+        os.replace(saved + ".tmp", saved)
+    except OSError as e:
+        log(f"Couldn't save {saved}: {e}")
+    return table
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def translate_word(word: int) -> str:
+    """ Disassemble a word that isn't in the program. """
+    return rv32i.bits_to_line(word)
+
+
+def translate(line: str, table: Mapping[int, str] = {}) -> str:
+    """ The text GTKWave should show for one value (a hex instruction word). """
+    line = line.strip()
+    if "x" in line.lower():
+        return "< X >"
+    try:
+        word = int(line, 16)
+    except ValueError:
+        word = None
+    if word is None or len(line) != 8:
+        log(f"bad instruction word form line {line}")
+        return line
+    if word in table:
+        return table[word]
+    try:
+        return translate_word(word)
+    except Exception:
+        log(f"Couldn't parse {line}")
+        return " > ??? < "
+
+
+def translate_batch(lines, table: Mapping[int, str] = {}) -> bytes:
+    translated = []
+    for line in lines:
+        text = translate(line.decode("ascii", "replace"), table)
+        log(f"{line!r} -> {text}")
+        translated.append(text)
+    return ("\n".join(translated) + "\n").encode("ascii", "replace")
+
+
+async def instruction_filter(table: Mapping[int, str] = {}):
     loop = asyncio.get_event_loop()
-    reader = asyncio.StreamReader()
+    reader = asyncio.StreamReader(limit=READ_SIZE)
     protocol = asyncio.StreamReaderProtocol(reader)
     await loop.connect_read_pipe(lambda: protocol, sys.stdin)
     w_transport, w_protocol = await loop.connect_write_pipe(
@@ -18,43 +226,53 @@ async def instruction_filter():
     )
     writer = asyncio.StreamWriter(w_transport, w_protocol, reader, loop)
 
+    # Translate everything that's arrived at once (GTKWave sends a burst of values when it redraws),
+    # then write and flush once for the whole batch
+    pending = b""
     while True:
         try:
-            line = await asyncio.wait_for(reader.readline(), 0.1)
-        except asyncio.exceptions.TimeoutError:
-            continue
-        except EOFError:
-            sys.stderr.write(f">>> Translation stopping.\n")
-            return 0
+            data = await reader.read(READ_SIZE)
         except Exception as e:
-            sys.stderr.write(f">>> Uncaught Exception: {dir(e)} {e}\n")
+            sys.stderr.write(f">>> Uncaught Exception: {e}\n")
             return 1
-        if not line:
-            sys.stderr.write(f">>> Translation stopping.\n")
+        if not data:
+            if pending.strip():
+                writer.write(translate_batch([pending], table))
+            # drain() only waits until the buffer is below its limit, so what's left would be lost
+            # when the loop stops. With no limit it waits until everything is written.
+            w_transport.set_write_buffer_limits(0)
+            await writer.drain()
+            log("Translation stopping.")
             return 0
-        line = line.decode()
-        line = line.strip()
-        sys.stderr.write(f">>> line: {line}\n")
-
-        if "x" in line.lower():
-            writer.write(bytes("< X >\n", "ascii"))
-            continue
-        sys.stderr.write(f">>> {line}\n")
-        bits = BitArray(hex=line)
-        if not bits or bits.length != 32:
-            sys.stderr.write(f">>> bad bit array: {bits} form line {line}\n")
-            writer.write(bytes(line + "\n", "ascii"))
-            continue
-        # TODO(avinash) - generate labels from known assembly file.
-        try:
-            disassembled = rv32i.bits_to_line(bits)
-        except Exception as e:
-            writer.write(bytes(" > ??? < \n", "ascii"))
-            sys.stderr.write("f>>> Couldn't parse {line}\n")
+        *lines, pending = (pending + data).split(b"\n")
+        if lines:
+            writer.write(translate_batch(lines, table))
+            await writer.drain()
+
 
-        writer.write(bytes(f"{disassembled}\n", "ascii"))
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "program",
+        nargs="?",
+        default=os.environ.get("GTKWAVE_FILTER_PROGRAM"),
+        help="the .memh being simulated (default $GTKWAVE_FILTER_PROGRAM)",
+    )
+    parser.add_argument(
+        "--sourcemap",
+        default=os.environ.get("GTKWAVE_FILTER_SOURCEMAP", path.join(ROOT, SOURCEMAP_PATH)),
+        help="the assembler's sourcemap for the program (default $GTKWAVE_FILTER_SOURCEMAP)",
+    )
+    args = parser.parse_args()
+
+    table = {}
+    if args.program:
+        try:
+            table = load_table(args.program, args.sourcemap)
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f">>> Couldn't load {args.program}, translating without it: {e}\n")
+    return asyncio.run(instruction_filter(table))
 
 
 if __name__ == "__main__":
-    ret = asyncio.run(instruction_filter())
-    sys.exit(ret)
+    sys.exit(main())
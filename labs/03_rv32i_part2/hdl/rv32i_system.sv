@@ -72,8 +72,14 @@ end
 `define INITIAL_INST_MEM "mem/zeros.memh"
 `endif // INITIAL_INST_MEM
 
+// Initialized data (.data/.rodata), written by the assembler next to the instruction memory.
+`ifndef INITIAL_DATA_MEM
+`define INITIAL_DATA_MEM "mem/zeros.memh"
+`endif // INITIAL_DATA_MEM
+
 mmu #(
   .INIT_INST(`INITIAL_INST_MEM),
+  .INIT_DATA(`INITIAL_DATA_MEM),
   .GPIO_PINS(8)
 ) MMU (
   .clk(clk), .rst(rst), .core_addr(core_mem_addr),